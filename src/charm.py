@@ -13,139 +13,586 @@ through the 'metrics-endpoint' relation using the
 `prometheus_scrape` interface.
 """
 
+import functools
+import hashlib
 import json
 import logging
-from typing import cast
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set, Tuple, cast
 
-import yaml
-from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointConsumer
 from ops.charm import CharmBase
+from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
+from ops.model import (
+    ActiveStatus,
+    BlockedStatus,
+    Relation,
+    RelationDataContent,
+    WaitingStatus,
+)
+
+from hook_tools import HookToolAccounting
+from overrides import InvalidOverridesError, ScrapeOverrides, profiles_from_config
+from payload_encoding import (
+    SPLIT_LAYOUT,
+    SUPPORTED_ENCODINGS_KEY,
+    ZLIB_ENCODING,
+    encode_relation_payload,
+    split_relation_payload,
+)
+from routing import InvalidRoutesError, RoutingTable, topology_labels
+from scrape_jobs import consolidate_jobs
+from serialization import canonical_json, iter_json_array
+from sharding import shard_jobs
+from upstreams import UpstreamsConsumer
+from write_buffer import WriteBuffer
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of cos-tool results kept in the charm state.
+COS_TOOL_CACHE_SIZE = 256
+# Maximum number of cos-tool processes run concurrently.
+COS_TOOL_MAX_WORKERS = 4
+# Maximum number of relation databags loaded concurrently.
+PREFETCH_MAX_WORKERS = 8
+# Topology labels identifying an upstream application across its units.
+_APPLICATION_LABELS = ("juju_model", "juju_model_uuid", "juju_application")
+
+
+def _payload_digest(payload: str) -> str:
+    """Compute a digest of a JSON payload that does not depend on its formatting or key order."""
+    try:
+        canonical = canonical_json(json.loads(payload))
+    except json.JSONDecodeError:
+        canonical = payload
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _prefetch_databags(databags: List[RelationDataContent], max_workers: int) -> int:
+    """Load relation databags concurrently, each with a `relation-get` hook tool invocation.
+
+    Databags are loaded the first time they are read, after which reads are memory lookups.
+
+    This is safe as long as no two threads load the same databag, which is why databags
+    are deduplicated first: loading a databag only sets its own cached content, and as of
+    ops 2.21, `_ModelBackend.relation_get` keeps no state between calls but runs a subprocess.
+    The only shared state is in the hook tool accounting, which is locked. Nothing else
+    may use the model while the databags are loaded.
+
+    Returns:
+        The number of databags loaded.
+    """
+    unique = list({id(databag): databag for databag in databags}.values())
+    if not unique:
+        return 0
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(unique))) as executor:
+        # Any read loads the whole databag
+        for _ in executor.map(len, unique):
+            pass
+    return len(unique)
+
+
+def _databag_changes(
+    databag: RelationDataContent, layout: Dict[str, Optional[str]], digests: Dict[str, str]
+) -> Dict[str, str]:
+    """Compute the changes bringing a databag to a layout, as written by `relation-set`."""
+    changes = {}  # type: Dict[str, str]
+    for key, value in layout.items():
+        current = databag.get(key)
+        if value is None:
+            if current is not None:
+                changes[key] = ""
+        elif key in digests:
+            # Plain JSON payloads are compared regardless of their formatting
+            if _payload_digest(current or "") != digests[key]:
+                changes[key] = value
+        elif current != value:
+            changes[key] = value
+    # Chunks that are no longer listed in the manifest of the split scrape jobs
+    changes.update(
+        {key: "" for key in databag if key.startswith("scrape_jobs.") and key not in layout}
+    )
+    return changes
+
+
+@functools.lru_cache(maxsize=16)
+def _compress_payload(payload: str) -> str:
+    """Compress a payload, once for all metrics consumers sharing it."""
+    return encode_relation_payload(payload, ZLIB_ENCODING)
+
+
+def _chunk_by_upstream(jobs: list) -> List[str]:
+    """Serialize the scrape jobs of each upstream application separately."""
+    chunks = {}  # type: Dict[Tuple[Tuple[str, str], ...], list]
+    for job in jobs:
+        chunks.setdefault(_application(_job_topology(job)), []).append(job)
+    return [canonical_json(chunk) for chunk in chunks.values()]
+
+
+def _job_topology(job: dict) -> Tuple[Tuple[str, str], ...]:
+    """Topology labels of the upstream a scrape job comes from."""
+    static_configs = job.get("static_configs") or [{}]
+    return topology_labels(static_configs[0].get("labels", {}))
+
+
+def _group_topology(group: dict) -> Tuple[Tuple[str, str], ...]:
+    """Topology labels of the upstream an alert rule group comes from."""
+    rules = group.get("rules") or [{}]
+    return topology_labels(rules[0].get("labels", {}))
+
+
+def _application(topology: Iterable[Tuple[str, str]]) -> Tuple[Tuple[str, str], ...]:
+    """Reduce topology labels to those identifying the upstream application, e.g. no unit."""
+    return tuple(pair for pair in topology if pair[0] in _APPLICATION_LABELS)
+
+
+@dataclass
+class _DirtyInputs:
+    """Inputs of the metrics consumer payloads that changed during the current dispatch.
+
+    Attributes:
+        config: whether the configuration, or anything else affecting every payload, changed.
+        upstreams: ids of the upstream relations whose scrape jobs or alert rules changed.
+        consumers: ids of the metrics consumer relations that need their payload (re)sent.
+    """
+
+    config: bool = False
+    upstreams: Set[int] = field(default_factory=set)
+    consumers: Set[int] = field(default_factory=set)
+
+    def __bool__(self) -> bool:
+        return self.config or bool(self.upstreams) or bool(self.consumers)
+
+    def all_consumers(self) -> bool:
+        """Whether the payloads of all metrics consumers may have changed."""
+        return self.config or bool(self.upstreams)
+
 
 class PrometheusScrapeConfigCharm(CharmBase):
     """PrometheusScrapeConfigCharm is an adapter charm used to override configuration settings in a scrape job."""
 
+    _stored = StoredState()
+
     def __init__(self, *args):
         """Construct the charm."""
         super().__init__(*args)
+        self._hook_tools = HookToolAccounting(self.model._backend)
+        # Digest of the configuration last published to the metrics consumers by this unit,
+        # while it was the leader.
+        self._stored.set_default(config_digest="")
+        # Time of the last update of the metrics consumer payloads, and whether an update was
+        # deferred since, see `min_publish_interval`. Both are only known to the unit that was
+        # leader at the time: a new leader compares the payloads with the consumer databags
+        # when it is elected, and defers the update itself if its own last one is too recent.
+        self._stored.set_default(last_publish=0.0, publish_pending=False)
 
         self._metrics_provider_relation_name = "configurable-scrape-jobs"
         self._metrics_consumer_relation_name = "metrics-endpoint"
         self._forward_alert_rules = cast(bool, self.config["forward_alert_rules"])
+        self._writes = WriteBuffer(self.unit)
+        # Event handlers only mark what changed, and the metrics consumers are reconciled
+        # once, at the end of the dispatch.
+        self._dirty = _DirtyInputs()
 
         # The metrics consumer object in this charm also acts as the metrics provider for other metrics
         # consumer charms related with this charm, hence we label the metrics consumer object in this charm
         # as the `_metrics_providers`.
-        self._metrics_providers = MetricsEndpointConsumer(
-            self, self._metrics_provider_relation_name
+        # Results are memoized per upstream relation, so that only upstreams whose relation data
+        # changed are processed again, and cos-tool results are cached across hooks. Diffs let
+        # changes to relation data that do not affect the scrape jobs or alert rules be ignored.
+        self._metrics_providers = UpstreamsConsumer(
+            self,
+            self._metrics_provider_relation_name,
+            memoize=True,
+            cos_tool_cache_size=COS_TOOL_CACHE_SIZE,
+            cos_tool_workers=min(COS_TOOL_MAX_WORKERS, os.cpu_count() or 1),
+            write_buffer=self._writes,
+            compute_diffs=True,
         )
 
         consumer_events = self.on[self._metrics_consumer_relation_name]
         provider_events = self.on[self._metrics_provider_relation_name]
 
-        for e in [
-            self.on.start,
-            self.on.config_changed,
-            self.on.upgrade_charm,
-            self._metrics_providers.on.targets_changed,
-            provider_events.relation_created,
-            provider_events.relation_joined,
-            provider_events.relation_broken,
-            consumer_events.relation_created,
-            consumer_events.relation_changed,
-        ]:
-            self.framework.observe(e, self._update_all_metrics_consumers)
+        # Upstream relations carry no data when they are created, so their jobs only change
+        # once they are joined. Only the leader updates the metrics consumers, so a new leader
+        # reconciles them all, as nothing may have changed in the relation data since.
+        for e in [self.on.start, self.on.upgrade_charm, self.on.leader_elected]:
+            self.framework.observe(e, self._mark_all_dirty)
+        for e in [provider_events.relation_joined, provider_events.relation_broken]:
+            self.framework.observe(e, self._mark_upstream_dirty)
+        for e in [consumer_events.relation_created, consumer_events.relation_changed]:
+            self.framework.observe(e, self._mark_consumer_dirty)
+        self.framework.observe(
+            self._metrics_providers.on.targets_changed, self._on_targets_changed
+        )
 
+        self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.install, self._on_install)
+        self.framework.observe(self.framework.on.pre_commit, self._reconcile)
+        self.framework.observe(self.framework.on.commit, self._on_commit)
 
     def _on_install(self, _) -> None:
         """Do any initial charm startup operations."""
         self.unit.set_workload_version("n/a")
 
-    def _update_all_metrics_consumers(self, _):
-        """Update all scrape configuration jobs for all metrics consumers."""
-        logger.debug("Updating all metrics consumers")
+    def _on_commit(self, _) -> None:
+        """Report the hook tools and cos-tool runs of the hook, once it is done."""
+        logger.debug(
+            "Hook tools: %s; cos-tool cache: %s",
+            self._hook_tools.summary(),
+            self._metrics_providers.cos_tool_cache.summary(),
+        )
+
+    def _on_config_changed(self, _) -> None:
+        """Mark the configuration dirty, unless it did not actually change."""
+        try:
+            overrides = ScrapeOverrides.from_config(self.model.config)
+        except InvalidOverridesError:
+            # Let the reconciliation surface the error in the unit status
+            pass
+        else:
+            if self.unit.is_leader() and self._stored.config_digest == overrides.digest:
+                logger.debug("Configuration unchanged, skipping update of metrics consumers")
+                return
+
+        self._dirty.config = True
+
+    def _on_targets_changed(self, event) -> None:
+        """Mark the upstream relation whose scrape jobs or alert rules changed dirty."""
+        if event.diff is not None and not event.diff:
+            logger.debug("Scrape targets of relation %s unchanged", event.relation_id)
+            return
+        self._dirty.upstreams.add(event.relation_id)
+
+    def _mark_all_dirty(self, _) -> None:
+        """Mark every input dirty, e.g. after the charm was (re)started, upgraded or elected."""
+        self._dirty.config = True
+
+    def _mark_upstream_dirty(self, event) -> None:
+        """Mark an upstream relation dirty."""
+        self._dirty.upstreams.add(event.relation.id)
+
+    def _mark_consumer_dirty(self, event) -> None:
+        """Mark a metrics consumer relation dirty."""
+        self._dirty.consumers.add(event.relation.id)
+
+    def _reconcile(self, _) -> None:
+        """Update the metrics consumers affected by the inputs marked dirty during the dispatch.
+
+        Changes to relation data and to the unit status are buffered, and applied together
+        once all metrics consumers were updated. The buffer is flushed even if nothing is
+        dirty, as event handlers buffer writes too, e.g. the errors reported to an upstream
+        whose scrape jobs are invalid. An update deferred by `min_publish_interval` is made by
+        the first hook after the interval, whatever the hook.
+        """
+        dirty, self._dirty = self._dirty, _DirtyInputs()
+        if self._stored.publish_pending and not self._publish_deferred():
+            dirty.config = True
+        if dirty:
+            self._update_metrics_consumers(dirty)
+        self._writes.flush()
+
+    def _update_metrics_consumers(self, dirty: _DirtyInputs):
+        """Update the metrics consumers affected by the dirty inputs, through the write buffer.
+
+        Upstreams whose relation data did not change are not processed again, as the scrape
+        jobs and alert rules are memoized per upstream relation.
+        """
+        logger.debug("Updating metrics consumers (%s)", dirty)
 
         if not self.unit.is_leader():
-            self.unit.status = WaitingStatus("inactive unit")
+            self._stored.config_digest = ""
+            self._stored.publish_pending = False
+            self._writes.set_status(WaitingStatus("inactive unit"))
+            return
+
+        try:
+            overrides = ScrapeOverrides.from_config(self.model.config)
+            profiles = profiles_from_config(self.model.config)
+            routes = RoutingTable.from_config(cast(str, self.config.get("routes")))
+        except (InvalidOverridesError, InvalidRoutesError) as e:
+            self._writes.set_status(BlockedStatus(f"invalid config: {e}"))
             return
 
         if not self._has_consumers():
-            self.unit.status = BlockedStatus(
-                "missing metrics consumer (relate to prometheus?)"
+            self._writes.set_status(
+                BlockedStatus("missing metrics consumer (relate to prometheus?)")
             )
             return
 
         if not self._has_providers():
-            self.unit.status = BlockedStatus(
-                "missing metrics provider (relate to upstream charm?)"
+            self._writes.set_status(
+                BlockedStatus("missing metrics provider (relate to upstream charm?)")
             )
             return
 
-        self.unit.status = MaintenanceStatus(
-            "Updating scrape jobs and alert rules for all metrics consumer"
+        self._prefetch_relation_data()
+
+        # Collecting the jobs and alert rules (including any cos-tool invocations) is the
+        # expensive part, so it is done once and only the overrides are applied per consumer.
+        # Without sharding, routing or profiles, the payload is shared by all consumers.
+        prometheus_configurations = self._prometheus_configurations()
+        relations = self.model.relations[self._metrics_consumer_relation_name]
+        per_consumer = bool(self.config["shard_targets"] or routes or profiles)
+        consumers = sorted({self._consumer_name(relation, per_consumer) for relation in relations})
+        scrape_jobs = self._distribute_scrape_jobs(
+            prometheus_configurations["scrape_jobs"], routes, consumers
         )
-
-        for relation in self.model.relations[self._metrics_consumer_relation_name]:
-            self._update_metrics_consumer_relation(relation)
-
-        self.unit.status = ActiveStatus()
-
-    def _update_metrics_consumer_relation(self, metrics_consumer_relation):
-        """Ensure that a specific metrics consumer's job specifications are updated."""
+        alert_rules = self._distribute_alert_rules(
+            prometheus_configurations["alert_rules"], routes, consumers, scrape_jobs
+        )
+        # Jobs are distributed across all consumers, but payloads are only made for those
+        # that need updating
+        if not dirty.all_consumers():
+            relations = [relation for relation in relations if relation.id in dirty.consumers]
+        updated = sorted({self._consumer_name(relation, per_consumer) for relation in relations})
+        payloads = {}  # type: Dict[str, Dict[str, str]]
+        digests = {}  # type: Dict[str, Dict[str, str]]
+        chunks = {}  # type: Dict[str, Dict[str, str]]
+        for consumer in updated:
+            consumer_overrides = profiles.get(consumer, overrides)
+            # The overridden copies are serialized as they are made, unless they are needed again
+            jobs = (
+                consumer_overrides.apply(dict(job)) for job in scrape_jobs[consumer]
+            )  # type: Iterable[dict]
+            if self.config["consolidate_jobs"]:
+                jobs = consolidate_jobs(list(jobs))
+            if self.config["split_scrape_jobs"]:
+                jobs = list(jobs)
+                chunks[consumer] = split_relation_payload("scrape_jobs", _chunk_by_upstream(jobs))
+            payloads[consumer] = {
+                "scrape_jobs": "".join(iter_json_array(jobs)),
+                "alert_rules": canonical_json(alert_rules[consumer]),
+            }
+            digests[consumer] = {
+                key: _payload_digest(value) for key, value in payloads[consumer].items()
+            }
+
+        self._publish(relations, per_consumer, payloads, digests, chunks)
+        self._stored.config_digest = overrides.digest
+        self._writes.set_status(ActiveStatus())
+
+    def _publish(
+        self,
+        relations: List[Relation],
+        per_consumer: bool,
+        payloads: Dict[str, Dict[str, str]],
+        digests: Dict[str, Dict[str, str]],
+        chunks: Dict[str, Dict[str, str]],
+    ) -> None:
+        """Update the payloads of metrics consumers, unless deferred by `min_publish_interval`."""
+        deferred = self._publish_deferred()
+        changed = False
+        for relation in relations:
+            consumer = self._consumer_name(relation, per_consumer)
+            changed = (
+                self._update_metrics_consumer_relation(
+                    relation, payloads[consumer], digests[consumer], chunks.get(consumer), deferred
+                )
+                or changed
+            )
+        if deferred:
+            if changed:
+                logger.info("Metrics consumers were updated too recently, deferring the update")
+                self._stored.publish_pending = True
+        else:
+            self._stored.publish_pending = False
+            if changed:
+                self._stored.last_publish = time.time()
+
+    def _update_metrics_consumer_relation(
+        self,
+        metrics_consumer_relation,
+        payload: Dict[str, str],
+        digests: Dict[str, str],
+        chunks: Optional[Dict[str, str]] = None,
+        defer: bool = False,
+    ) -> bool:
+        """Ensure that a specific metrics consumer's job specifications are updated.
+
+        Args:
+            metrics_consumer_relation: the `metrics-endpoint` relation to update.
+            payload: mapping of application databag keys (`scrape_jobs`, `alert_rules`)
+                to their JSON serialized values.
+            digests: mapping of the same keys to the digest of their values.
+            chunks: the scrape jobs split per upstream application, as laid out in the
+                databag by `split_relation_payload`, if enabled.
+            defer: whether to leave the relation data as is, even if it is outdated.
+
+        Returns:
+            Whether the relation data was outdated.
+        """
         if not self.unit.is_leader():
-            self.unit.status = WaitingStatus("inactive unit")
-            return
+            self._writes.set_status(WaitingStatus("inactive unit"))
+            return False
 
         if not metrics_consumer_relation:
             logger.debug("no metrics consumer relation provided")
-            return
-
-        prometheus_configurations = self._prometheus_configurations
-
-        scrape_jobs = json.dumps(prometheus_configurations["scrape_jobs"])
-        alert_rules = json.dumps(prometheus_configurations["alert_rules"])
-
-        metrics_consumer_relation.data[self.app]["scrape_jobs"] = scrape_jobs
-        metrics_consumer_relation.data[self.app]["alert_rules"] = alert_rules
+            return False
+
+        # Every write may trigger a configuration reload on the consumer side, so only keys whose
+        # content actually changed are written.
+        layout = self._databag_layout(metrics_consumer_relation, payload, chunks)
+        changes = _databag_changes(metrics_consumer_relation.data[self.app], layout, digests)
+        if not changes:
+            logger.debug("Metrics consumer %s is up to date", metrics_consumer_relation.app)
+            return False
+        if defer:
+            logger.debug("Deferred update of metrics consumer %s", metrics_consumer_relation.app)
+            return True
+
+        self._writes.update(metrics_consumer_relation, self.app, changes)
         logger.debug("Updated metrics consumer %s", metrics_consumer_relation.app)
+        return True
+
+    def _publish_deferred(self) -> bool:
+        """Whether the metrics consumers were updated less than `min_publish_interval` ago."""
+        interval = cast(int, self.config["min_publish_interval"])
+        # Updates are not deferred indefinitely if the clock goes backwards
+        return interval > 0 and 0 <= time.time() - self._stored.last_publish < interval
+
+    def _databag_layout(
+        self, relation, payload: Dict[str, str], chunks: Optional[Dict[str, str]]
+    ) -> Dict[str, Optional[str]]:
+        """Lay out the payloads in the databag of a metrics consumer, as the consumer supports.
+
+        Returns:
+            A mapping of all databag keys holding payloads to their values, or to None for the
+            keys that should not be set. Chunks of split scrape jobs that are no longer listed
+            in the manifest are not included.
+        """
+        compress = self._supports(relation, "compress_payloads", ZLIB_ENCODING)
+        split = chunks is not None and self._supports(relation, "split_scrape_jobs", SPLIT_LAYOUT)
+        layout = {"scrape_jobs_manifest": None}  # type: Dict[str, Optional[str]]
+        for key, value in payload.items():
+            # Only one of the layouts of each payload is set at any time
+            compressed_key = f"{key}_{ZLIB_ENCODING}"
+            layout[key] = layout[compressed_key] = None
+            if key == "scrape_jobs" and split and chunks is not None:
+                layout.update(chunks)
+            elif compress:
+                # Compression is deterministic, so compressed payloads can be compared as is
+                layout[compressed_key] = _compress_payload(value)
+            else:
+                layout[key] = value
+        return layout
+
+    def _supports(self, relation, option: str, encoding: str) -> bool:
+        """Whether an encoding is enabled by a config option and supported by a metrics consumer."""
+        if not self.config[option] or not relation.app:
+            return False
+        try:
+            encodings = json.loads(relation.data[relation.app].get(SUPPORTED_ENCODINGS_KEY, "[]"))
+        except json.JSONDecodeError:
+            return False
+        return isinstance(encodings, list) and encoding in encodings
+
+    def _prefetch_relation_data(self) -> None:
+        """Load all the relation databags read while updating the metrics consumers up front.
+
+        Those are the databags of the upstream applications and their units, and the databags
+        of the downstream applications and of this application on the downstream relations.
+        Loading them concurrently rather than one by one, as they are first read, overlaps
+        their `relation-get` invocations.
+        """
+        databags = []  # type: List[RelationDataContent]
+        for relation in self.model.relations[self._metrics_provider_relation_name]:
+            remote = [relation.app, *relation.units] if relation.app else list(relation.units)
+            databags.extend(relation.data[entity] for entity in remote)
+        for relation in self.model.relations[self._metrics_consumer_relation_name]:
+            local_and_remote = [self.app, relation.app] if relation.app else [self.app]
+            databags.extend(relation.data[entity] for entity in local_and_remote)
+
+        start = time.monotonic()
+        loaded = _prefetch_databags(databags, PREFETCH_MAX_WORKERS)
+        logger.debug(
+            "Loaded %d relation databags with up to %d threads in %.1f ms",
+            loaded,
+            PREFETCH_MAX_WORKERS,
+            (time.monotonic() - start) * 1000,
+        )
 
-    @property
     def _prometheus_configurations(self):
-        """Fetch all scrape jobs with updated configuration.
+        """Fetch all scrape jobs and alert rules provided by related metrics providers.
 
-        This method transforms all scrape jobs provided by related
-        metrics consumers, using configuration items set in this
-        charm. The scrape jobs (including associated alert rules)
-        are returned.
+        The scrape jobs are returned as provided, as an iterator to be consumed once; the
+        overrides compiled from the configuration items set in this charm are applied per
+        metrics consumer.
+        Both are in canonical order, independent of the order of the relations.
         """
-        non_scrape_config_keys = ["forward_alert_rules"]
-        yaml_keys = ["relabel_configs", "metric_relabel_configs"]
-        config = {k: v for k, v in self.model.config.items() if k not in [*non_scrape_config_keys, *yaml_keys]}
-        for key in yaml_keys:
-            if as_yaml := self.model.config.get(key):
-                config[key] = yaml.safe_load(str(as_yaml))
-
-        configured_jobs = []
-        for job in self._metrics_providers.jobs():
-            job.update(config)
-            configured_jobs.append(job)
-
-        alerts = list(self._metrics_providers.alerts.values())
+        configured_jobs = self._metrics_providers.iter_jobs()
+
+        alerts = self._metrics_providers.alerts
         alert_groups = {"groups": []}  # type: ignore
         if self._forward_alert_rules:
-            for entry in alerts:
-                alert_groups["groups"] += entry["groups"]
+            for identifier in sorted(alerts):
+                alert_groups["groups"] += alerts[identifier]["groups"]
 
         return {
             "scrape_jobs": configured_jobs,
             "alert_rules": alert_groups if alert_groups["groups"] else {},
         }
 
+    def _distribute_scrape_jobs(
+        self, jobs: Iterable[dict], routes: RoutingTable, consumers: List[str]
+    ) -> Dict[str, list]:
+        """Pick the scrape jobs to send to each metrics consumer.
+
+        Jobs are routed to the consumers selected by the routing table. With sharding enabled,
+        the targets of each job are then split across the consumers it is routed to.
+        """
+        if not self.config["shard_targets"]:
+            return routes.index(jobs, _job_topology, consumers)
+
+        distributed = {consumer: [] for consumer in consumers}  # type: Dict[str, list]
+        for job in jobs:
+            routed = routes.consumers_for(dict(_job_topology(job)), consumers)
+            for consumer, shard in shard_jobs([job], routed).items():
+                distributed[consumer].extend(shard)
+        return distributed
+
+    def _distribute_alert_rules(
+        self,
+        alert_rules: dict,
+        routes: RoutingTable,
+        consumers: List[str],
+        scrape_jobs: Dict[str, list],
+    ) -> Dict[str, dict]:
+        """Pick the alert rule groups to send to each metrics consumer, as routed.
+
+        With sharding enabled, the alert rules of an upstream application are only sent to
+        the consumers scraping its targets, as rules such as `absent(up{...})` would fire on
+        all others. The rules of applications without targets are sent as routed.
+        """
+        groups = routes.index(alert_rules.get("groups", []), _group_topology, consumers)
+        if self.config["shard_targets"]:
+            scraping = {}  # type: Dict[Tuple[Tuple[str, str], ...], Set[str]]
+            for consumer, jobs in scrape_jobs.items():
+                for job in jobs:
+                    scraping.setdefault(_application(_job_topology(job)), set()).add(consumer)
+            for consumer in consumers:
+                groups[consumer] = [
+                    group
+                    for group in groups[consumer]
+                    if consumer in scraping.get(_application(_group_topology(group)), {consumer})
+                ]
+        return {
+            consumer: {"groups": groups[consumer]} if groups[consumer] else {}
+            for consumer in consumers
+        }
+
+    def _consumer_name(self, relation, per_consumer: bool) -> str:
+        """Name a metrics consumer after its application, if consumers get different payloads.
+
+        Otherwise, all consumers share the same name and payload, which is only serialized once.
+        """
+        if not per_consumer:
+            return ""
+        return relation.app.name if relation.app else f"{relation.name}:{relation.id}"
+
     def _has_providers(self):
         """Checks if there is at least one metrics provider related to the charm."""
         return (
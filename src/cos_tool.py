@@ -0,0 +1,456 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Cached, batched and concurrent cos-tool runs.
+
+The `prometheus_scrape` library runs cos-tool once per scrape job list, alert rule
+file and alert expression. `CosTool` extends its runner so that results are cached
+(across hooks if the cache is persisted), the scrape jobs of all upstreams are
+validated together, common alert expressions are labeled in-process, and the rest
+are transformed in as few runs as possible, concurrently if allowed.
+"""
+
+import hashlib
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, MutableMapping, Optional, Tuple
+
+import yaml
+from charms.prometheus_k8s.v0 import prometheus_scrape
+
+from promql import UnsupportedPromQLError, inject_promql_label_matchers
+from serialization import canonical_json
+
+logger = logging.getLogger(__name__)
+
+
+class CosToolCache:
+    """A size-bounded LRU cache of cos-tool results.
+
+    cos-tool results only depend on the cos-tool binary, the operation and its
+    input, so they are keyed by a digest of all three. Failed runs are cached as
+    well, so that invalid input does not cost a cos-tool run every time it is seen.
+
+    The entries are kept in a mutable mapping, in least to most recently used
+    order. Passing a `StoredState` dict persists the cache across hooks. Lookups
+    do not modify the mapping, so that a hook only hitting the cache does not
+    mark the stored state dirty: the entries that were used are only moved to
+    the end of the mapping when a result is inserted.
+
+    Attributes:
+        hits: number of lookups that found a cached result.
+        misses: number of lookups that did not.
+    """
+
+    def __init__(self, entries: Optional[MutableMapping] = None, max_entries: int = 1024):
+        self._entries = {} if entries is None else entries  # type: MutableMapping
+        self._max_entries = max_entries
+        # Keys of the entries used since the last insertion, from least to most recently used
+        self._used = {}  # type: Dict[str, None]
+        # cos-tool may be run from several threads, see `CosTool.map`
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(binary_digest: str, operation: str, payload: Any) -> str:
+        """Compute the cache key of running a cos-tool operation on the given input."""
+        canonical = canonical_json([binary_digest, operation, payload])
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[int, str, List[str]]]:
+        """Look up the (return code, output, command) of a cached run, marking it as used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._used.pop(key, None)
+            self._used[key] = None
+        # Entries loaded from a `StoredState` dict are stored lists
+        return entry[0], entry[1], list(entry[2])
+
+    def put(self, key: str, returncode: int, output: str, cmd: List[str]):
+        """Cache the result of a run, evicting the least recently used results if full."""
+        with self._lock:
+            used, self._used = self._used, {}
+            for used_key in used:
+                if used_key in self._entries:
+                    self._entries[used_key] = self._entries.pop(used_key)
+            self._entries.pop(key, None)
+            self._entries[key] = [returncode, output, cmd]
+            while len(self._entries) > self._max_entries:
+                del self._entries[next(iter(self._entries))]
+
+    def summary(self) -> str:
+        """Summarize the lookups since the cache was loaded."""
+        return "{} hits, {} misses, {} entries".format(self.hits, self.misses, len(self))
+
+    def __len__(self):
+        """Number of cached results."""
+        return len(self._entries)
+
+
+class CosTool(prometheus_scrape.CosTool):
+    """Runs cos-tool like the library's `CosTool`, caching and combining its runs."""
+
+    # Digests of cos-tool binaries, keyed by their path, size and modification time
+    _binary_digests = {}  # type: Dict[Tuple[str, int, int], str]
+
+    def __init__(self, charm, cache: Optional[CosToolCache] = None, max_workers: int = 1):
+        super().__init__(charm)
+        self.cache = cache if cache is not None else CosToolCache()
+        self._max_workers = max_workers
+        # Bounds the cos-tool processes run at once, as concurrent bisections nest thread pools
+        self._slots = threading.BoundedSemaphore(max(max_workers, 1))
+
+    def map(self, func: Callable[[Any], Any], items: list) -> list:
+        """Apply a function running cos-tool to each item, concurrently if `max_workers` allows.
+
+        Only the cos-tool runs are meant to happen concurrently, so the function
+        must not touch the charm model (e.g. relation data).
+
+        Returns:
+            The results, in the same order as the items.
+        """
+        if self._max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self._max_workers, len(items))) as pool:
+            return list(pool.map(func, items))
+
+    def validate_alert_rules(self, rules: dict) -> Tuple[bool, str]:
+        """Will validate correctness of alert rules, returning a boolean and any errors."""
+        if not self.path:
+            logger.debug("`cos-tool` unavailable. Not validating alert correctness.")
+            return True, ""
+
+        def validate() -> str:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                rule_path = Path(tmpdir + "/validate_rule.yaml")
+                rule_path.write_text(yaml.dump(rules))
+                return self._exec([str(self.path), "validate", str(rule_path)])
+
+        # noinspection PyBroadException
+        try:
+            self._exec_cached("validate", rules, validate)
+            return True, ""
+        except subprocess.CalledProcessError as e:
+            logger.debug("Validating the rules failed: %s", e.output)
+            return False, ", ".join(
+                [
+                    line
+                    for line in e.output.decode("utf8").splitlines()
+                    if "error validating" in line
+                ]
+            )
+
+    def validate_scrape_jobs(self, jobs: list) -> bool:
+        """Validate scrape jobs using cos-tool."""
+        if not self.path:
+            logger.debug("`cos-tool` unavailable. Not validating scrape jobs.")
+            return True
+        try:
+            self._validate_scrape_configs(jobs)
+        except subprocess.CalledProcessError as e:
+            logger.error("Validating scrape jobs failed: {}".format(e.output))
+            raise
+        return True
+
+    def validate_scrape_jobs_batch(self, job_lists: List[list]) -> List[Optional[str]]:
+        """Validate several independent lists of scrape jobs using as few cos-tool runs as possible.
+
+        All lists are validated together in a single cos-tool run. Only if
+        that fails, the lists are bisected to isolate the invalid ones, so
+        that errors can still be attributed to each list individually. With
+        more than one worker, both halves of each bisection are validated
+        concurrently.
+
+        Args:
+            job_lists: lists of scrape jobs, e.g. one for each relation.
+
+        Returns:
+            A list with an item for each list of jobs, which is the validation
+            error if that list of jobs is invalid and None otherwise.
+        """
+        errors = [None] * len(job_lists)  # type: List[Optional[str]]
+        if not self.path:
+            logger.debug("`cos-tool` unavailable. Not validating scrape jobs.")
+            return errors
+
+        self._bisect_scrape_jobs(job_lists, [i for i, jobs in enumerate(job_lists) if jobs], errors)
+        return errors
+
+    def _bisect_scrape_jobs(
+        self, job_lists: List[list], indices: List[int], errors: List[Optional[str]]
+    ):
+        """Validate the job lists at the given indices, recording errors of the invalid ones."""
+        if not indices:
+            return
+
+        if len(indices) == 1:
+            try:
+                self.validate_scrape_jobs(job_lists[indices[0]])
+            except subprocess.CalledProcessError as e:
+                errors[indices[0]] = str(e)
+            return
+
+        # Job names only need to be unique within each list, so they are made unique
+        # across lists for the combined validation.
+        combined = [
+            dict(job, job_name="{}_{}".format(i, job.get("job_name", "")))
+            for i in indices
+            for job in job_lists[i]
+        ]
+        try:
+            self._validate_scrape_configs(combined)
+        except subprocess.CalledProcessError:
+            # The halves are independent, so they are bisected concurrently if workers allow
+            middle = len(indices) // 2
+            self.map(
+                lambda half: self._bisect_scrape_jobs(job_lists, half, errors),
+                [indices[:middle], indices[middle:]],
+            )
+
+    def _validate_scrape_configs(self, jobs: list):
+        """Run cos-tool on a Prometheus config with the given scrape jobs."""
+        conf = {"scrape_configs": jobs}
+
+        def validate() -> str:
+            with tempfile.NamedTemporaryFile() as tmpfile:
+                with open(tmpfile.name, "w") as f:
+                    f.write(yaml.safe_dump(conf))
+                return self._exec([str(self.path), "validate-config", tmpfile.name])
+
+        self._exec_cached("validate-config", conf, validate)
+
+    def inject_label_matchers(self, expression, topology) -> str:
+        """Add label matchers to an expression.
+
+        Common expressions are handled in-process by `inject_promql_label_matchers`,
+        only the ones it does not support are transformed with cos-tool.
+        """
+        if not topology:
+            return expression
+        try:
+            return inject_promql_label_matchers(expression, topology)
+        except UnsupportedPromQLError as e:
+            logger.debug("Transforming %s with cos-tool: %s", expression, e)
+        if not self.path:
+            logger.debug("`cos-tool` unavailable. Leaving expression unchanged: %s", expression)
+            return expression
+        # noinspection PyBroadException
+        try:
+            return self._transform(expression, topology)
+        except subprocess.CalledProcessError as e:
+            logger.debug('Applying the expression failed: "%s", falling back to the original', e)
+            return expression
+
+    def inject_label_matchers_bulk(
+        self, expressions: List[Tuple[str, Dict[str, str]]]
+    ) -> List[str]:
+        """Add label matchers to many expressions, using as few cos-tool runs as possible.
+
+        Common expressions are handled in-process by `inject_promql_label_matchers`.
+        cos-tool transforms a single expression per run, so the remaining expressions that get
+        the same label matchers are combined into one, as in `(expr_1) or (expr_2)`,
+        which is transformed in a single run and then split again. If a combined
+        expression cannot be transformed (e.g. because one of the expressions is
+        not an instant vector), its expressions are transformed one by one.
+        Expressions getting different label matchers are transformed concurrently
+        if `max_workers` allows.
+
+        Args:
+            expressions: a list of (expression, label matchers) pairs.
+
+        Returns:
+            The transformed expressions, in the same order. As with
+            `inject_label_matchers`, an expression that cannot be transformed
+            is returned unchanged.
+        """
+        results = [expression for expression, _ in expressions]
+        batches = defaultdict(list)  # type: Dict[Tuple[Tuple[str, str], ...], List[int]]
+        for i, (expression, topology) in enumerate(expressions):
+            if not topology:
+                continue
+            try:
+                results[i] = inject_promql_label_matchers(expression, topology)
+            except UnsupportedPromQLError as e:
+                logger.debug("Transforming %s with cos-tool: %s", expression, e)
+                batches[tuple(topology.items())].append(i)
+
+        if batches and not self.path:
+            logger.debug("`cos-tool` unavailable. Leaving expressions unchanged.")
+            return results
+
+        chunks = [
+            (dict(matchers), chunk)
+            for matchers, indices in batches.items()
+            for chunk in self._chunk_expressions(indices, results)
+        ]
+
+        def transform(item: Tuple[Dict[str, str], List[int]]) -> List[str]:
+            topology, chunk = item
+            chunk_expressions = [results[i] for i in chunk]
+            transformed = self._transform_combined(chunk_expressions, topology)
+            if transformed is None:
+                transformed = [
+                    self.inject_label_matchers(expression, topology)
+                    for expression in chunk_expressions
+                ]
+            return transformed
+
+        for (_, chunk), transformed in zip(chunks, self.map(transform, chunks)):
+            for i, expression in zip(chunk, transformed):
+                results[i] = expression
+
+        return results
+
+    def _chunk_expressions(self, indices: List[int], expressions: List[str]) -> List[List[int]]:
+        """Split the indices of expressions into chunks that fit in a single command argument."""
+        chunks = []  # type: List[List[int]]
+        chunk_length = 0
+        for i in indices:
+            length = len(expressions[i]) + len(" or ()\n")
+            if not chunks or chunk_length + length > _MAX_COMBINED_EXPRESSION_LENGTH:
+                chunks.append([])
+                chunk_length = 0
+            chunks[-1].append(i)
+            chunk_length += length
+        return chunks
+
+    def _transform_combined(
+        self, expressions: List[str], topology: Dict[str, str]
+    ) -> Optional[List[str]]:
+        """Inject label matchers into several expressions with a single cos-tool run.
+
+        Returns:
+            The transformed expressions, or None if they could not be
+            transformed together.
+        """
+        if len(expressions) == 1:
+            return [self.inject_label_matchers(expressions[0], topology)]
+
+        # The line break ends any trailing comment in an expression
+        combined = " or ".join("({}\n)".format(expression) for expression in expressions)
+        try:
+            output = self._transform(combined, topology)
+        except subprocess.CalledProcessError as e:
+            logger.debug("Transforming %d expressions together failed: %s", len(expressions), e)
+            return None
+
+        transformed = _split_parenthesized_or_operands(output)
+        if transformed is None or len(transformed) != len(expressions):
+            logger.debug("Unexpected output transforming expressions together: %s", output)
+            return None
+        return transformed
+
+    def _transform(self, expression: str, topology: Dict[str, str]) -> str:
+        """Inject label matchers into an expression with cos-tool."""
+        args = [str(self.path), "transform"]
+        args.extend(
+            ["--label-matcher={}={}".format(key, value) for key, value in topology.items()]
+        )
+        args.append(expression)
+        return self._exec_cached("transform", args[2:], lambda: self._exec(args))
+
+    def _exec_cached(self, operation: str, payload: Any, run: Callable[[], str]) -> str:
+        """Run a cos-tool operation, unless its result for the same input is cached.
+
+        Args:
+            operation: the cos-tool subcommand.
+            payload: a JSON serializable representation of the input of the operation.
+            run: a function running the operation with cos-tool.
+
+        Raises:
+            CalledProcessError: if the operation fails, or failed when it was cached.
+        """
+        key = CosToolCache.key(self._binary_digest(), operation, payload)
+        cached = self.cache.get(key)
+        if cached is not None:
+            returncode, output, cmd = cached
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, cmd, output=output.encode())
+            return output
+
+        try:
+            with self._slots:
+                output = run()
+        except subprocess.CalledProcessError as e:
+            output = e.output.decode("utf-8", "replace") if e.output else ""
+            self.cache.put(key, e.returncode, output, [str(arg) for arg in e.cmd])
+            raise
+        self.cache.put(key, 0, output, [])
+        return output
+
+    def _binary_digest(self) -> str:
+        """Compute a digest of the cos-tool binary, hashing each version only once."""
+        path = str(self.path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path
+        version = (path, stat.st_size, stat.st_mtime_ns)
+        if version not in self._binary_digests:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            CosTool._binary_digests[version] = digest.hexdigest()
+        return self._binary_digests[version]
+
+
+# Maximum length of an expression combining several others, well below the 128KiB limit
+# Linux imposes on a single command line argument.
+_MAX_COMBINED_EXPRESSION_LENGTH = 64 * 1024
+
+
+def _split_parenthesized_or_operands(expression: str) -> Optional[List[str]]:
+    """Split an expression of the form `(expr_1) or (expr_2) or ...` into its operands.
+
+    Returns:
+        The operands without their enclosing parentheses, or None if the
+        expression does not have the expected form.
+    """
+    operands = []
+    position = 0
+    while True:
+        if not expression.startswith("(", position):
+            return None
+        end = _find_closing_parenthesis(expression, position)
+        if end is None:
+            return None
+        operands.append(expression[position + 1 : end])
+        position = end + 1
+        if position == len(expression):
+            return operands
+        if not expression.startswith(" or ", position):
+            return None
+        position += len(" or ")
+
+
+def _find_closing_parenthesis(expression: str, start: int) -> Optional[int]:
+    """Find the parenthesis closing the one at `start`, skipping over PromQL string literals."""
+    depth = 0
+    position = start
+    while position < len(expression):
+        char = expression[position]
+        if char in "\"'`":
+            # Skip to the end of the string literal; only backticks do not support escapes
+            position += 1
+            while position < len(expression) and expression[position] != char:
+                position += 2 if char != "`" and expression[position] == "\\" else 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return position
+        position += 1
+    return None
@@ -0,0 +1,103 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Accounting of the hook tools invoked by the charm.
+
+Every interaction with Juju during a hook, e.g. reading relation data or setting the
+unit status, runs a hook tool such as `relation-get` or `status-set` in a subprocess.
+`HookToolAccounting` counts and times these invocations, so that they can be reported
+at the end of the hook.
+
+ops already caches most read-only results for the duration of a hook (`is-leader` for
+the duration of its lease, `config-get`, `relation-ids`, `relation-list` and every
+`relation-get`). The remote application of a relation cannot change, so the
+`relation-list --app` invocations finding it are memoized as well. Other read-only
+hook tools are not: the goal state behind `planned_units`, for instance, changes as
+soon as units are added or removed, even during a hook.
+
+There is no public hook for this: the hook tools are run by the private `_run` method
+of `ops.model._ModelBackend`, which is wrapped, like the backend method that is
+memoized. Backends without these methods are left alone, so the invocations are not
+accounted for if a later ops release drops them; the tests of this module check the
+ops version in use still has them.
+"""
+
+import functools
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Counter, Dict, Tuple
+
+# Model backend methods running hook tools whose result cannot change, that ops does not cache.
+MEMOIZED_METHODS = ("relation_remote_app_name",)
+
+
+class HookToolAccounting:
+    """Counts and times the hook tool invocations of an ops model backend.
+
+    Hook tools may be invoked concurrently, e.g. when relation data is prefetched, so the
+    accounting is updated under a lock.
+
+    Attributes:
+        calls: number of invocations of each hook tool.
+        durations: total time spent running each hook tool, in seconds.
+        memoized: number of backend method calls answered from memory, per method.
+    """
+
+    def __init__(self, backend: Any):
+        self.calls: Counter[str] = Counter()
+        self.durations: Dict[str, float] = defaultdict(float)
+        self.memoized: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        # Every hook tool is run by this method of the model backend, which the testing
+        # backend does not have
+        if hasattr(backend, "_run"):
+            backend._run = self._counted(backend._run)
+        for name in MEMOIZED_METHODS:
+            if hasattr(backend, name):
+                setattr(backend, name, self._memoized(name, getattr(backend, name)))
+
+    def summary(self) -> str:
+        """Summarize the hook tool invocations, the most time consuming first."""
+        if not self.calls and not self.memoized:
+            return "no hook tools invoked"
+        tools = sorted(self.calls, key=lambda tool: (-self.durations[tool], tool))
+        summary = "{} hook tool invocations in {:.1f}ms".format(
+            sum(self.calls.values()), 1000 * sum(self.durations.values())
+        )
+        if tools:
+            summary += ": " + ", ".join(
+                "{} x{} ({:.1f}ms)".format(tool, self.calls[tool], 1000 * self.durations[tool])
+                for tool in tools
+            )
+        if self.memoized:
+            summary += "; {} avoided by memoization".format(sum(self.memoized.values()))
+        return summary
+
+    def _counted(self, run: Callable) -> Callable:
+        @functools.wraps(run)
+        def counted(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return run(*args, **kwargs)
+            finally:
+                duration = time.monotonic() - start
+                with self._lock:
+                    self.calls[args[0]] += 1
+                    self.durations[args[0]] += duration
+
+        return counted
+
+    def _memoized(self, name: str, method: Callable) -> Callable:
+        results: Dict[Tuple, Any] = {}
+
+        @functools.wraps(method)
+        def memoized(*args):
+            if args in results:
+                with self._lock:
+                    self.memoized[name] += 1
+            else:
+                results[args] = method(*args)
+            return results[args]
+
+        return memoized
@@ -0,0 +1,260 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Scrape job overrides compiled from the charm configuration.
+
+The charm configuration is parsed, validated and normalized once into an
+immutable `ScrapeOverrides` object, which is then applied to every scrape
+job forwarded to the metrics consumers.
+
+The `profiles` option may layer different overrides on top of the global
+ones for specific consumers, e.g.
+
+    prometheus-short-term: {scrape_interval: 15s}
+    prometheus-long-term: {scrape_interval: 2m, sample_limit: 10000}
+"""
+
+import hashlib
+import json
+import re
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional
+from urllib.parse import urlparse
+
+import yaml
+
+# Config options that are not part of a Prometheus scrape config.
+NON_SCRAPE_CONFIG_KEYS = (
+    "forward_alert_rules",
+    "shard_targets",
+    "routes",
+    "profiles",
+    "compress_payloads",
+    "split_scrape_jobs",
+    "consolidate_jobs",
+    "min_publish_interval",
+)
+# Config options holding YAML formatted lists of relabel configs.
+YAML_KEYS = ("relabel_configs", "metric_relabel_configs")
+DURATION_KEYS = ("scrape_interval", "scrape_timeout")
+LIMIT_KEYS = (
+    "sample_limit",
+    "label_limit",
+    "label_name_length_limit",
+    "label_value_length_limit",
+)
+# Config options that may be overridden by a profile.
+PROFILE_KEYS = YAML_KEYS + DURATION_KEYS + LIMIT_KEYS + ("proxy_url",)
+
+_DURATION_RE = re.compile(
+    r"^(?:(\d+)y)?(?:(\d+)w)?(?:(\d+)d)?(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?(?:(\d+)ms)?$"
+)
+# Milliseconds per duration unit, ordered as in `_DURATION_RE`.
+_DURATION_UNITS = (
+    ("y", 365 * 24 * 60 * 60 * 1000),
+    ("w", 7 * 24 * 60 * 60 * 1000),
+    ("d", 24 * 60 * 60 * 1000),
+    ("h", 60 * 60 * 1000),
+    ("m", 60 * 1000),
+    ("s", 1000),
+    ("ms", 1),
+)
+
+
+class InvalidOverridesError(Exception):
+    """Raised when the charm configuration does not describe valid scrape job overrides."""
+
+
+def parse_duration(value: str) -> int:
+    """Parse a Prometheus duration string (e.g. "1m30s") into milliseconds.
+
+    Raises:
+        ValueError: if the value is not a valid Prometheus duration.
+    """
+    if value == "0":
+        return 0
+    match = _DURATION_RE.match(value)
+    if not value or not match:
+        raise ValueError(f"not a valid duration string: {value!r}")
+    return sum(
+        int(amount) * unit_ms
+        for amount, (_, unit_ms) in zip(match.groups(), _DURATION_UNITS)
+        if amount
+    )
+
+
+def format_duration(milliseconds: int) -> str:
+    """Render milliseconds as a Prometheus duration string, the same way Prometheus does."""
+    if milliseconds == 0:
+        return "0s"
+    parts = []
+    for unit, unit_ms in _DURATION_UNITS:
+        amount, milliseconds = divmod(milliseconds, unit_ms)
+        if amount:
+            parts.append(f"{amount}{unit}")
+    return "".join(parts)
+
+
+def config_digest(config: Mapping[str, Any]) -> str:
+    """Compute a digest of the raw charm configuration."""
+    # Profiles are parsed from YAML and may hold non-JSON scalars such as dates
+    serialized = json.dumps(dict(config), sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class ScrapeOverrides:
+    """Validated scrape job settings that override those set by the metrics providers.
+
+    Attributes:
+        digest: digest of the raw charm configuration the overrides were compiled from.
+        values: scrape config keys mapped to their parsed and normalized values. Nested
+            values (e.g. relabel configs) are shared by every job they are applied to and
+            must be treated as read-only.
+    """
+
+    digest: str
+    values: Mapping[str, Any]
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> "ScrapeOverrides":
+        """Compile the charm configuration into scrape job overrides.
+
+        Compiled overrides are cached by the digest of the raw configuration, so that
+        repeated calls with an unchanged configuration are cheap.
+
+        Raises:
+            InvalidOverridesError: if any of the configured values is invalid.
+        """
+        digest = config_digest(config)
+        cached = _cache.get(digest)
+        if cached is None:
+            cached = cls(digest=digest, values=MappingProxyType(_compile(config)))
+            _cache.clear()
+            _cache[digest] = cached
+        return cached
+
+    def apply(self, job: dict) -> dict:
+        """Apply the overrides to a scrape job in place and return it."""
+        job.update(self.values)
+        return job
+
+
+def profiles_from_config(config: Mapping[str, Any]) -> Mapping[str, ScrapeOverrides]:
+    """Compile the override profiles of the `profiles` option into scrape job overrides.
+
+    Each profile is layered on top of the global overrides, so a profile only needs to
+    set the values that differ for its consumer. Like the global overrides, compiled
+    profiles are cached by the digest of the raw configuration.
+
+    Returns:
+        A mapping of consumer application names to their scrape job overrides.
+
+    Raises:
+        InvalidOverridesError: if the option or any of the resulting overrides is invalid.
+    """
+    digest = config_digest(config)
+    cached = _profiles_cache.get(digest)
+    if cached is None:
+        base = {key: value for key, value in config.items() if key not in NON_SCRAPE_CONFIG_KEYS}
+        profiles = {}
+        for consumer, profile in _parse_profiles(config.get("profiles")).items():
+            layered = {**base, **profile}
+            try:
+                values = _compile(layered)
+            except InvalidOverridesError as e:
+                raise InvalidOverridesError(f"profiles: {consumer}: {e}") from e
+            profiles[consumer] = ScrapeOverrides(
+                digest=config_digest(layered), values=MappingProxyType(values)
+            )
+        cached = MappingProxyType(profiles)
+        _profiles_cache.clear()
+        _profiles_cache[digest] = cached
+    return cached
+
+
+_cache: Dict[str, ScrapeOverrides] = {}
+_profiles_cache: Dict[str, Mapping[str, ScrapeOverrides]] = {}
+
+
+def _compile(config: Mapping[str, Any]) -> Dict[str, Any]:
+    values: Dict[str, Any] = {}
+    for key, value in config.items():
+        if key in NON_SCRAPE_CONFIG_KEYS or value is None or value == "":
+            continue
+        if key in YAML_KEYS:
+            relabel_configs = _parse_relabel_configs(key, value)
+            if relabel_configs is not None:
+                values[key] = relabel_configs
+        elif key in DURATION_KEYS:
+            try:
+                values[key] = format_duration(parse_duration(str(value).strip()))
+            except ValueError as e:
+                raise InvalidOverridesError(f"{key}: {e}") from e
+        elif key in LIMIT_KEYS:
+            values[key] = _parse_limit(key, value)
+        elif key == "proxy_url":
+            values[key] = _parse_proxy_url(str(value))
+        else:
+            values[key] = value
+
+    interval = values.get("scrape_interval")
+    timeout = values.get("scrape_timeout")
+    if interval and timeout and parse_duration(timeout) > parse_duration(interval):
+        raise InvalidOverridesError(
+            f"scrape_timeout ({timeout}) is greater than scrape_interval ({interval})"
+        )
+
+    return values
+
+
+def _parse_relabel_configs(key: str, value: Any) -> Optional[list]:
+    # Profiles may hold the relabel configs themselves rather than a YAML string
+    parsed = value
+    if isinstance(value, str):
+        try:
+            parsed = yaml.safe_load(value)
+        except yaml.YAMLError as e:
+            raise InvalidOverridesError(f"{key}: invalid YAML") from e
+    if parsed is None:
+        return None
+    if not isinstance(parsed, list) or not all(isinstance(item, dict) for item in parsed):
+        raise InvalidOverridesError(f"{key}: expected a list of relabel configs")
+    # YAML parses some scalars, such as dates, to values that cannot be sent as JSON
+    return json.loads(json.dumps(parsed, default=str))
+
+
+def _parse_profiles(value: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    try:
+        parsed = yaml.safe_load(value or "")
+    except yaml.YAMLError as e:
+        raise InvalidOverridesError("profiles: invalid YAML") from e
+    if parsed is None:
+        return {}
+    if not isinstance(parsed, dict) or not all(
+        isinstance(profile, dict) for profile in parsed.values()
+    ):
+        raise InvalidOverridesError("profiles: expected a mapping of consumers to overrides")
+    for consumer, profile in parsed.items():
+        unknown = sorted(set(profile) - set(PROFILE_KEYS))
+        if unknown:
+            raise InvalidOverridesError(f"profiles: {consumer}: unknown keys {unknown}")
+    return {str(consumer): profile for consumer, profile in parsed.items()}
+
+
+def _parse_limit(key: str, value: Any) -> int:
+    try:
+        limit = int(value)
+    except (TypeError, ValueError) as e:
+        raise InvalidOverridesError(f"{key}: expected an integer") from e
+    if limit < 0:
+        raise InvalidOverridesError(f"{key}: must not be negative")
+    return limit
+
+
+def _parse_proxy_url(value: str) -> str:
+    parsed = urlparse(value.strip())
+    if not parsed.scheme or not parsed.netloc:
+        raise InvalidOverridesError(f"proxy_url: not a valid URL: {value!r}")
+    return parsed.geturl()
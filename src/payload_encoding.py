@@ -0,0 +1,99 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Encodings and layouts of the `scrape_jobs` and `alert_rules` relation payloads.
+
+Metrics consumers advertise the payload encodings they can decode under the
+`supported_encodings` key of their application databag, as a JSON list. This
+charm then writes payloads in these encodings to the consumers that support
+them, and decodes the ones its upstreams write, as the consumer of their jobs:
+
+- `zlib_v1`: the payload is written under the key suffixed with the encoding,
+  e.g. `scrape_jobs_zlib_v1`, as base64 encoded, zlib compressed JSON.
+- `split_v1`: the `scrape_jobs` list is split into content-addressed chunks,
+  e.g. one per upstream application, stored as `scrape_jobs.<digest>` and
+  listed, in order, by the JSON list of digests in `scrape_jobs_manifest`.
+  Unchanged chunks keep their key and value.
+
+Consumers that do not advertise an encoding get the plain JSON payloads.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import zlib
+from typing import Dict, List, Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_ENCODINGS_KEY = "supported_encodings"
+ZLIB_ENCODING = "zlib_v1"
+# Advertised like an encoding, although the chunks are plain JSON
+SPLIT_LAYOUT = "split_v1"
+
+
+def encode_relation_payload(payload: str, encoding: str = ZLIB_ENCODING) -> str:
+    """Encode a JSON payload for the databag key suffixed with the given encoding."""
+    if encoding != ZLIB_ENCODING:
+        raise ValueError("unsupported payload encoding: {}".format(encoding))
+    return base64.b64encode(zlib.compress(payload.encode("utf-8"), 9)).decode("ascii")
+
+
+def decode_relation_payload(databag: Mapping[str, str], key: str) -> Optional[str]:
+    """Read a JSON payload from a databag, decoding it if it was written in an encoded form.
+
+    Args:
+        databag: the relation data of the application that wrote the payload.
+        key: the plain key of the payload, e.g. "scrape_jobs".
+
+    Returns:
+        The JSON payload, or None if there is none or it cannot be decoded.
+    """
+    encoded = databag.get("{}_{}".format(key, ZLIB_ENCODING))
+    if not encoded:
+        return databag.get(key)
+    try:
+        return zlib.decompress(base64.b64decode(encoded)).decode("utf-8")
+    except (ValueError, zlib.error) as e:
+        logger.error("Could not decode %s: %s", key, e)
+        return None
+
+
+def split_relation_payload(key: str, chunks: List[str]) -> Dict[str, str]:
+    """Lay out JSON list chunks as content-addressed databag keys.
+
+    Args:
+        key: the plain key of the payload, e.g. "scrape_jobs".
+        chunks: JSON serialized lists, whose concatenation is the payload.
+
+    Returns:
+        The databag keys and values of the manifest and the chunks.
+    """
+    databag = {}
+    manifest = []
+    for chunk in chunks:
+        digest = hashlib.sha256(chunk.encode("utf-8")).hexdigest()[:16]
+        databag["{}.{}".format(key, digest)] = chunk
+        manifest.append(digest)
+    databag["{}_manifest".format(key)] = json.dumps(manifest)
+    return databag
+
+
+def load_split_relation_payload(databag: Mapping[str, str], key: str) -> Optional[list]:
+    """Read a payload written with `split_relation_payload`.
+
+    Returns:
+        The concatenation of all chunks, or None if the payload is not split.
+    """
+    manifest = databag.get("{}_manifest".format(key))
+    if not manifest:
+        return None
+    items = []
+    for digest in json.loads(manifest):
+        chunk = databag.get("{}.{}".format(key, digest))
+        if chunk is None:
+            logger.error("Missing chunk %s of %s", digest, key)
+            continue
+        items.extend(json.loads(chunk))
+    return items
@@ -0,0 +1,254 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""In-process injection of label matchers into PromQL expressions.
+
+The alert rules of upstream applications are labeled with their Juju topology by
+adding label matchers to every vector selector of their expressions. `cos-tool
+transform` does this with the PromQL parser of Prometheus, at the cost of a
+process per expression. The common shapes of alert expressions are instead
+handled here, by tokenizing them; anything else is left to cos-tool.
+"""
+
+import json
+import re
+from typing import Dict, List, Tuple
+
+
+class UnsupportedPromQLError(Exception):
+    """Raised if an expression cannot be handled by `inject_promql_label_matchers`."""
+
+
+# Keywords followed by a list of label names, e.g. `sum by (job) (...)`
+_PROMQL_GROUPING_KEYWORDS = {"by", "without", "on", "ignoring", "group_left", "group_right"}
+_PROMQL_OPERATOR_KEYWORDS = {"and", "or", "unless", "atan2", "bool", "offset"}
+_PROMQL_AGGREGATORS = {
+    "sum",
+    "avg",
+    "count",
+    "min",
+    "max",
+    "group",
+    "stddev",
+    "stdvar",
+    "topk",
+    "bottomk",
+    "count_values",
+    "quantile",
+    "limitk",
+    "limit_ratio",
+}
+_PROMQL_TOKEN_RE = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<comment>\#[^\n]*)
+    | (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|`[^`]*`)
+    # Numbers, including durations such as 1h30m
+    | (?P<number>(?:0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)[a-zA-Z0-9]*)
+    # Identifiers; a colon followed by a digit is the step of a subquery, as in `[1h:5m]`
+    | (?P<ident>(?:[a-zA-Z_]|:(?!\d))[a-zA-Z0-9_:]*)
+    | (?P<punct>=~|!~|!=|==|>=|<=|[-+*/%^<>=,(){}\[\]@:])
+    """,
+    re.VERBOSE,
+)
+
+
+def _tokenize_promql(expression: str) -> List[Tuple[str, str, int, int]]:
+    """Split a PromQL expression into (kind, text, start, end) tokens, without whitespace."""
+    tokens = []
+    position = 0
+    while position < len(expression):
+        match = _PROMQL_TOKEN_RE.match(expression, position)
+        if not match:
+            raise UnsupportedPromQLError(
+                "unexpected character {!r}".format(expression[position])
+            )
+        kind = match.lastgroup or ""
+        if kind not in ("space", "comment"):
+            tokens.append((kind, match.group(), match.start(), match.end()))
+        position = match.end()
+    return tokens
+
+
+def inject_promql_label_matchers(expression: str, matchers: Dict[str, str]) -> str:
+    """Add label matchers to every vector selector of a PromQL expression.
+
+    This is an in-process alternative to `cos-tool transform` for the common
+    shapes of alert expressions: selectors, aggregations, function calls,
+    binary operations, range vectors and subqueries. The expression is only
+    tokenized, so its formatting is preserved. Any `%%juju_topology%%`
+    placeholder is removed first.
+
+    Args:
+        expression: a PromQL expression.
+        matchers: label names mapped to the values they must equal.
+
+    Returns:
+        The expression with the label matchers added to all vector selectors.
+
+    Raises:
+        UnsupportedPromQLError: if the expression uses constructs that are not
+            supported, or already has matchers for any of the labels.
+    """
+    expression = re.sub(r"%%juju_topology%%,?", "", expression)
+    rendered = ",".join(
+        "{}={}".format(name, json.dumps(value, ensure_ascii=False))
+        for name, value in matchers.items()
+    )
+    insertions = _promql_matcher_insertions(_tokenize_promql(expression), matchers, rendered)
+
+    pieces = []
+    position = 0
+    for insert_at, text in insertions:
+        pieces.extend([expression[position:insert_at], text])
+        position = insert_at
+    pieces.append(expression[position:])
+    return "".join(pieces)
+
+
+def _promql_matcher_insertions(
+    tokens: List[Tuple[str, str, int, int]], matchers: Dict[str, str], rendered: str
+) -> List[Tuple[int, str]]:
+    """Find where the rendered matchers go in the tokens of an expression.
+
+    Returns:
+        The text to insert in the expression, as (position, text) pairs in order.
+    """
+    insertions = []  # type: List[Tuple[int, str]]
+    depth = 0
+
+    i = 0
+    while i < len(tokens):
+        kind, text, _, _ = tokens[i]
+        if kind == "ident":
+            i = _inject_promql_ident(tokens, i, matchers, rendered, insertions)
+            continue
+
+        if text == "{":
+            i = _inject_promql_selector_matchers(
+                tokens, i, matchers, rendered, insertions, named=False
+            )
+            continue
+        if text == "[":
+            i = _skip_promql_range(tokens, i)
+            continue
+
+        if text == "(":
+            depth += 1
+        elif text == ")":
+            depth -= 1
+        elif text in ("}", "]"):
+            raise UnsupportedPromQLError("unexpected {!r}".format(text))
+        if depth < 0:
+            raise UnsupportedPromQLError("unbalanced parentheses")
+        i += 1
+
+    if depth:
+        raise UnsupportedPromQLError("unbalanced parentheses")
+    return insertions
+
+
+def _inject_promql_ident(
+    tokens: List[Tuple[str, str, int, int]],
+    i: int,
+    matchers: Dict[str, str],
+    rendered: str,
+    insertions: List[Tuple[int, str]],
+) -> int:
+    """Handle the identifier at token `i`, adding matchers if it is a metric name.
+
+    Returns:
+        The index of the next token to handle.
+    """
+    _, text, _, end = tokens[i]
+    following = tokens[i + 1][1] if i + 1 < len(tokens) else None
+
+    # Keywords are case-insensitive
+    keyword = text.lower()
+    if keyword in _PROMQL_GROUPING_KEYWORDS:
+        return _skip_promql_label_list(tokens, i + 1) if following == "(" else i + 1
+    if (
+        keyword in _PROMQL_OPERATOR_KEYWORDS
+        or keyword in _PROMQL_AGGREGATORS
+        or keyword in ("inf", "nan")
+        or following == "("  # a function call
+    ):
+        return i + 1
+    if following == "{":
+        return _inject_promql_selector_matchers(
+            tokens, i + 1, matchers, rendered, insertions, named=True
+        )
+    insertions.append((end, "{" + rendered + "}"))
+    return i + 1
+
+
+def _skip_promql_label_list(tokens: List[Tuple[str, str, int, int]], i: int) -> int:
+    """Skip a parenthesized list of label names starting at token `i`."""
+    for j in range(i + 1, len(tokens)):
+        kind, text, _, _ = tokens[j]
+        if text == ")":
+            return j + 1
+        if kind not in ("ident", "string") and text != ",":
+            raise UnsupportedPromQLError("unexpected {!r} in label list".format(text))
+    raise UnsupportedPromQLError("unterminated label list")
+
+
+def _skip_promql_range(tokens: List[Tuple[str, str, int, int]], i: int) -> int:
+    """Skip a range (`[5m]`) or subquery (`[5m:1m]`) starting at token `i`."""
+    for j in range(i + 1, len(tokens)):
+        kind, text, _, _ = tokens[j]
+        if text == "]":
+            return j + 1
+        if kind != "number" and text != ":":
+            raise UnsupportedPromQLError("unexpected {!r} in range".format(text))
+    raise UnsupportedPromQLError("unterminated range")
+
+
+def _inject_promql_selector_matchers(
+    tokens: List[Tuple[str, str, int, int]],
+    i: int,
+    matchers: Dict[str, str],
+    rendered: str,
+    insertions: List[Tuple[int, str]],
+    named: bool,
+) -> int:
+    """Add matchers to the braces of a vector selector starting at token `i`.
+
+    Args:
+        tokens: the tokens of the expression.
+        i: the index of the opening brace.
+        matchers: label names mapped to the values they must equal.
+        rendered: the matchers, rendered as PromQL.
+        insertions: the list to add the (position, text) insertion to.
+        named: whether the selector has a metric name before the braces.
+
+    Returns:
+        The index of the token following the closing brace.
+    """
+    labels = set()
+    j = i + 1
+    while j < len(tokens) and tokens[j][1] != "}":
+        try:
+            (name_kind, name, _, _), (_, op, _, _), (value_kind, _, _, _) = tokens[j : j + 3]
+        except ValueError:
+            raise UnsupportedPromQLError("unterminated selector")
+        if name_kind != "ident" or op not in ("=", "!=", "=~", "!~") or value_kind != "string":
+            raise UnsupportedPromQLError("unsupported label matcher")
+        labels.add(name)
+        j += 3
+        if j < len(tokens) and tokens[j][1] == ",":
+            j += 1
+        elif j < len(tokens) and tokens[j][1] != "}":
+            raise UnsupportedPromQLError("unexpected {!r} in selector".format(tokens[j][1]))
+
+    if j == len(tokens):
+        raise UnsupportedPromQLError("unterminated selector")
+    if not labels and not named:
+        raise UnsupportedPromQLError("empty selector")
+    if labels.intersection(matchers):
+        # Leave it to cos-tool to decide how conflicting matchers are handled
+        raise UnsupportedPromQLError("selector already has matchers for the injected labels")
+
+    separator = "" if tokens[j - 1][1] in ("{", ",") else ","
+    insertions.append((tokens[j][2], separator + rendered))
+    return j + 1
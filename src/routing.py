@@ -0,0 +1,165 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Routing of upstream applications to specific metrics consumers.
+
+The `routes` config option is a YAML mapping of selectors to the names of the
+consumer applications that should receive the matching scrape jobs and alert
+rules, e.g.
+
+    "mysql-*": prometheus-db
+    "juju_model=prod-*,juju_application=*-exporter": [prometheus-a, prometheus-b]
+    "*": prometheus-default
+
+A selector is either a glob matched against the application name, or a
+comma-separated list of `label=glob` pairs matched against the Juju topology
+labels. Routes are evaluated in order and the first matching one wins; upstreams
+that match no route are sent to every consumer.
+"""
+
+import fnmatch
+import re
+from dataclasses import dataclass
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+import yaml
+
+T = TypeVar("T")
+
+_TOPOLOGY_LABELS = ("juju_model", "juju_model_uuid", "juju_application", "juju_charm", "juju_unit")
+
+
+class InvalidRoutesError(Exception):
+    """Raised when the charm configuration does not describe a valid routing table."""
+
+
+@dataclass(frozen=True)
+class Route:
+    """Consumers receiving the jobs and alert rules of the upstreams matching all patterns."""
+
+    patterns: Tuple[Tuple[str, Pattern], ...]
+    consumers: Tuple[str, ...]
+
+    def matches(self, topology: Mapping[str, str]) -> bool:
+        """Check whether the topology labels of an upstream match this route."""
+        return all(pattern.match(topology.get(label, "")) for label, pattern in self.patterns)
+
+
+@dataclass(frozen=True)
+class RoutingTable:
+    """Compiled routes, in the order they are evaluated in."""
+
+    routes: Tuple[Route, ...]
+
+    @classmethod
+    def from_config(cls, value: Optional[str]) -> "RoutingTable":
+        """Compile the `routes` config option, caching the last compiled table.
+
+        Raises:
+            InvalidRoutesError: if the option is not a valid routing table.
+        """
+        value = value or ""
+        cached = _cache.get(value)
+        if cached is None:
+            cached = cls(routes=_compile(value))
+            _cache.clear()
+            _cache[value] = cached
+        return cached
+
+    def __bool__(self) -> bool:
+        """Whether any routes are configured."""
+        return bool(self.routes)
+
+    def consumers_for(
+        self, topology: Mapping[str, str], consumers: Sequence[str]
+    ) -> Tuple[str, ...]:
+        """Pick the related consumers that the upstream with the given topology is routed to.
+
+        Consumers named in the matching route that are not related are skipped.
+        """
+        for route in self.routes:
+            if route.matches(topology):
+                return tuple(consumer for consumer in consumers if consumer in route.consumers)
+        return tuple(consumers)
+
+    def index(
+        self,
+        items: Iterable[T],
+        topology: Callable[[T], Tuple[Tuple[str, str], ...]],
+        consumers: Sequence[str],
+    ) -> Dict[str, List[T]]:
+        """Group items by the consumers they are routed to, in their original order.
+
+        The routes are evaluated once per distinct topology, rather than once per item.
+
+        Args:
+            items: scrape jobs or alert rule groups.
+            topology: a function returning the topology labels of an item, as sorted pairs.
+            consumers: the names of the related consumer applications.
+        """
+        routed = {}  # type: Dict[Tuple[Tuple[str, str], ...], Tuple[str, ...]]
+        indexed = {consumer: [] for consumer in consumers}  # type: Dict[str, List[T]]
+        for item in items:
+            key = topology(item)
+            if key not in routed:
+                routed[key] = self.consumers_for(dict(key), consumers)
+            for consumer in routed[key]:
+                indexed[consumer].append(item)
+        return indexed
+
+
+def topology_labels(labels: Mapping[str, str]) -> Tuple[Tuple[str, str], ...]:
+    """Extract the Juju topology labels routes are matched against, as sorted pairs."""
+    return tuple(sorted((key, labels[key]) for key in _TOPOLOGY_LABELS if key in labels))
+
+
+_cache: Dict[str, RoutingTable] = {}
+
+
+def _compile(value: str) -> Tuple[Route, ...]:
+    try:
+        parsed = yaml.safe_load(value)
+    except yaml.YAMLError as e:
+        raise InvalidRoutesError("routes: invalid YAML") from e
+    if parsed is None:
+        return ()
+    if not isinstance(parsed, dict):
+        raise InvalidRoutesError("routes: expected a mapping of selectors to consumers")
+    return tuple(
+        Route(patterns=_compile_selector(str(selector)), consumers=_parse_consumers(consumers))
+        for selector, consumers in parsed.items()
+    )
+
+
+def _compile_selector(selector: str) -> Tuple[Tuple[str, Pattern], ...]:
+    if "=" not in selector:
+        return (("juju_application", re.compile(fnmatch.translate(selector.strip()))),)
+
+    patterns = []
+    for pair in selector.split(","):
+        label, separator, glob = (part.strip() for part in pair.partition("="))
+        if not separator:
+            raise InvalidRoutesError(f"routes: expected label=glob, got {pair!r} in {selector!r}")
+        if label not in _TOPOLOGY_LABELS:
+            raise InvalidRoutesError(f"routes: unknown topology label {label!r} in {selector!r}")
+        patterns.append((label, re.compile(fnmatch.translate(glob))))
+    return tuple(patterns)
+
+
+def _parse_consumers(consumers) -> Tuple[str, ...]:
+    if isinstance(consumers, str):
+        return (consumers,)
+    if isinstance(consumers, list) and all(isinstance(item, str) for item in consumers):
+        return tuple(consumers)
+    raise InvalidRoutesError(f"routes: expected consumer names, got {consumers!r}")
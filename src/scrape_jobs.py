@@ -0,0 +1,279 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Transformations of the scrape jobs collected from upstream applications.
+
+These complement `PrometheusConfig` of the `prometheus_scrape` library: wildcard
+targets are expanded lazily, job names are deduplicated in linear time, jobs are
+ordered canonically so that payloads do not depend on the order of relations, and
+jobs that only differ in their targets may be consolidated.
+"""
+
+import hashlib
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from charms.prometheus_k8s.v0.prometheus_scrape import PrometheusConfig
+from cosl import JujuTopology
+
+from serialization import canonical_json
+
+# Scrape targets whose host is a wildcard, expanded to the address of every unit
+_WILDCARD_TARGET_RE = re.compile(r"\*(?:(:\d+))?")
+
+
+def prefix_job_name(scrape_config: dict, prefix: str) -> dict:
+    """Return a copy of a scrape job, with the given prefix added to its name."""
+    job_name = scrape_config.get("job_name")
+    modified = scrape_config.copy()
+    modified["job_name"] = prefix + "_" + job_name if job_name else prefix
+    return modified
+
+
+def iter_expanded_wildcard_targets(
+    scrape_jobs: Iterable[dict],
+    hosts: Dict[str, Tuple[str, str]],
+    topology: Optional[JujuTopology] = None,
+) -> Iterator[dict]:
+    """Extract wildcard hosts from scrape jobs into separate jobs, one job at a time.
+
+    A lazy version of `PrometheusConfig.expand_wildcard_targets_into_individual_jobs`:
+    jobs are consumed and the expanded jobs produced one at a time.
+
+    Args:
+        scrape_jobs: scrape jobs, which are only iterated over once.
+        hosts: a dictionary mapping unit names to (address, path) tuples for
+            all units of the relation for which the jobs are expanded.
+        topology: optional arg for adding topology labels to scrape targets.
+    """
+    # Unit-invariant parts are computed once and shared, read-only, by all expanded jobs
+    topology_labels = topology.label_matcher_dict if topology else None
+
+    for job in scrape_jobs:
+        static_configs = job.get("static_configs")
+        if not static_configs:
+            continue
+
+        # When a single unit specified more than one wildcard target, then they are expanded
+        # into a static_config per target
+        non_wildcard_static_configs = []
+
+        metrics_path = job.get("metrics_path") or "/metrics"
+
+        for static_config in static_configs:
+            # All wildcard targets are extracted to a job per unit. If multiple wildcard
+            # targets are specified, they remain in the same static_config (per unit).
+            wildcard_targets = []
+            # All non-wildcard targets remain in the same static_config
+            non_wildcard_targets = []
+            for target in static_config.get("targets") or []:
+                if _WILDCARD_TARGET_RE.match(target):
+                    wildcard_targets.append(target)
+                else:
+                    non_wildcard_targets.append(target)
+
+            if non_wildcard_targets:
+                non_wildcard_static_configs.append(
+                    _non_wildcard_static_config(
+                        static_config, non_wildcard_targets, topology_labels
+                    )
+                )
+            if wildcard_targets:
+                yield from _iter_unit_jobs(
+                    job,
+                    static_config,
+                    wildcard_targets,
+                    hosts,
+                    metrics_path,
+                    topology_labels,
+                )
+
+        if non_wildcard_static_configs:
+            yield _non_wildcard_job(
+                job, non_wildcard_static_configs, metrics_path, topology_labels
+            )
+
+
+def _non_wildcard_static_config(
+    static_config: dict, targets: List[str], topology_labels: Optional[Dict[str, str]]
+) -> dict:
+    """Copy a static config, keeping only its non-wildcard targets."""
+    non_wildcard_static_config = static_config.copy()
+    non_wildcard_static_config["targets"] = targets
+
+    if topology_labels is not None:
+        # When non-wildcard targets (aka fully qualified hostnames) are specified,
+        # there is no reliable way to determine the name (Juju topology unit name)
+        # for such a target. Therefore labeling with Juju topology, excluding the
+        # unit name.
+        non_wildcard_static_config["labels"] = {
+            **topology_labels,
+            **non_wildcard_static_config.get("labels", {}),
+        }
+    return non_wildcard_static_config
+
+
+def _non_wildcard_job(
+    job: dict,
+    static_configs: List[dict],
+    metrics_path: str,
+    topology_labels: Optional[Dict[str, str]],
+) -> dict:
+    """Copy a job, keeping only the static configs of its non-wildcard targets."""
+    modified_job = job.copy()
+    modified_job["static_configs"] = static_configs
+    modified_job["metrics_path"] = metrics_path
+
+    if topology_labels is not None:
+        # Instance relabeling for topology should be last in order.
+        modified_job["relabel_configs"] = modified_job.get("relabel_configs", []) + [
+            PrometheusConfig.topology_relabel_config
+        ]
+    return modified_job
+
+
+def _iter_unit_jobs(
+    job: dict,
+    static_config: dict,
+    wildcard_targets: List[str],
+    hosts: Dict[str, Tuple[str, str]],
+    metrics_path: str,
+    topology_labels: Optional[Dict[str, str]],
+) -> Iterator[dict]:
+    """Produce a job per unit, scraping the wildcard targets of a static config on the unit."""
+    job_template = job
+    if topology_labels is not None:
+        # Instance relabeling for topology should be last in order.
+        job_template = dict(
+            job,
+            relabel_configs=job.get("relabel_configs", [])
+            + [PrometheusConfig.topology_relabel_config_wildcard],
+        )
+    job_name = job.get("job_name", "unnamed-job")
+    static_config_labels = static_config.get("labels", {})
+    # Split each wildcard target around the wildcard, so that only the host needs
+    # to be filled in per unit
+    target_parts = [target.split("*") for target in wildcard_targets]
+
+    for unit_name, (unit_hostname, unit_path) in hosts.items():
+        modified_static_config = static_config.copy()
+        modified_static_config["targets"] = [
+            unit_hostname.join(parts) for parts in target_parts
+        ]
+        if topology_labels is not None:
+            # Add topology labels
+            modified_static_config["labels"] = {
+                **topology_labels,
+                "juju_unit": unit_name,
+                **static_config_labels,
+            }
+
+        modified_job = job_template.copy()
+        modified_job["static_configs"] = [modified_static_config]
+        modified_job["job_name"] = job_name + "-" + unit_name.split("/")[-1]
+        modified_job["metrics_path"] = unit_path + metrics_path
+        yield modified_job
+
+
+def consolidate_jobs(scrape_jobs: List[dict]) -> List[dict]:
+    """Merge scrape jobs that only differ in their names and static configs.
+
+    Jobs with identical settings (e.g. the per-unit jobs created by
+    `iter_expanded_wildcard_targets`) are merged into the
+    first of them, which gets the static configs of all of them. Every
+    static config is labeled with the name of the job it comes from, which
+    Prometheus uses as the `job` label instead of the name of the merged
+    job, so the labels of the scraped series do not change. Relabel configs
+    are part of the settings, so the `instance` relabeling of merged jobs
+    is the same as before.
+
+    Args:
+        scrape_jobs: a list of scrape jobs, which is not modified.
+
+    Returns:
+        The consolidated scrape jobs, in the order of the first job of each group.
+    """
+    consolidated = []  # type: List[dict]
+    merged = {}  # type: Dict[str, dict]
+    for job in scrape_jobs:
+        if not job.get("static_configs"):
+            consolidated.append(job)
+            continue
+
+        settings = {
+            key: value
+            for key, value in job.items()
+            if key not in ("job_name", "static_configs")
+        }
+        signature = canonical_json(settings)
+        static_configs = [
+            dict(
+                static_config,
+                labels={"job": job["job_name"], **static_config.get("labels", {})},
+            )
+            for static_config in job["static_configs"]
+        ]
+        if signature in merged:
+            merged[signature]["static_configs"].extend(static_configs)
+        else:
+            merged[signature] = dict(job, static_configs=static_configs)
+            consolidated.append(merged[signature])
+    return consolidated
+
+
+def dedupe_job_names(jobs: Iterable[dict]) -> List[dict]:
+    """Deduplicate a list of dicts by appending a hash to the value of the 'job_name' key.
+
+    Additionally, fully de-duplicate any identical jobs.
+
+    The jobs are returned in canonical order: sorted by name (and by content, for jobs
+    sharing a name), with the static configs of each job sorted by content and their
+    targets alphabetically. The appended hash is computed from the canonical serialization
+    of the job, so that the result does not depend on the order in which the jobs, their
+    keys or their targets were collected. Jobs are only copied if they are renamed or reordered, so the
+    returned jobs may be the given ones.
+
+    Args:
+        jobs: prometheus scrape jobs, which are only iterated over once
+    """
+    # Group jobs by name, keeping the order in which the names first appear. Jobs of providers
+    # without scrape metadata may have no name, which is left to the validation to reject.
+    jobs_by_name = {}  # type: Dict[str, List[dict]]
+    for job in jobs:
+        jobs_by_name.setdefault(job.get("job_name", ""), []).append(_canonical_job(job))
+
+    deduped_jobs = {}  # type: Dict[str, dict]
+    for name, named_jobs in jobs_by_name.items():
+        for job in named_jobs:
+            key = canonical_json(job)
+            # If multiple jobs have the same name, convert the name to "name_<hash-of-job>"
+            if len(named_jobs) > 1:
+                hashed = hashlib.sha256(key.encode()).hexdigest()
+                job = dict(job, job_name="{}_{}".format(name, hashed))
+                key = canonical_json(job)
+            # Deduplicate jobs which are equal
+            deduped_jobs.setdefault(key, job)
+
+    return [
+        job
+        for _, _, job in sorted(
+            (job.get("job_name", ""), key, job) for key, job in deduped_jobs.items()
+        )
+    ]
+
+
+def _canonical_job(job: dict) -> dict:
+    """Sort the static configs of a job and their targets, copying the job if needed."""
+    static_configs = job.get("static_configs")
+    if not static_configs:
+        return job
+    normalized = [
+        dict(static_config, targets=sorted(static_config["targets"], key=str))
+        if static_config.get("targets")
+        else static_config
+        for static_config in static_configs
+    ]
+    normalized.sort(key=canonical_json)
+    if normalized == static_configs:
+        return job
+    return dict(job, static_configs=normalized)
@@ -0,0 +1,34 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Canonical JSON serialization of relation payloads.
+
+Payloads are serialized so that equal content gives byte-identical JSON, whatever
+the order in which dictionaries were built. Unchanged payloads are then recognized
+by comparing or hashing their serialization, and are not written again.
+"""
+
+import json
+from typing import Any, Iterable, Iterator
+
+
+def canonical_json(obj: Any) -> str:
+    """Serialize an object to compact JSON that only depends on its content, not its key order.
+
+    Used wherever payloads are hashed or published, so that equal payloads are byte-identical.
+    """
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"))
+
+
+def iter_json_array(items: Iterable[Any]) -> Iterator[str]:
+    """Serialize items to a canonical JSON array incrementally, one item at a time.
+
+    The concatenated fragments are identical to `canonical_json(list(items))`, but the
+    items may be produced lazily and discarded as soon as they are serialized.
+    """
+    separator = "["
+    for item in items:
+        yield separator
+        yield canonical_json(item)
+        separator = ","
+    yield "]" if separator == "," else "[]"
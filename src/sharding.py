@@ -0,0 +1,73 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Sharding of scrape targets across several metrics consumers.
+
+Every scrape target is assigned to exactly one shard by rendezvous (highest
+random weight) hashing of the target, its Juju topology and the shard name.
+Unlike `hashmod` relabeling, adding or removing a shard only moves the targets
+that are assigned to, or were assigned to, that shard.
+"""
+
+import copy
+import hashlib
+import json
+from typing import Dict, List, Mapping, Sequence
+
+
+def target_key(target: str, labels: Mapping[str, str]) -> str:
+    """Identify a scrape target by its address and the Juju topology labels of its static config."""
+    topology = {key: value for key, value in labels.items() if key.startswith("juju_")}
+    return json.dumps([target, topology], sort_keys=True)
+
+
+def assign_shard(key: str, shards: Sequence[str]) -> str:
+    """Pick the shard with the highest weight for the given key."""
+    return max(shards, key=lambda shard: _weight(shard, key))
+
+
+def shard_jobs(jobs: List[dict], shards: Sequence[str]) -> Dict[str, List[dict]]:
+    """Split scrape jobs across shards, so that each target is scraped by a single shard.
+
+    The targets of every static config are split, keeping their labels. A job is only
+    sent to the shards that are assigned at least one of its targets; jobs without static
+    configs are assigned to a shard as a whole.
+
+    Args:
+        jobs: the scrape jobs to split.
+        shards: the names of the shards, e.g. the names of the consumer applications.
+
+    Returns:
+        A mapping of each shard name to its scrape jobs, in the original order.
+    """
+    sharded = {shard: [] for shard in shards}  # type: Dict[str, List[dict]]
+    if not shards:
+        return sharded
+
+    for job in jobs:
+        if not job.get("static_configs"):
+            sharded[assign_shard(job.get("job_name", ""), shards)].append(job)
+            continue
+
+        static_configs = {shard: [] for shard in shards}  # type: Dict[str, List[dict]]
+        for static_config in job["static_configs"]:
+            labels = static_config.get("labels", {})
+            targets = {shard: [] for shard in shards}  # type: Dict[str, List[str]]
+            for target in static_config.get("targets", []):
+                targets[assign_shard(target_key(target, labels), shards)].append(target)
+            for shard, shard_targets in targets.items():
+                if shard_targets:
+                    static_configs[shard].append(dict(static_config, targets=shard_targets))
+
+        for shard, shard_static_configs in static_configs.items():
+            if shard_static_configs:
+                shard_job = copy.copy(job)
+                shard_job["static_configs"] = shard_static_configs
+                sharded[shard].append(shard_job)
+
+    return sharded
+
+
+def _weight(shard: str, key: str) -> int:
+    digest = hashlib.sha256(f"{shard}\0{key}".encode()).digest()
+    return int.from_bytes(digest[:8], "big")
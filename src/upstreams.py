@@ -0,0 +1,598 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Collection of the scrape jobs and alert rules of upstream applications.
+
+`UpstreamsConsumer` extends the `MetricsEndpointConsumer` of the `prometheus_scrape`
+library, which processes every upstream relation from scratch in every hook, so that:
+
+- results are memoized per relation, keyed by a digest of its relation data, and
+  only relations whose data changed are processed again;
+- cos-tool runs are cached, batched and run concurrently, see `cos_tool.CosTool`;
+- payloads written in the encodings of `payload_encoding` are decoded;
+- errors reported to upstreams are buffered, see `write_buffer.WriteBuffer`;
+- each `TargetsChangedEvent` carries a `TargetsDiff` of the changes to its relation.
+"""
+
+import copy
+import hashlib
+import itertools
+import json
+import logging
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from charms.prometheus_k8s.v0 import prometheus_scrape
+from cosl import JujuTopology
+from ops.charm import CharmBase
+from ops.framework import EventSource, ObjectEvents, StoredDict, StoredList, StoredState
+from ops.model import Relation
+
+from cos_tool import CosTool, CosToolCache
+from payload_encoding import (
+    SPLIT_LAYOUT,
+    SUPPORTED_ENCODINGS_KEY,
+    ZLIB_ENCODING,
+    decode_relation_payload,
+    load_split_relation_payload,
+)
+from scrape_jobs import dedupe_job_names, iter_expanded_wildcard_targets, prefix_job_name
+from serialization import canonical_json
+from write_buffer import WriteBuffer
+
+logger = logging.getLogger(__name__)
+
+
+def _type_convert_stored(obj: Any) -> Any:
+    """Convert Stored* to their appropriate types, recursively."""
+    if isinstance(obj, StoredList):
+        return [_type_convert_stored(item) for item in obj]
+    if isinstance(obj, StoredDict):
+        return {key: _type_convert_stored(obj[key]) for key in obj.keys()}
+    return obj
+
+
+class TargetsDiff:
+    """Changes to the scrape targets and alert rules of a relation.
+
+    Attributes:
+        added_units: names of the remote units that joined the relation.
+        removed_units: names of the remote units that departed from the relation.
+        changed_units: names of the remote units whose relation data changed.
+        added_jobs: names of the scrape jobs added to the relation.
+        removed_jobs: names of the scrape jobs removed from the relation.
+        changed_jobs: names of the scrape jobs whose configuration changed.
+        alert_rules_changed: whether the alert rules of the relation changed.
+    """
+
+    FIELDS = (
+        "added_units",
+        "removed_units",
+        "changed_units",
+        "added_jobs",
+        "removed_jobs",
+        "changed_jobs",
+    )
+
+    def __init__(
+        self,
+        added_units: Iterable[str] = (),
+        removed_units: Iterable[str] = (),
+        changed_units: Iterable[str] = (),
+        added_jobs: Iterable[str] = (),
+        removed_jobs: Iterable[str] = (),
+        changed_jobs: Iterable[str] = (),
+        alert_rules_changed: bool = False,
+    ):
+        self.added_units = sorted(added_units)
+        self.removed_units = sorted(removed_units)
+        self.changed_units = sorted(changed_units)
+        self.added_jobs = sorted(added_jobs)
+        self.removed_jobs = sorted(removed_jobs)
+        self.changed_jobs = sorted(changed_jobs)
+        self.alert_rules_changed = alert_rules_changed
+
+    @classmethod
+    def between(cls, old: dict, new: dict) -> "TargetsDiff":
+        """Compute the changes between two snapshots of a relation, see `_targets_snapshot`."""
+
+        def changed(before: dict, after: dict) -> List[str]:
+            return [name for name in after.keys() & before.keys() if after[name] != before[name]]
+
+        old_units, new_units = old.get("units", {}), new.get("units", {})
+        old_jobs, new_jobs = old.get("jobs", {}), new.get("jobs", {})
+        return cls(
+            added_units=new_units.keys() - old_units.keys(),
+            removed_units=old_units.keys() - new_units.keys(),
+            changed_units=changed(old_units, new_units),
+            added_jobs=new_jobs.keys() - old_jobs.keys(),
+            removed_jobs=old_jobs.keys() - new_jobs.keys(),
+            changed_jobs=changed(old_jobs, new_jobs),
+            alert_rules_changed=old.get("alert_rules", "") != new.get("alert_rules", ""),
+        )
+
+    def as_dict(self) -> dict:
+        """Represent the changes as a dict, from which `TargetsDiff(**...)` restores them."""
+        data: Dict[str, Any] = {field: getattr(self, field) for field in self.FIELDS}
+        data["alert_rules_changed"] = self.alert_rules_changed
+        return data
+
+    def __bool__(self) -> bool:
+        """Whether anything changed."""
+        return self.alert_rules_changed or any(getattr(self, field) for field in self.FIELDS)
+
+    def __eq__(self, other) -> bool:
+        """Whether both diffs hold the same changes."""
+        return isinstance(other, TargetsDiff) and self.as_dict() == other.as_dict()
+
+    def __repr__(self) -> str:
+        """Represent the changes, omitting empty fields."""
+        return "TargetsDiff({})".format(
+            ", ".join("{}={!r}".format(k, v) for k, v in self.as_dict().items() if v)
+        )
+
+
+class TargetsChangedEvent(prometheus_scrape.TargetsChangedEvent):
+    """Event emitted when Prometheus scrape targets change.
+
+    Attributes:
+        relation_id: id of the relation whose scrape targets changed.
+        diff: a `TargetsDiff` of the changes to the relation since the previous event for
+            it, if the `UpstreamsConsumer` computes diffs, or None.
+    """
+
+    def __init__(self, handle, relation_id, diff: Optional[TargetsDiff] = None):
+        super().__init__(handle, relation_id)
+        self.diff = diff
+
+    def snapshot(self):
+        """Save scrape target relation information."""
+        return {
+            "relation_id": self.relation_id,
+            "diff": self.diff.as_dict() if self.diff is not None else None,
+        }
+
+    def restore(self, snapshot):
+        """Restore scrape target relation information."""
+        self.relation_id = snapshot["relation_id"]
+        diff = snapshot.get("diff")
+        self.diff = TargetsDiff(**diff) if diff is not None else None
+
+
+class UpstreamsEvents(ObjectEvents):
+    """Event descriptor for events raised by `UpstreamsConsumer`."""
+
+    targets_changed = EventSource(TargetsChangedEvent)
+
+
+class UpstreamsConsumer(prometheus_scrape.MetricsEndpointConsumer):
+    """A `MetricsEndpointConsumer` that only processes the upstream relations that changed."""
+
+    on = UpstreamsEvents()  # pyright: ignore
+    _stored = StoredState()
+    # The cos-tool cache is reordered as it is used, so it is kept apart from the memoized
+    # results, which would otherwise be saved again whenever the cache changes
+    _cos_tool_stored = StoredState()
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        relation_name: str = prometheus_scrape.DEFAULT_RELATION_NAME,
+        *,
+        memoize: bool = False,
+        cos_tool_cache_size: int = 0,
+        cos_tool_workers: int = 1,
+        write_buffer: Optional[WriteBuffer] = None,
+        compute_diffs: bool = False,
+    ):
+        """Collect the scrape jobs and alert rules of upstream applications.
+
+        Args:
+            charm: the charm collecting the scrape jobs and alert rules.
+            relation_name: the name of the `prometheus_scrape` relation to upstreams.
+            memoize: a boolean flag indicating if the scrape jobs and alert rules computed
+                for each relation should be persisted across hooks, keyed by a digest of
+                the relation data, so that only relations whose data changed are processed
+                again by `jobs()` and `alerts`.
+            cos_tool_cache_size: maximum number of cos-tool results (validated scrape jobs
+                and alert rules, transformed alert expressions) persisted across hooks. By
+                default, results are only cached for the duration of a hook.
+            cos_tool_workers: maximum number of cos-tool processes run concurrently to validate
+                the scrape jobs and alert rules of independent relations. By default, cos-tool
+                runs are strictly sequential.
+            write_buffer: a `WriteBuffer` collecting the errors reported to upstreams in their
+                relation data, to be flushed by the charm. By default, errors are written as
+                they are found.
+            compute_diffs: a boolean flag indicating if each `TargetsChangedEvent` should
+                carry a `TargetsDiff` of the changes to its relation, computed from digests
+                of the relation persisted across hooks. The scrape jobs of the relation are
+                then collected and validated as the event is emitted.
+        """
+        super().__init__(charm, relation_name)
+        self._memoize = memoize
+        self._write_buffer = write_buffer
+        self._compute_diffs = compute_diffs
+        self._stored.set_default(relation_memo={}, targets_snapshots={})
+        self._cos_tool_stored.set_default(entries={})
+        if cos_tool_cache_size:
+            entries = self._cos_tool_stored.entries  # pyright: ignore
+            cache = CosToolCache(entries, cos_tool_cache_size)
+        else:
+            if self._cos_tool_stored.entries:  # pyright: ignore
+                self._cos_tool_stored.entries = {}
+            cache = CosToolCache()
+        self._tool = CosTool(self._charm, cache, max_workers=cos_tool_workers)
+        # relation_changed and relation_departed are observed by the library
+        events = self._charm.on[relation_name]
+        self.framework.observe(events.relation_created, self._advertise_supported_encodings)
+        self.framework.observe(self._charm.on.leader_elected, self._advertise_supported_encodings)
+        if self._memoize:
+            self.framework.observe(self._charm.on.upgrade_charm, self._on_upgrade_charm)
+
+    @property
+    def cos_tool_cache(self) -> CosToolCache:
+        """The cache of cos-tool results, e.g. to report how many runs it saved."""
+        return self._tool.cache
+
+    def _advertise_supported_encodings(self, _):
+        """Let upstreams know they may send encoded payloads, see `payload_encoding`."""
+        if not self._charm.unit.is_leader():
+            return
+        encodings = json.dumps([ZLIB_ENCODING, SPLIT_LAYOUT])
+        writes = self._write_buffer or WriteBuffer(self._charm.unit)
+        for relation in self._charm.model.relations[self._relation_name]:
+            writes.update(relation, self._charm.app, {SUPPORTED_ENCODINGS_KEY: encodings})
+        if self._write_buffer is None:
+            writes.flush()
+
+    def _on_metrics_provider_relation_changed(self, event):
+        """Let the charm know the scrape targets of an upstream may have changed."""
+        self._emit_targets_changed(event.relation)
+
+    def _on_metrics_provider_relation_departed(self, event):
+        """Let the charm know an upstream unit departed."""
+        self._emit_targets_changed(event.relation)
+
+    def _emit_targets_changed(self, relation: Relation):
+        """Emit a `TargetsChangedEvent` for a relation, with its diff if enabled."""
+        if not self._compute_diffs:
+            self.on.targets_changed.emit(relation_id=relation.id)
+            return
+
+        snapshots = self._stored.targets_snapshots  # pyright: ignore
+        current = {str(r.id) for r in self._charm.model.relations[self._relation_name]}
+        for stale in [rel_id for rel_id in snapshots.keys() if rel_id not in current]:
+            del snapshots[stale]
+
+        snapshot = self._targets_snapshot(relation)
+        old = _type_convert_stored(snapshots.get(str(relation.id), {}))
+        snapshots[str(relation.id)] = snapshot
+        diff = TargetsDiff.between(old, snapshot)
+        self.on.targets_changed.emit(relation_id=relation.id, diff=diff)
+
+    def _targets_snapshot(self, relation: Relation) -> dict:
+        """Digest the relation data of each unit, each scrape job and the alert rules."""
+
+        def digest(obj) -> str:
+            return hashlib.sha256(canonical_json(obj).encode()).hexdigest()
+
+        alert_rules = json.loads(
+            (decode_relation_payload(relation.data[relation.app], "alert_rules") or "{}")
+            if relation.app
+            else "{}"
+        )
+        return {
+            "units": {unit.name: digest(dict(relation.data[unit])) for unit in relation.units},
+            "jobs": {
+                job.get("job_name", ""): digest(job)
+                for job in self._collect_jobs([relation])[relation.id]
+            },
+            "alert_rules": digest(alert_rules) if alert_rules else "",
+        }
+
+    def _set_event_data(self, relation: Relation, key: str, value: Any):
+        """Set a key of the `event` data reported to an upstream, through the buffer."""
+        writes = self._write_buffer or WriteBuffer(self._charm.unit)
+        data = json.loads(writes.get(relation, self._charm.app, "event") or "{}")
+        data[key] = value
+        writes.update(relation, self._charm.app, {"event": json.dumps(data)})
+        if self._write_buffer is None:
+            writes.flush()
+
+    def _on_upgrade_charm(self, _):
+        """Drop memoized results, as they may have been computed by another charm revision."""
+        self._stored.relation_memo = {}
+
+    def jobs(self) -> list:
+        """Fetch the list of scrape jobs, see `iter_jobs`."""
+        return list(self.iter_jobs())
+
+    def iter_jobs(self) -> Iterator[dict]:
+        """Stream the scrape jobs of all relations, in the same order as `jobs`.
+
+        The parsing, prefixing, sanitizing and wildcard expansion stages are chained lazily
+        for each relation, so no intermediate copies of its jobs are materialized. As the jobs
+        of all relations are validated together and deduplicated across relations, they are
+        all collected before the first one is produced, but only references to them are held
+        after that. Callers that serialize the jobs, e.g. with `iter_json_array`, therefore
+        never hold more than the collected jobs and the output.
+        """
+        relations = self._charm.model.relations[self._relation_name]
+        relation_jobs = self._collect_jobs(relations)
+        self._prune_memo(relations)
+
+        yield from dedupe_job_names(
+            itertools.chain.from_iterable(relation_jobs[relation.id] for relation in relations)
+        )
+
+    def relation_jobs(self, relation_id: int) -> list:
+        """Fetch the scrape jobs of a single relation, without touching the other relations.
+
+        The jobs are validated on their own, and their names are only deduplicated within
+        the relation: a job whose name clashes with a job of another relation is renamed
+        by `jobs()`, but not here.
+
+        Returns:
+            The static scrape configurations of the relation, or an empty list if there
+            is no such relation.
+        """
+        for relation in self._charm.model.relations[self._relation_name]:
+            if relation.id == relation_id:
+                return self._collect_jobs([relation])[relation.id]
+        return []
+
+    def _collect_jobs(self, relations: List[Relation]) -> Dict[int, list]:
+        """Fetch the validated scrape jobs of each relation, memoized ones included.
+
+        Returns:
+            A mapping of relation ids to the scrape jobs of the relation, which are
+            deduplicated within the relation.
+        """
+        relation_jobs: Dict[int, list] = {}
+        # Relations whose jobs were not memoized, as (relation, digest, jobs) tuples
+        pending: List[Tuple[Relation, str, list]] = []
+
+        for relation in relations:
+            digest = self._relation_digest(relation)
+            found, jobs = self._memo_get(relation, "jobs", digest)
+            if found:
+                relation_jobs[relation.id] = jobs
+                continue
+
+            # Duplicate job names will cause validate_scrape_jobs to fail.
+            # Therefore we need to dedupe here and after all jobs are collected.
+            static_scrape_jobs = dedupe_job_names(self._iter_static_scrape_config(relation))
+            pending.append((relation, digest, static_scrape_jobs))
+
+        # The jobs of all relations are validated together, invalid relations are singled out
+        errors = self._tool.validate_scrape_jobs_batch([jobs for _, _, jobs in pending])
+        for (relation, digest, jobs), error in zip(pending, errors):
+            if error:
+                if self._charm.unit.is_leader():
+                    self._set_event_data(relation, "scrape_job_errors", error)
+                jobs = []
+            self._memo_set(relation, "jobs", digest, jobs)
+            relation_jobs[relation.id] = jobs
+
+        return relation_jobs
+
+    @property
+    def alerts(self) -> dict:
+        """Fetch alerts for all relations, see `MetricsEndpointConsumer.alerts`.
+
+        Returns:
+            A dictionary mapping the Juju topology identifier of the source charm to
+            its list of alert rule groups.
+        """
+        alerts: Dict[str, dict] = {}
+        relations = self._charm.model.relations[self._relation_name]
+        relation_alerts: Dict[int, Optional[Tuple[str, dict]]] = {}
+        # Relations whose alerts were not memoized, as (relation, digest, alerts) tuples
+        pending: List[Tuple[Relation, str, Optional[Tuple[str, dict]]]] = []
+
+        for relation in relations:
+            digest = self._relation_digest(relation)
+            found, memoized = self._memo_get(relation, "alerts", digest)
+            if found:
+                relation_alerts[relation.id] = memoized
+            else:
+                pending.append((relation, digest, self._relation_alerts(relation)))
+
+        # The alert rules of each relation are validated independently, possibly concurrently
+        results = self._tool.map(
+            lambda item: self._tool.validate_alert_rules(item[1]) if item else (True, ""),
+            [item for _, _, item in pending],
+        )
+        for (relation, digest, item), (_, errmsg) in zip(pending, results):
+            if errmsg:
+                if self._charm.unit.is_leader():
+                    self._set_event_data(relation, "errors", errmsg)
+                item = None
+            # Memoized as a list, which StoredState hands back as a fresh copy
+            self._memo_set(relation, "alerts", digest, list(item) if item else None)
+            relation_alerts[relation.id] = item
+
+        for relation in relations:
+            item = relation_alerts[relation.id]
+            if item:
+                identifier, alert_rules = item
+                alerts[identifier] = alert_rules
+        self._prune_memo(relations)
+
+        return alerts
+
+    def _relation_alerts(self, relation: Relation) -> Optional[Tuple[str, dict]]:
+        """Fetch the alert rules of a single relation, with the topology injected.
+
+        The alert rules are not validated yet, see `alerts`.
+
+        Returns:
+            A tuple of the identifier under which the alert rules are
+            exposed by `alerts` and the alert rules themselves, or None
+            if the relation has no alert rules.
+        """
+        if not relation.units or not relation.app:
+            return None
+
+        alert_rules = json.loads(
+            decode_relation_payload(relation.data[relation.app], "alert_rules") or "{}"
+        )
+        if not alert_rules:
+            return None
+
+        alert_rules = self._inject_alert_expr_labels(alert_rules)
+
+        identifier, topology = self._get_identifier_by_alert_rules(alert_rules)
+        if not topology:
+            try:
+                scrape_metadata = json.loads(relation.data[relation.app]["scrape_metadata"])
+                identifier = JujuTopology.from_dict(scrape_metadata).identifier
+
+            except KeyError as e:
+                logger.debug(
+                    "Relation %s has no 'scrape_metadata': %s",
+                    relation.id,
+                    e,
+                )
+
+        if not identifier:
+            logger.error("Alert rules were found but no usable group or identifier was present.")
+            return None
+
+        # As in the library, the relation is part of the identifier, for upstreams that are
+        # related more than once.
+        identifier = f"{identifier}_{relation.name}_{relation.id}"
+
+        return identifier, alert_rules
+
+    def _memo_get(self, relation: Relation, key: str, digest: str) -> Tuple[bool, Any]:
+        """Look up a memoized per-relation result.
+
+        Args:
+            relation: the relation the result was computed for.
+            key: the name under which the result is memoized for the relation.
+            digest: the current digest of the relation, see `_relation_digest`.
+
+        Returns:
+            A tuple of a boolean indicating whether a result computed from
+            unchanged relation data was found, and the result itself.
+        """
+        if not self._memoize:
+            return False, None
+        stored = self._stored.relation_memo.get(str(relation.id))  # pyright: ignore
+        if stored is None or stored["digest"] != digest or key not in stored:
+            return False, None
+        return True, _type_convert_stored(stored[key])
+
+    def _memo_set(self, relation: Relation, key: str, digest: str, result: Any):
+        """Memoize a per-relation result computed from relation data with the given digest."""
+        if not self._memoize:
+            return
+        memo = self._stored.relation_memo  # pyright: ignore
+        stored = memo.get(str(relation.id))
+        entry: Dict[str, Any] = {"digest": digest}
+        if stored is not None and stored["digest"] == digest:
+            entry.update({k: _type_convert_stored(v) for k, v in stored.items()})
+        entry[key] = copy.deepcopy(result)
+        memo[str(relation.id)] = entry
+
+    def _relation_digest(self, relation: Relation) -> str:
+        """Compute a digest of everything the results for a relation are derived from."""
+        if not self._memoize:
+            return ""
+        inputs = {
+            "app": dict(relation.data[relation.app]) if relation.app else {},
+            "units": {unit.name: dict(relation.data[unit]) for unit in relation.units},
+            # Validation errors are only reported to upstreams by the leader.
+            "leader": self._charm.unit.is_leader(),
+            "cos-tool": str(self._tool.path),
+        }
+        return hashlib.sha256(canonical_json(inputs).encode()).hexdigest()
+
+    def _prune_memo(self, relations: List[Relation]):
+        """Drop memoized results of relations that no longer exist."""
+        if not self._memoize:
+            return
+        memo = self._stored.relation_memo  # pyright: ignore
+        current = {str(relation.id) for relation in relations}
+        for stale in [rel_id for rel_id in memo.keys() if rel_id not in current]:
+            del memo[stale]
+
+    def _inject_alert_expr_labels(self, rules: Dict[str, Any]) -> Dict[str, Any]:
+        """Inject the topology into the expressions of all alert rules, in bulk.
+
+        Args:
+            rules: a dict of alert rules
+        """
+        if "groups" not in rules:
+            return rules
+
+        # All expressions are collected first, so that they can be transformed in bulk
+        labeled_rules: List[dict] = []
+        expressions: List[Tuple[str, Dict[str, str]]] = []
+        for group in rules["groups"]:
+            for rule in group["rules"]:
+                labels = rule.get("labels")
+                if not labels:
+                    continue
+
+                try:
+                    topology = JujuTopology(
+                        # Don't try to safely get required constructor fields. There's already
+                        # a handler for KeyErrors
+                        model_uuid=labels["juju_model_uuid"],
+                        model=labels["juju_model"],
+                        application=labels["juju_application"],
+                        unit=labels.get("juju_unit", ""),
+                        charm_name=labels.get("juju_charm", ""),
+                    )
+                    expression = re.sub(r"%%juju_topology%%,?", "", rule["expr"])
+                except KeyError:
+                    # Some required JujuTopology key is missing. Just move on.
+                    continue
+
+                labeled_rules.append(rule)
+                expressions.append((expression, topology.alert_expression_dict))
+
+        for rule, expression in zip(
+            labeled_rules, self._tool.inject_label_matchers_bulk(expressions)
+        ):
+            rule["expr"] = expression
+
+        return rules
+
+    def _iter_static_scrape_config(self, relation) -> Iterator[dict]:
+        """A lazy version of the library's `_static_scrape_config`, chaining its stages."""
+        if not relation.units:
+            return
+
+        scrape_configs = load_split_relation_payload(relation.data[relation.app], "scrape_jobs")
+        if scrape_configs is None:
+            scrape_configs = json.loads(
+                decode_relation_payload(relation.data[relation.app], "scrape_jobs") or "[]"
+            )
+
+        if not scrape_configs:
+            return
+
+        scrape_metadata = json.loads(relation.data[relation.app].get("scrape_metadata", "{}"))
+
+        if not scrape_metadata:
+            yield from scrape_configs
+            return
+
+        topology = JujuTopology.from_dict(scrape_metadata)
+
+        job_name_prefix = "juju_{}_prometheus_scrape".format(topology.identifier)
+        sanitized = (
+            prometheus_scrape.PrometheusConfig.sanitize_scrape_config(
+                prefix_job_name(job, job_name_prefix)
+            )
+            for job in scrape_configs
+        )
+
+        hosts = self._relation_hosts(relation)
+
+        # For https scrape targets we still do not render a `tls_config` section because certs
+        # are expected to be made available by the charm via the `update-ca-certificates` mechanism.
+        yield from iter_expanded_wildcard_targets(sanitized, hosts, topology)
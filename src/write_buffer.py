@@ -0,0 +1,56 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Buffering of the relation data and status changes made during a hook."""
+
+from typing import Dict, Optional, Tuple, Union
+
+from ops.model import Application, Relation, StatusBase, Unit
+
+Entity = Union[Application, Unit]
+
+
+class WriteBuffer:
+    """Collects relation data and status changes, to apply them together at the end of a hook.
+
+    Every change to a databag is otherwise a `relation-set` hook tool invocation, and every
+    status change a `status-set` one. Buffered changes to the same databag are applied with
+    a single `relation-set` of the keys whose value actually changes, and only the last
+    buffered status is set.
+    """
+
+    def __init__(self, unit: Unit):
+        self._unit = unit
+        # Relations, entities and the changes buffered to their databag, keyed by relation id
+        # and entity name
+        self._databags: Dict[Tuple[int, str], Tuple[Relation, Entity, Dict[str, str]]] = {}
+        self._status: Optional[StatusBase] = None
+
+    def get(self, relation: Relation, entity: Entity, key: str) -> Optional[str]:
+        """Read the value of a databag key, including any buffered change to it."""
+        buffered = self._databags.get((relation.id, entity.name))
+        if buffered and key in buffered[2]:
+            # An empty value deletes the key
+            return buffered[2][key] or None
+        return relation.data[entity].get(key)
+
+    def update(self, relation: Relation, entity: Entity, changes: Dict[str, str]):
+        """Buffer changes to a databag. An empty value deletes the key."""
+        key = (relation.id, entity.name)
+        if key not in self._databags:
+            self._databags[key] = (relation, entity, {})
+        self._databags[key][2].update(changes)
+
+    def set_status(self, status: StatusBase):
+        """Buffer the status of the unit, replacing any status buffered before."""
+        self._status = status
+
+    def flush(self):
+        """Apply the buffered changes, with at most one hook tool invocation per databag."""
+        databags, self._databags = self._databags, {}
+        for relation, entity, changes in databags.values():
+            # Only the keys whose value changes are written, if any
+            relation.data[entity].update(changes)
+        status, self._status = self._status, None
+        if status is not None:
+            self._unit.status = status
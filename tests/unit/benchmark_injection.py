@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Compare the cost of labeling alert expressions in-process and with cos-tool.
+
+Run with `tox -e benchmark`, it is not part of the unit tests. The expressions are
+those the unit tests compare with cos-tool. Without a cos-tool binary in the working
+directory, the cost of starting a process that does nothing is reported instead, as
+a lower bound of a cos-tool run.
+"""
+
+import re
+import subprocess
+import time
+from typing import Callable, List
+
+from helpers import alert_expressions
+
+from cos_tool import CosTool, CosToolCache
+from promql import inject_promql_label_matchers
+
+MATCHERS = {
+    "juju_model": "cos",
+    "juju_model_uuid": "20ce8299-3634-4bef-8bd8-5ace6c8816b4",
+    "juju_application": "app",
+}
+
+
+def per_call(func: Callable[[str], object], expressions: List[str], rounds: int) -> float:
+    """Time calls of a function on every expression, in seconds per call."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for expression in expressions:
+            func(expression)
+    return (time.perf_counter() - start) / (rounds * len(expressions))
+
+
+def main():
+    """Print the cost per expression of both ways to label alert expressions."""
+    expressions = [re.sub(r"%%juju_topology%%,?", "", expr) for expr in alert_expressions()]
+    print("{} alert expressions".format(len(expressions)))
+
+    in_process = per_call(lambda e: inject_promql_label_matchers(e, MATCHERS), expressions, 100)
+    print("in-process: {:8.1f} µs per expression".format(1e6 * in_process))
+
+    tool = CosTool(None)
+    if tool.path:
+        # Results are not cached, so that every expression costs a cos-tool run
+        tool.cache = CosToolCache(max_entries=0)
+        cos_tool = per_call(lambda e: tool._transform(e, MATCHERS), expressions, 3)
+        print("cos-tool:   {:8.1f} µs per expression".format(1e6 * cos_tool))
+    else:
+        spawn = per_call(lambda _: subprocess.run(["true"], check=True), expressions, 3)
+        print("no cos-tool, process spawn: {:8.1f} µs per expression".format(1e6 * spawn))
+
+
+if __name__ == "__main__":
+    main()
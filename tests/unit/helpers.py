@@ -0,0 +1,48 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Stand-ins for cos-tool and alert rule fixtures shared by the unit tests."""
+
+import re
+import subprocess
+from pathlib import Path
+from typing import List
+
+import yaml
+from cosl.rules import generic_alert_groups
+
+ALERT_RULES_PATH = Path(__file__).parent / "prometheus_alert_rules"
+
+
+def fake_validate_config(cmd) -> str:
+    """Stand-in for `cos-tool validate-config` rejecting jobs with "invalid" in their name."""
+    config = yaml.safe_load(Path(cmd[-1]).read_text())
+    if any("invalid" in job["job_name"] for job in config["scrape_configs"]):
+        raise subprocess.CalledProcessError(1, cmd, output=b"invalid scrape config")
+    return ""
+
+
+def fake_transform(cmd) -> str:
+    """Stand-in for `cos-tool transform` that only knows about the `up` and `foo` metrics."""
+    *options, expression = cmd[2:]
+    if "bad" in expression:
+        raise subprocess.CalledProcessError(1, cmd, output=b"parse error")
+    matchers = ",".join(
+        '{}="{}"'.format(*option[len("--label-matcher=") :].split("=", 1)) for option in options
+    )
+    # Like cos-tool, print the expression back without the line breaks
+    return re.sub(
+        r"\b(up|foo)\b(\{)?",
+        lambda m: m.group(1) + "{" + matchers + ("," if m.group(2) else "}"),
+        expression.replace("\n", ""),
+    )
+
+
+def alert_expressions() -> List[str]:
+    """The expressions of all alert rules in the fixtures, and in the generic rules of cosl."""
+    groups = []
+    for path in sorted(ALERT_RULES_PATH.glob("*.rules")):
+        groups.extend(yaml.safe_load(path.read_text())["groups"])
+    groups.extend(generic_alert_groups.application_rules["groups"])
+    groups.extend(generic_alert_groups.aggregator_rules["groups"])
+    return [rule["expr"] for group in groups for rule in group["rules"]]
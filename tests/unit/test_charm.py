@@ -3,15 +3,85 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import contextlib
 import json
+import threading
+import time
 import typing
 import unittest
+from pathlib import Path
+from unittest.mock import PropertyMock, patch
 
 from charms.observability_libs.v0.juju_topology import JujuTopology
+from helpers import fake_validate_config
 from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
 from ops.testing import Harness
 
 from charm import PrometheusScrapeConfigCharm
+from cos_tool import CosTool
+from payload_encoding import (
+    decode_relation_payload,
+    encode_relation_payload,
+    load_split_relation_payload,
+)
+from upstreams import TargetsDiff, UpstreamsConsumer
+from write_buffer import WriteBuffer
+
+
+class DispatchingHarness(Harness[PrometheusScrapeConfigCharm]):
+    """A harness ending a dispatch after each of its methods that emit events.
+
+    At the end of each dispatch ops commits the framework, emitting `pre_commit` and `commit`,
+    which the harness never does. Events emitted through the charm directly are dispatched with
+    `dispatch()`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def dispatch(self):
+        """Handle all events emitted in the block within a single dispatch."""
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+        if not self._depth:
+            self.framework.commit()
+
+    def begin_with_initial_hooks(self):
+        with self.dispatch():
+            super().begin_with_initial_hooks()
+
+    def set_leader(self, *args, **kwargs):
+        with self.dispatch():
+            super().set_leader(*args, **kwargs)
+
+    def update_config(self, *args, **kwargs):
+        with self.dispatch():
+            super().update_config(*args, **kwargs)
+
+    def add_relation(self, *args, **kwargs):
+        with self.dispatch():
+            return super().add_relation(*args, **kwargs)
+
+    def remove_relation(self, *args, **kwargs):
+        with self.dispatch():
+            super().remove_relation(*args, **kwargs)
+
+    def add_relation_unit(self, *args, **kwargs):
+        with self.dispatch():
+            super().add_relation_unit(*args, **kwargs)
+
+    def remove_relation_unit(self, *args, **kwargs):
+        with self.dispatch():
+            super().remove_relation_unit(*args, **kwargs)
+
+    def update_relation_data(self, *args, **kwargs):
+        with self.dispatch():
+            super().update_relation_data(*args, **kwargs)
 
 
 class TestCharm(unittest.TestCase):
@@ -36,11 +106,34 @@ class TestCharm(unittest.TestCase):
             "prometheus_scrape_unit_name": f"{app_name}/0",
         }
 
+    def _relate_upstream(self, app_name: str, job_name: str = "") -> int:
+        """Relate an upstream charm with a single wildcard scrape job and one unit."""
+        job: dict = {"metrics_path": "/metrics", "static_configs": [{"targets": ["*:9500"]}]}
+        if job_name:
+            job["job_name"] = job_name
+
+        rel_id = self.harness.add_relation("configurable-scrape-jobs", app_name)
+        self.harness.add_relation_unit(rel_id, f"{app_name}/0")
+        self.harness.update_relation_data(
+            rel_id,
+            app_name,
+            {
+                "scrape_jobs": json.dumps([job]),
+                "scrape_metadata": self._scrape_metadata(app_name),
+            },
+        )
+        self.harness.update_relation_data(rel_id, f"{app_name}/0", self._unit_data(app_name))
+        return rel_id
+
+    def _begin(self) -> DispatchingHarness:
+        harness = DispatchingHarness(PrometheusScrapeConfigCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin_with_initial_hooks()
+        return harness
+
     def setUp(self):
         """Flake8 forces me to write meaningless docstrings."""
-        self.harness = Harness(PrometheusScrapeConfigCharm)
-        self.addCleanup(self.harness.cleanup)
-        self.harness.begin_with_initial_hooks()
+        self.harness = self._begin()
         self.harness.update_config({"scrape_interval": "1s"})
 
     def test_change_scrape_interval(self):
@@ -241,6 +334,826 @@ class TestCharm(unittest.TestCase):
                     ["whatever.cluster.local:9600"],
                 )
 
+    def test_pipeline_runs_once_for_multiple_downstreams(self):
+        """Ensure the override pipeline is not re-evaluated for every downstream."""
+        self.harness.set_leader(True)
+        self._relate_upstream("cassandra-k8s")
+
+        downstream_rel_ids = [
+            self.harness.add_relation("metrics-endpoint", f"prometheus-k8s-{i}")
+            for i in range(4)
+        ]
+
+        with patch.object(
+            UpstreamsConsumer,
+            "iter_jobs",
+            autospec=True,
+            side_effect=UpstreamsConsumer.iter_jobs,
+        ) as jobs, patch.object(
+            UpstreamsConsumer, "alerts", new_callable=PropertyMock, return_value={}
+        ) as alerts:
+            self.harness.update_config({"scrape_interval": "2s"})
+
+        self.assertEqual(jobs.call_count, 1)
+        self.assertEqual(alerts.call_count, 1)
+        for rel_id in downstream_rel_ids:
+            with self.subTest(rel_id=rel_id):
+                app_data = self.harness.get_relation_data(rel_id, self.harness.model.app.name)
+                scrape_jobs = json.loads(typing.cast(str, app_data["scrape_jobs"]))
+                self.assertEqual(scrape_jobs[0]["scrape_interval"], "2s")
+
+    def test_targets_are_sharded_across_downstreams(self):
+        self.harness.set_leader(True)
+        self.harness.update_config({"shard_targets": True})
+        downstream_rel_ids = [
+            self.harness.add_relation("metrics-endpoint", f"prometheus-k8s-{i}") for i in range(3)
+        ]
+        for i in range(12):
+            self._relate_upstream(f"app-{i}")
+
+        targets = []
+        for rel_id in downstream_rel_ids:
+            app_data = self.harness.get_relation_data(rel_id, self.harness.model.app.name)
+            scrape_jobs = json.loads(typing.cast(str, app_data["scrape_jobs"]))
+            targets.append(
+                {
+                    (job["job_name"], target)
+                    for job in scrape_jobs
+                    for static_config in job["static_configs"]
+                    for target in static_config["targets"]
+                }
+            )
+
+        # Every upstream has a single target, which is scraped by exactly one downstream
+        self.assertEqual(sum(len(shard) for shard in targets), 12)
+        self.assertEqual(len(set().union(*targets)), 12)
+
+    def test_alert_rules_follow_the_sharded_targets(self):
+        self.harness.set_leader(True)
+        self.harness.update_config({"shard_targets": True})
+        downstream_rel_ids = [
+            self.harness.add_relation("metrics-endpoint", f"prometheus-k8s-{i}") for i in range(2)
+        ]
+        upstream_rel_id = self._relate_upstream("cassandra-k8s")
+        topology = json.loads(self._scrape_metadata("cassandra-k8s"))
+        labels = {key: topology[key] for key in ("model", "model_uuid", "application")}
+        alert_rules = {
+            "groups": [
+                {
+                    "name": "cassandra_absent",
+                    "rules": [
+                        {
+                            "alert": "CassandraTargetMissing",
+                            "expr": "absent(up)",
+                            "labels": {f"juju_{key}": value for key, value in labels.items()},
+                        }
+                    ],
+                }
+            ]
+        }
+        self.harness.update_relation_data(
+            upstream_rel_id, "cassandra-k8s", {"alert_rules": json.dumps(alert_rules)}
+        )
+
+        app_name = self.harness.model.app.name
+        scraping, other = sorted(
+            downstream_rel_ids,
+            key=lambda rel_id: not self.harness.get_relation_data(rel_id, app_name).get(
+                "scrape_jobs", "[]"
+            ).startswith("[{"),
+        )
+        # The absent rule would fire on the shard that does not scrape the upstream
+        scraping_data = self.harness.get_relation_data(scraping, app_name)
+        scraping_rules = json.loads(scraping_data["alert_rules"])
+        self.assertEqual(
+            [group["name"] for group in scraping_rules["groups"]], ["cassandra_absent"]
+        )
+        self.assertEqual(
+            json.loads(self.harness.get_relation_data(other, app_name)["alert_rules"]), {}
+        )
+
+    def test_upstreams_are_routed_to_their_downstreams(self):
+        self.harness.set_leader(True)
+        self.harness.update_config({"routes": '"mysql-*": prometheus-db'})
+        db_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-db")
+        default_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-default")
+        self._relate_upstream("mysql-k8s")
+        self._relate_upstream("cassandra-k8s")
+
+        def scrape_jobs(rel_id):
+            app_data = self.harness.get_relation_data(rel_id, self.harness.model.app.name)
+            return json.loads(typing.cast(str, app_data["scrape_jobs"]))
+
+        applications = {
+            rel_id: sorted(
+                job["static_configs"][0]["labels"]["juju_application"]
+                for job in scrape_jobs(rel_id)
+            )
+            for rel_id in (db_rel_id, default_rel_id)
+        }
+        self.assertEqual(applications[db_rel_id], ["cassandra-k8s", "mysql-k8s"])
+        self.assertEqual(applications[default_rel_id], ["cassandra-k8s"])
+
+    def test_profiles_override_the_jobs_of_their_downstream(self):
+        self.harness.set_leader(True)
+        self.harness.update_config({"profiles": "prometheus-long-term: {scrape_interval: 2m}"})
+        short_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-short-term")
+        long_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-long-term")
+
+        with patch.object(
+            UpstreamsConsumer,
+            "iter_jobs",
+            autospec=True,
+            side_effect=UpstreamsConsumer.iter_jobs,
+        ) as jobs, patch.object(
+            PrometheusScrapeConfigCharm,
+            "_update_metrics_consumer_relation",
+            autospec=True,
+            side_effect=PrometheusScrapeConfigCharm._update_metrics_consumer_relation,
+        ) as update:
+            self._relate_upstream("cassandra-k8s")
+
+        def scrape_intervals(rel_id):
+            app_data = self.harness.get_relation_data(rel_id, self.harness.model.app.name)
+            return [job["scrape_interval"] for job in json.loads(app_data["scrape_jobs"])]
+
+        self.assertEqual(scrape_intervals(short_rel_id), ["1s"])
+        self.assertEqual(scrape_intervals(long_rel_id), ["2m"])
+        # The jobs were collected once per update, not once per downstream
+        self.assertTrue(jobs.called)
+        self.assertEqual(update.call_count, 2 * jobs.call_count)
+
+    def test_identical_jobs_are_consolidated(self):
+        self.harness.set_leader(True)
+        self.harness.update_config({"consolidate_jobs": True})
+        downstream_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        upstream_rel_id = self._relate_upstream("cassandra-k8s")
+        for i in range(1, 3):
+            self.harness.add_relation_unit(upstream_rel_id, f"cassandra-k8s/{i}")
+            self.harness.update_relation_data(
+                upstream_rel_id,
+                f"cassandra-k8s/{i}",
+                {
+                    "prometheus_scrape_unit_address": f"cassandra-{i}.cluster.local",
+                    "prometheus_scrape_unit_name": f"cassandra-k8s/{i}",
+                },
+            )
+
+        app_data = self.harness.get_relation_data(downstream_rel_id, self.harness.model.app.name)
+        scrape_jobs = json.loads(typing.cast(str, app_data["scrape_jobs"]))
+        self.assertEqual(len(scrape_jobs), 1)
+        self.assertEqual(len(scrape_jobs[0]["static_configs"]), 3)
+        self.assertEqual(scrape_jobs[0]["scrape_interval"], "1s")
+
+    def test_payloads_are_compressed_for_downstreams_supporting_it(self):
+        self.harness.set_leader(True)
+        self.harness.update_config({"compress_payloads": True})
+        new_rel_id = self.harness.add_relation(
+            "metrics-endpoint",
+            "prometheus-new",
+            app_data={"supported_encodings": json.dumps(["zlib_v1"])},
+        )
+        old_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-old")
+        self._relate_upstream("cassandra-k8s")
+
+        app_name = self.harness.model.app.name
+        new_data = self.harness.get_relation_data(new_rel_id, app_name)
+        old_data = self.harness.get_relation_data(old_rel_id, app_name)
+        self.assertNotIn("scrape_jobs", new_data)
+        self.assertNotIn("scrape_jobs_zlib_v1", old_data)
+        self.assertEqual(
+            decode_relation_payload(new_data, "scrape_jobs"),
+            decode_relation_payload(old_data, "scrape_jobs"),
+        )
+
+        # Switching compression off sends plain payloads again
+        self.harness.update_config({"compress_payloads": False})
+        new_data = self.harness.get_relation_data(new_rel_id, app_name)
+        self.assertNotIn("scrape_jobs_zlib_v1", new_data)
+        self.assertEqual(new_data["scrape_jobs"], old_data["scrape_jobs"])
+
+    def test_scrape_jobs_are_split_per_upstream(self):
+        self.harness.set_leader(True)
+        self.harness.update_config({"split_scrape_jobs": True})
+        downstream_rel_id = self.harness.add_relation(
+            "metrics-endpoint",
+            "prometheus-k8s",
+            app_data={"supported_encodings": json.dumps(["split_v1"])},
+        )
+        self._relate_upstream("cassandra-k8s")
+        app_data = self.harness.get_relation_data(downstream_rel_id, self.harness.model.app.name)
+        before = dict(app_data)
+
+        upstream_rel_id = self._relate_upstream("mysql-k8s")
+        after = dict(app_data)
+
+        self.assertNotIn("scrape_jobs", after)
+        changed = {key for key in after if before.get(key) != after[key]}
+        self.assertEqual(len(changed), 2)
+        self.assertIn("scrape_jobs_manifest", changed)
+        jobs = load_split_relation_payload(after, "scrape_jobs") or []
+        self.assertEqual(len(jobs), 2)
+
+        # The chunk of a removed upstream is removed as well
+        self.harness.remove_relation(upstream_rel_id)
+        self.assertEqual(dict(app_data), before)
+
+    def test_scrape_jobs_of_all_upstream_units_share_a_chunk(self):
+        self.harness.set_leader(True)
+        self.harness.update_config({"split_scrape_jobs": True})
+        downstream_rel_id = self.harness.add_relation(
+            "metrics-endpoint",
+            "prometheus-k8s",
+            app_data={"supported_encodings": json.dumps(["split_v1"])},
+        )
+        upstream_rel_id = self._relate_upstream("cassandra-k8s")
+        for unit in range(1, 4):
+            unit_name = f"cassandra-k8s/{unit}"
+            self.harness.add_relation_unit(upstream_rel_id, unit_name)
+            self.harness.update_relation_data(
+                upstream_rel_id,
+                unit_name,
+                {
+                    "prometheus_scrape_unit_address": f"cassandra-{unit}.cluster.local",
+                    "prometheus_scrape_unit_name": unit_name,
+                },
+            )
+        self._relate_upstream("mysql-k8s")
+
+        app_data = self.harness.get_relation_data(downstream_rel_id, self.harness.model.app.name)
+        chunk_keys = {key for key in app_data if key.startswith("scrape_jobs.")}
+        self.assertEqual(len(chunk_keys), 2)
+        self.assertEqual(len(load_split_relation_payload(app_data, "scrape_jobs") or []), 5)
+
+    def test_compressed_upstream_payloads_are_decoded(self):
+        self.harness.set_leader(True)
+        self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        upstream_rel_id = self.harness.add_relation("configurable-scrape-jobs", "cassandra-k8s")
+        self.harness.add_relation_unit(upstream_rel_id, "cassandra-k8s/0")
+
+        # The consumer advertises that it supports compressed payloads
+        app_data = self.harness.get_relation_data(upstream_rel_id, self.harness.model.app.name)
+        self.assertEqual(json.loads(app_data["supported_encodings"]), ["zlib_v1", "split_v1"])
+
+        job = {"job_name": "compressed", "static_configs": [{"targets": ["*:9500"]}]}
+        self.harness.update_relation_data(
+            upstream_rel_id,
+            "cassandra-k8s",
+            {
+                "scrape_jobs_zlib_v1": encode_relation_payload(json.dumps([job])),
+                "scrape_metadata": self._scrape_metadata("cassandra-k8s"),
+            },
+        )
+        self.harness.update_relation_data(
+            upstream_rel_id, "cassandra-k8s/0", self._unit_data("cassandra-k8s")
+        )
+
+        jobs = self.harness.charm._metrics_providers.jobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertIn("compressed", jobs[0]["job_name"])
+
+    def test_unchanged_payload_is_not_rewritten(self):
+        """Ensure hooks that do not change the rendered payload do not write relation data."""
+        self.harness.set_leader(True)
+        self._relate_upstream("cassandra-k8s")
+        downstream_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+
+        with patch.object(
+            self.harness._backend,
+            "update_relation_data",
+            wraps=self.harness._backend.update_relation_data,
+        ) as relation_set:
+            self.harness.update_config({"scrape_interval": "1s"})
+            with self.harness.dispatch():
+                self.harness.charm.on.upgrade_charm.emit()
+
+        relation_set.assert_not_called()
+
+        # A semantically identical payload with different formatting is not rewritten either
+        app_name = self.harness.model.app.name
+        scrape_jobs = self.harness.get_relation_data(downstream_rel_id, app_name)["scrape_jobs"]
+        reformatted = json.dumps(json.loads(scrape_jobs), indent=2, sort_keys=True)
+        self.harness.update_relation_data(
+            downstream_rel_id, app_name, {"scrape_jobs": reformatted}
+        )
+
+        with patch.object(
+            self.harness._backend,
+            "update_relation_data",
+            wraps=self.harness._backend.update_relation_data,
+        ) as relation_set:
+            with self.harness.dispatch():
+                self.harness.charm.on.config_changed.emit()
+
+        relation_set.assert_not_called()
+
+        # A change in the payload is still written
+        self.harness.update_config({"scrape_interval": "5s"})
+        scrape_jobs = self.harness.get_relation_data(downstream_rel_id, app_name)["scrape_jobs"]
+        self.assertEqual(json.loads(scrape_jobs)[0]["scrape_interval"], "5s")
+
+    def test_payload_does_not_depend_on_relation_order(self):
+        """Ensure the same upstreams produce the same bytes, whatever order they are related in."""
+        apps = ["cassandra-k8s", "kafka-k8s", "zookeeper-k8s"]
+        payloads = set()
+        for order in [apps, apps[::-1], apps[1:] + apps[:1]]:
+            self.harness = self._begin()
+            self.harness.set_leader(True)
+            for app_name in order:
+                # The same job name in every upstream, so that the names are deduplicated
+                self._relate_upstream(app_name, job_name="metrics")
+            downstream_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+            app_data = self.harness.get_relation_data(downstream_rel_id, self.harness.model.app)
+            payloads.add(app_data["scrape_jobs"])
+
+        self.assertEqual(len(payloads), 1)
+        self.assertEqual(len(json.loads(payloads.pop())), len(apps))
+
+    def test_relation_data_is_prefetched_concurrently(self):
+        """Ensure relation databags are loaded up front, by worker threads, once each."""
+        self.harness.set_leader(True)
+        self._relate_upstream("cassandra-k8s")
+        self._relate_upstream("kafka-k8s")
+        self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        # Start from relations whose databags were not loaded yet, as in a new hook
+        for relation_name in ["configurable-scrape-jobs", "metrics-endpoint"]:
+            self.harness.model.relations._invalidate(relation_name)
+
+        relation_get = self.harness._backend.relation_get
+        loaded = []
+
+        def record_relation_get(relation_id, member_name, is_app):
+            loaded.append((threading.current_thread(), relation_id, member_name))
+            return relation_get(relation_id, member_name, is_app)
+
+        with patch.object(self.harness._backend, "relation_get", side_effect=record_relation_get):
+            with self.harness.dispatch():
+                self.harness.charm.on.upgrade_charm.emit()
+
+        # The databags of both upstream applications and units, and of this application
+        # and the downstream application
+        self.assertEqual(len(loaded), 6)
+        self.assertEqual(len({(rel_id, name) for _, rel_id, name in loaded}), 6)
+        self.assertNotIn(threading.main_thread(), {thread for thread, _, _ in loaded})
+
+    def test_writes_are_combined(self):
+        """Ensure each databag is written once per hook, with all its changes, and the status once."""
+        self.harness.set_leader(True)
+        backend = self.harness._backend
+        with patch.object(
+            CosTool, "path", new_callable=PropertyMock, return_value=Path("cos-tool-amd64")
+        ), patch.object(CosTool, "_exec", side_effect=fake_validate_config):
+            self._relate_upstream("cassandra-k8s")
+            invalid_rel_id = self._relate_upstream("broken")
+            invalid_job = {"job_name": "invalid", "static_configs": [{"targets": ["*:9500"]}]}
+
+            with patch.object(
+                backend, "update_relation_data", wraps=backend.update_relation_data
+            ) as relation_set, patch.object(
+                backend, "status_set", wraps=backend.status_set
+            ) as status_set:
+                with self.harness.dispatch():
+                    self.harness.update_relation_data(
+                        invalid_rel_id, "broken", {"scrape_jobs": json.dumps([invalid_job])}
+                    )
+                    downstream_rel_id = self.harness.add_relation(
+                        "metrics-endpoint", "prometheus-k8s"
+                    )
+
+        # The errors reported to the invalid upstream are buffered as well
+        self.assertCountEqual(
+            [
+                (call.kwargs["relation_id"], sorted(call.kwargs["data"]))
+                for call in relation_set.call_args_list
+                if call.kwargs["entity"] == self.harness.model.app
+            ],
+            [(invalid_rel_id, ["event"]), (downstream_rel_id, ["alert_rules", "scrape_jobs"])],
+        )
+        self.assertEqual(status_set.call_count, 1)
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+        app_name = self.harness.model.app.name
+        event = json.loads(self.harness.get_relation_data(invalid_rel_id, app_name)["event"])
+        self.assertIn("scrape_job_errors", event)
+
+    def test_supported_encodings_are_advertised_through_the_buffer(self):
+        """Ensure the encodings advertised to upstreams are written at the end of the dispatch."""
+        upstream_rel_id = self.harness.add_relation("configurable-scrape-jobs", "cassandra-k8s")
+        app_name = self.harness.model.app.name
+
+        with self.harness.dispatch():
+            self.harness.set_leader(True)
+            app_data = self.harness.get_relation_data(upstream_rel_id, app_name)
+            self.assertNotIn("supported_encodings", app_data)
+
+        app_data = self.harness.get_relation_data(upstream_rel_id, app_name)
+        self.assertEqual(json.loads(app_data["supported_encodings"]), ["zlib_v1", "split_v1"])
+
+    def test_write_buffer(self):
+        """Ensure buffered changes are readable, combined and applied once flushed."""
+        self.harness.set_leader(True)
+        rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        relation = self.harness.model.get_relation("metrics-endpoint", rel_id)
+        assert relation
+        app = self.harness.model.app
+        self.harness.update_relation_data(rel_id, app.name, {"a": "1", "b": "2"})
+
+        backend = self.harness._backend
+        writes = WriteBuffer(self.harness.model.unit)
+        with patch.object(
+            backend, "update_relation_data", wraps=backend.update_relation_data
+        ) as relation_set, patch.object(backend, "status_set", wraps=backend.status_set) as status_set:
+            writes.update(relation, app, {"a": "3", "b": "2"})
+            writes.update(relation, app, {"c": "4"})
+            writes.update(relation, app, {"c": ""})
+            writes.set_status(WaitingStatus("first"))
+            writes.set_status(ActiveStatus())
+
+            self.assertEqual(writes.get(relation, app, "a"), "3")
+            self.assertIsNone(writes.get(relation, app, "c"))
+            relation_set.assert_not_called()
+            status_set.assert_not_called()
+
+            writes.flush()
+            writes.flush()
+
+        # Unchanged keys are not written
+        relation_set.assert_called_once()
+        self.assertEqual(relation_set.call_args.kwargs["data"], {"a": "3"})
+        status_set.assert_called_once()
+        self.assertEqual(self.harness.get_relation_data(rel_id, app.name), {"a": "3", "b": "2"})
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_hook_tools_are_reported_on_commit(self):
+        """Ensure a summary of the hook tools and cos-tool cache is logged after each hook."""
+        with patch("charm.logger") as logger:
+            self.harness.framework.on.commit.emit()
+
+        logger.debug.assert_called_once_with(
+            "Hook tools: %s; cos-tool cache: %s",
+            self.harness.charm._hook_tools.summary(),
+            "0 hits, 0 misses, 0 entries",
+        )
+
+    def test_created_upstream_relation_is_not_reconciled(self):
+        """Ensure an upstream relation, which carries no data when created, costs nothing."""
+        self.harness.set_leader(True)
+        self._relate_upstream("cassandra-k8s")
+        self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+
+        with patch.object(
+            PrometheusScrapeConfigCharm, "_update_metrics_consumers"
+        ) as update_metrics_consumers:
+            self.harness.add_relation("configurable-scrape-jobs", "kafka-k8s")
+
+        update_metrics_consumers.assert_not_called()
+
+    def test_dirty_inputs_are_reconciled_once_per_dispatch(self):
+        """Ensure events only mark their inputs dirty, and consumers are updated once."""
+        self.harness.set_leader(True)
+
+        with patch.object(
+            PrometheusScrapeConfigCharm,
+            "_update_metrics_consumers",
+            autospec=True,
+            side_effect=PrometheusScrapeConfigCharm._update_metrics_consumers,
+        ) as update_metrics_consumers:
+            with self.harness.dispatch():
+                upstream_rel_id = self._relate_upstream("cassandra-k8s")
+                downstream_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+                self.harness.update_config({"scrape_interval": "2s"})
+                update_metrics_consumers.assert_not_called()
+
+        update_metrics_consumers.assert_called_once()
+        dirty = update_metrics_consumers.call_args.args[1]
+        self.assertTrue(dirty.config)
+        self.assertEqual(dirty.upstreams, {upstream_rel_id})
+        self.assertEqual(dirty.consumers, {downstream_rel_id})
+        app_data = self.harness.get_relation_data(downstream_rel_id, self.harness.model.app.name)
+        scrape_jobs = json.loads(typing.cast(str, app_data["scrape_jobs"]))
+        self.assertEqual(scrape_jobs[0]["scrape_interval"], "2s")
+
+    def test_only_dirty_consumers_are_updated(self):
+        """Ensure a change on one metrics consumer relation does not update the others."""
+        self.harness.set_leader(True)
+        self._relate_upstream("cassandra-k8s")
+        downstream_rel_ids = [
+            self.harness.add_relation("metrics-endpoint", f"prometheus-k8s-{i}")
+            for i in range(3)
+        ]
+
+        with patch.object(
+            PrometheusScrapeConfigCharm,
+            "_update_metrics_consumer_relation",
+            autospec=True,
+            side_effect=PrometheusScrapeConfigCharm._update_metrics_consumer_relation,
+        ) as update_relation:
+            self.harness.update_relation_data(
+                downstream_rel_ids[1], "prometheus-k8s-1", {"supported_encodings": "[]"}
+            )
+
+        update_relation.assert_called_once()
+        self.assertEqual(update_relation.call_args.args[1].id, downstream_rel_ids[1])
+
+    def test_updates_within_min_publish_interval_are_deferred(self):
+        """Ensure payloads are updated at most once per interval, and eventually converge."""
+        self.harness.set_leader(True)
+        upstream_rel_id = self._relate_upstream("cassandra-k8s")
+        downstream_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+
+        def scrape_job():
+            app_data = self.harness.get_relation_data(downstream_rel_id, self.harness.model.app)
+            return json.loads(app_data["scrape_jobs"])[0]
+
+        def targets():
+            return scrape_job()["static_configs"][0]["targets"]
+
+        # Well after the payloads were first published
+        now = time.time() + 3600
+        with patch("charm.time.time", return_value=now) as clock:
+            self.harness.update_config({"min_publish_interval": 60, "scrape_interval": "2s"})
+            self.assertEqual(scrape_job()["scrape_interval"], "2s")
+
+            clock.return_value = now + 10
+            for i in range(3):
+                self.harness.update_relation_data(
+                    upstream_rel_id,
+                    "cassandra-k8s/0",
+                    {"prometheus_scrape_unit_address": f"restarted-{i}.cluster.local"},
+                )
+            self.assertEqual(targets(), ["whatever.cluster.local:9500"])
+            self.assertTrue(self.harness.charm._stored.publish_pending)
+
+            clock.return_value = now + 59
+            with self.harness.dispatch():
+                self.harness.charm.on.update_status.emit()
+            self.assertEqual(targets(), ["whatever.cluster.local:9500"])
+
+            clock.return_value = now + 61
+            with self.harness.dispatch():
+                self.harness.charm.on.update_status.emit()
+            self.assertEqual(targets(), ["restarted-2.cluster.local:9500"])
+            self.assertFalse(self.harness.charm._stored.publish_pending)
+            self.assertEqual(self.harness.charm._stored.last_publish, now + 61)
+
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_deferred_updates_survive_leadership_changes(self):
+        """Ensure an update deferred by a former leader is made by the next one."""
+        self.harness.set_leader(True)
+        upstream_rel_id = self._relate_upstream("cassandra-k8s")
+        downstream_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+
+        def targets():
+            app_data = self.harness.get_relation_data(downstream_rel_id, self.harness.model.app)
+            return json.loads(app_data["scrape_jobs"])[0]["static_configs"][0]["targets"]
+
+        now = time.time() + 3600
+        with patch("charm.time.time", return_value=now) as clock:
+            self.harness.update_config({"min_publish_interval": 60, "scrape_interval": "2s"})
+
+            clock.return_value = now + 10
+            self.harness.update_relation_data(
+                upstream_rel_id,
+                "cassandra-k8s/0",
+                {"prometheus_scrape_unit_address": "restarted.cluster.local"},
+            )
+            self.assertTrue(self.harness.charm._stored.publish_pending)
+
+            # The deferred update is only recorded in the stored state of the former leader,
+            # the next one starts from its own
+            self.harness.set_leader(False)
+            self.harness.charm._stored.publish_pending = False
+
+            # Within the interval since its own last update, the new leader defers it too
+            clock.return_value = now + 20
+            self.harness.set_leader(True)
+            self.assertEqual(targets(), ["whatever.cluster.local:9500"])
+            self.assertTrue(self.harness.charm._stored.publish_pending)
+
+            clock.return_value = now + 61
+            with self.harness.dispatch():
+                self.harness.charm.on.update_status.emit()
+            self.assertEqual(targets(), ["restarted.cluster.local:9500"])
+
+            # A leader that never updated the metrics consumers does so as soon as it is elected
+            clock.return_value = now + 70
+            self.harness.set_leader(False)
+            self.harness.update_relation_data(
+                upstream_rel_id,
+                "cassandra-k8s/0",
+                {"prometheus_scrape_unit_address": "moved.cluster.local"},
+            )
+            self.harness.charm._stored.last_publish = 0.0
+            self.harness.set_leader(True)
+            self.assertEqual(targets(), ["moved.cluster.local:9500"])
+
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_targets_changed_events_carry_a_diff(self):
+        """Ensure each upstream change is described by a diff of its relation."""
+        self.harness.set_leader(True)
+        rel_id = self._relate_upstream("cassandra-k8s")
+        job_prefix = "juju_model_20ce8299_cassandra-k8s_prometheus_scrape"
+        diffs = []
+
+        with patch.object(
+            PrometheusScrapeConfigCharm,
+            "_on_targets_changed",
+            autospec=True,
+            side_effect=lambda _, event: diffs.append((event.relation_id, event.diff)),
+        ):
+            self.harness.add_relation_unit(rel_id, "cassandra-k8s/1")
+            self.harness.update_relation_data(
+                rel_id,
+                "cassandra-k8s/1",
+                {
+                    "prometheus_scrape_unit_address": "other.cluster.local",
+                    "prometheus_scrape_unit_name": "cassandra-k8s/1",
+                },
+            )
+            self.harness.update_relation_data(
+                rel_id, "cassandra-k8s", {"alert_rules": json.dumps({"groups": []})}
+            )
+            self.harness.remove_relation_unit(rel_id, "cassandra-k8s/0")
+
+        self.assertEqual(
+            diffs,
+            [
+                (
+                    rel_id,
+                    TargetsDiff(added_units=["cassandra-k8s/1"], added_jobs=[f"{job_prefix}-1"]),
+                ),
+                (rel_id, TargetsDiff(alert_rules_changed=True)),
+                (
+                    rel_id,
+                    TargetsDiff(
+                        removed_units=["cassandra-k8s/0"], removed_jobs=[f"{job_prefix}-0"]
+                    ),
+                ),
+            ],
+        )
+        jobs = self.harness.charm._metrics_providers.relation_jobs(rel_id)
+        self.assertEqual([job["job_name"] for job in jobs], [f"{job_prefix}-1"])
+
+    def test_unchanged_targets_are_not_reconciled(self):
+        """Ensure upstream changes that do not affect scrape jobs or alert rules are ignored."""
+        self.harness.set_leader(True)
+        rel_id = self._relate_upstream("cassandra-k8s")
+        self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+
+        with patch.object(
+            PrometheusScrapeConfigCharm, "_update_metrics_consumers"
+        ) as update_metrics_consumers:
+            self.harness.update_relation_data(rel_id, "cassandra-k8s", {"unrelated": "value"})
+
+        update_metrics_consumers.assert_not_called()
+
+    def test_errors_are_reported_when_targets_are_unchanged(self):
+        """Ensure errors buffered while handling an event with an empty diff are written."""
+        self.harness.set_leader(True)
+        self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        rel_id = self.harness.add_relation("configurable-scrape-jobs", "broken")
+        self.harness.add_relation_unit(rel_id, "broken/0")
+        self.harness.update_relation_data(rel_id, "broken/0", self._unit_data("broken"))
+        invalid_job = {"job_name": "invalid", "static_configs": [{"targets": ["*:9500"]}]}
+
+        with patch.object(
+            CosTool, "path", new_callable=PropertyMock, return_value=Path("cos-tool-amd64")
+        ), patch.object(CosTool, "_exec", side_effect=fake_validate_config), patch.object(
+            PrometheusScrapeConfigCharm, "_update_metrics_consumers"
+        ) as update_metrics_consumers:
+            # The invalid job is dropped, so the targets of the relation do not change
+            self.harness.update_relation_data(
+                rel_id, "broken", {"scrape_jobs": json.dumps([invalid_job])}
+            )
+
+        update_metrics_consumers.assert_not_called()
+        app_name = self.harness.model.app.name
+        event = json.loads(self.harness.get_relation_data(rel_id, app_name)["event"])
+        self.assertIn("scrape_job_errors", event)
+
+    def test_jobs_of_a_single_relation(self):
+        """Ensure the jobs of one relation are fetched without reading the other relations."""
+        self.harness.set_leader(True)
+        rel_id = self._relate_upstream("cassandra-k8s")
+        self._relate_upstream("kafka-k8s")
+        consumer = self.harness.charm._metrics_providers
+
+        with patch.object(
+            UpstreamsConsumer,
+            "_relation_digest",
+            autospec=True,
+            side_effect=UpstreamsConsumer._relation_digest,
+        ) as relation_digest:
+            jobs = consumer.relation_jobs(rel_id)
+
+        self.assertEqual([call.args[1].id for call in relation_digest.call_args_list], [rel_id])
+        self.assertEqual(
+            [job["static_configs"][0]["labels"]["juju_application"] for job in jobs],
+            ["cassandra-k8s"],
+        )
+        self.assertEqual(consumer.relation_jobs(1234), [])
+
+    def test_unchanged_config_skips_pipeline(self):
+        """Ensure config-changed with unchanged values does not re-run the pipeline."""
+        self.harness.set_leader(True)
+        self._relate_upstream("cassandra-k8s")
+        self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+
+        with patch.object(
+            UpstreamsConsumer,
+            "iter_jobs",
+            autospec=True,
+            side_effect=UpstreamsConsumer.iter_jobs,
+        ) as jobs:
+            self.harness.update_config({"scrape_interval": "1s"})
+            self.assertEqual(jobs.call_count, 0)
+
+            self.harness.update_config({"scrape_interval": "2s"})
+            self.assertEqual(jobs.call_count, 1)
+
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_invalid_config_blocks(self):
+        """Ensure invalid overrides are rejected before reaching the metrics consumers."""
+        self.harness.set_leader(True)
+        self._relate_upstream("cassandra-k8s")
+        downstream_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+
+        self.harness.update_config({"scrape_interval": "10s", "scrape_timeout": "1m"})
+
+        self.assertEqual(
+            self.harness.model.unit.status,
+            BlockedStatus("invalid config: scrape_timeout (1m) is greater than scrape_interval (10s)"),
+        )
+        app_data = self.harness.get_relation_data(downstream_rel_id, self.harness.model.app.name)
+        scrape_jobs = json.loads(typing.cast(str, app_data["scrape_jobs"]))
+        self.assertEqual(scrape_jobs[0]["scrape_interval"], "1s")
+
+        self.harness.update_config({"scrape_timeout": "5s"})
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_unchanged_upstreams_are_not_reprocessed(self):
+        """Ensure only upstream relations whose data changed are processed again."""
+        self.harness.set_leader(True)
+        upstream1_rel_id = self._relate_upstream("cassandra-k8s-1")
+        self._relate_upstream("cassandra-k8s-2")
+        downstream_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+
+        with patch.object(
+            UpstreamsConsumer,
+            "_iter_static_scrape_config",
+            autospec=True,
+            side_effect=UpstreamsConsumer._iter_static_scrape_config,
+        ) as static_scrape_config:
+            self.harness.update_config({"scrape_interval": "2s"})
+            static_scrape_config.assert_not_called()
+
+            self.harness.update_relation_data(
+                upstream1_rel_id,
+                "cassandra-k8s-1/0",
+                {"prometheus_scrape_unit_address": "elsewhere.cluster.local"},
+            )
+
+        self.assertEqual(static_scrape_config.call_count, 1)
+        self.assertEqual(static_scrape_config.call_args.args[1].id, upstream1_rel_id)
+
+        app_data = self.harness.get_relation_data(downstream_rel_id, self.harness.model.app.name)
+        scrape_jobs = json.loads(typing.cast(str, app_data["scrape_jobs"]))
+        self.assertEqual(
+            sorted(job["static_configs"][0]["targets"][0] for job in scrape_jobs),
+            ["elsewhere.cluster.local:9500", "whatever.cluster.local:9500"],
+        )
+        self.assertTrue(all(job["scrape_interval"] == "2s" for job in scrape_jobs))
+
+    def test_scrape_job_errors_are_reported_to_invalid_upstreams(self):
+        """Ensure upstreams are validated together, and errors reported to the invalid ones."""
+        self.harness.set_leader(True)
+        downstream_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+
+        with patch.object(
+            CosTool, "path", new_callable=PropertyMock, return_value=Path("cos-tool-amd64")
+        ), patch.object(CosTool, "_exec", side_effect=fake_validate_config) as exec_:
+            valid_rel_ids = [self._relate_upstream(f"valid-{i}") for i in range(3)]
+            invalid_rel_id = self._relate_upstream("broken", job_name="invalid")
+
+            exec_.reset_mock()
+            self.harness.update_config({"scrape_interval": "2s"})
+
+        # Nothing changed upstream, so nothing is validated again
+        exec_.assert_not_called()
+
+        app_name = self.harness.model.app.name
+        app_data = self.harness.get_relation_data(downstream_rel_id, app_name)
+        scrape_jobs = json.loads(typing.cast(str, app_data["scrape_jobs"]))
+        self.assertEqual(len(scrape_jobs), 3)
+        self.assertFalse(any("invalid" in job["job_name"] for job in scrape_jobs))
+
+        event = json.loads(self.harness.get_relation_data(invalid_rel_id, app_name)["event"])
+        self.assertIn("scrape_job_errors", event)
+        for rel_id in valid_rel_ids:
+            self.assertNotIn("event", self.harness.get_relation_data(rel_id, app_name))
+
     def test_no_downstreams(self):
         """Ensure charm blocks when no downstreams."""
         self.harness.set_leader(True)
@@ -320,6 +1233,20 @@ class TestCharm(unittest.TestCase):
             WaitingStatus("inactive unit"),
         )
 
+    def test_elected_unit_updates_the_metrics_consumers(self):
+        """Ensure that a unit elected leader publishes what it was waiting for."""
+        self.harness.set_leader(False)
+        downstream_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        self._relate_upstream("cassandra-k8s")
+        app_data = self.harness.get_relation_data(downstream_rel_id, self.harness.model.app.name)
+        self.assertEqual(self.harness.model.unit.status, WaitingStatus("inactive unit"))
+        self.assertEqual(dict(app_data), {})
+
+        self.harness.set_leader(True)
+
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+        self.assertEqual(len(json.loads(app_data["scrape_jobs"])), 1)
+
     def test_alert_rules(self):
         self.harness.set_leader(True)
         prom_rel_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
@@ -9,7 +9,7 @@ import yaml
 
 class TestConfigKeys(unittest.TestCase):
     def test_config_keys_were_mindfully_added(self):
-        # In charm.py, all config keys, unless explicitly excluded, would be used as part of a scrape config.
+        # In overrides.py, all config keys, unless explicitly excluded, would be used as part of a scrape config.
         # For this reason, any newly added key should be either a valid scrape config key or explicitly excluded.
         metadata = yaml.safe_load(Path("./charmcraft.yaml").read_text())
         config_keys = set(metadata["config"]["options"].keys())
@@ -26,4 +26,11 @@ class TestConfigKeys(unittest.TestCase):
             "label_name_length_limit",
             "label_value_length_limit",
             "forward_alert_rules",  # Excluded (non scrape config keys)
+            "shard_targets",  # Excluded (non scrape config keys)
+            "routes",  # Excluded (non scrape config keys)
+            "profiles",  # Excluded (non scrape config keys)
+            "compress_payloads",  # Excluded (non scrape config keys)
+            "split_scrape_jobs",  # Excluded (non scrape config keys)
+            "consolidate_jobs",  # Excluded (non scrape config keys)
+            "min_publish_interval",  # Excluded (non scrape config keys)
         }
@@ -0,0 +1,344 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import re
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import PropertyMock, patch
+
+from helpers import alert_expressions, fake_transform, fake_validate_config
+
+from cos_tool import CosTool, CosToolCache
+from promql import UnsupportedPromQLError, inject_promql_label_matchers
+
+
+class TestValidateScrapeJobsBatch(unittest.TestCase):
+    def setUp(self):
+        self.tool = CosTool(None)
+        patcher = patch.object(
+            CosTool, "path", new_callable=PropertyMock, return_value=Path("cos-tool-amd64")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_valid_jobs_are_validated_in_one_run(self):
+        job_lists = [[{"job_name": "job"}] for _ in range(10)]
+
+        with patch.object(CosTool, "_exec", side_effect=fake_validate_config) as exec_:
+            errors = self.tool.validate_scrape_jobs_batch(job_lists)
+
+        self.assertEqual(errors, [None] * 10)
+        self.assertEqual(exec_.call_count, 1)
+
+    def test_invalid_jobs_are_isolated(self):
+        job_lists = [[{"job_name": "job"}] for _ in range(16)]
+        job_lists[3] = [{"job_name": "job"}, {"job_name": "invalid-job"}]
+        job_lists[12] = [{"job_name": "invalid-job"}]
+
+        with patch.object(CosTool, "_exec", side_effect=fake_validate_config) as exec_:
+            errors = self.tool.validate_scrape_jobs_batch(job_lists)
+
+        self.assertEqual([i for i, error in enumerate(errors) if error], [3, 12])
+        self.assertIn("returned non-zero exit status 1", str(errors[3]))
+        # One run per bisection level for each of the two invalid lists, plus the initial run
+        self.assertLessEqual(exec_.call_count, 1 + 2 * 2 * 4)
+
+    def test_empty_job_lists_are_not_validated(self):
+        with patch.object(CosTool, "_exec", side_effect=fake_validate_config) as exec_:
+            errors = self.tool.validate_scrape_jobs_batch([[], []])
+
+        self.assertEqual(errors, [None, None])
+        exec_.assert_not_called()
+
+    def test_without_cos_tool_everything_is_valid(self):
+        with patch.object(CosTool, "path", new_callable=PropertyMock, return_value=None):
+            errors = self.tool.validate_scrape_jobs_batch([[{"job_name": "invalid-job"}]])
+
+        self.assertEqual(errors, [None])
+
+
+class TestCosToolCache(unittest.TestCase):
+    def setUp(self):
+        self.entries = {}
+        self.tool = CosTool(None, CosToolCache(self.entries, max_entries=2))
+        patcher = patch.object(
+            CosTool, "path", new_callable=PropertyMock, return_value=Path("cos-tool-amd64")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_results_are_cached(self):
+        with patch.object(CosTool, "_exec", side_effect=fake_validate_config) as exec_:
+            for _ in range(3):
+                self.assertTrue(self.tool.validate_scrape_jobs([{"job_name": "job"}]))
+
+        self.assertEqual(exec_.call_count, 1)
+        self.assertEqual((self.tool.cache.hits, self.tool.cache.misses), (2, 1))
+        self.assertEqual(self.tool.cache.summary(), "2 hits, 1 misses, 1 entries")
+
+    def test_failures_are_cached(self):
+        with patch.object(CosTool, "_exec", side_effect=fake_validate_config) as exec_:
+            errors = [
+                self.tool.validate_scrape_jobs_batch([[{"job_name": "invalid-job"}]])[0]
+                for _ in range(3)
+            ]
+
+        self.assertEqual(exec_.call_count, 1)
+        self.assertIsNotNone(errors[0])
+        self.assertEqual(errors, [errors[0]] * 3)
+
+    def test_cache_is_shared_through_its_entries(self):
+        with patch.object(CosTool, "_exec", side_effect=fake_transform):
+            self.tool.inject_label_matchers('up{"a.b"="c"}', {"juju_model": "a"})
+
+        # e.g. a new charm instance in the next hook, loading the entries from its stored state
+        tool = CosTool(None, CosToolCache(self.entries))
+        with patch.object(CosTool, "_exec", side_effect=fake_transform) as exec_:
+            expression = tool.inject_label_matchers('up{"a.b"="c"}', {"juju_model": "a"})
+
+        exec_.assert_not_called()
+        self.assertEqual(expression, 'up{juju_model="a","a.b"="c"}')
+
+    def test_least_recently_used_results_are_evicted(self):
+        with patch.object(CosTool, "_exec", side_effect=fake_validate_config) as exec_:
+            for name in ["a", "b", "a", "c", "a", "b"]:
+                self.tool.validate_scrape_jobs([{"job_name": name}])
+
+        # "b" was evicted by "c", while "a" was kept as it was used more recently
+        self.assertEqual(exec_.call_count, 4)
+        self.assertEqual(len(self.tool.cache), 2)
+
+    def test_lookups_do_not_modify_the_entries(self):
+        with patch.object(CosTool, "_exec", side_effect=fake_validate_config):
+            for name in ["a", "b"]:
+                self.tool.validate_scrape_jobs([{"job_name": name}])
+        entries = list(self.entries.items())
+
+        # e.g. a hook only hitting the cache, which should not rewrite the stored state
+        with patch.object(CosTool, "_exec", side_effect=fake_validate_config) as exec_:
+            self.tool.validate_scrape_jobs([{"job_name": "a"}])
+
+        exec_.assert_not_called()
+        self.assertEqual(list(self.entries.items()), entries)
+
+
+class TestInjectLabelMatchersBulk(unittest.TestCase):
+    def setUp(self):
+        self.tool = CosTool(None)
+        patcher = patch.object(
+            CosTool, "path", new_callable=PropertyMock, return_value=Path("cos-tool-amd64")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_expressions_are_transformed_in_one_run_per_topology(self):
+        # Quoted label names are not supported in-process, so these need cos-tool
+        topology_a = {"juju_model": "a"}
+        topology_b = {"juju_model": "b"}
+        expressions = [
+            ('up{"service.name"="x"} == 0', topology_a),
+            ('label_replace(up{"a.b"="c"}, "x", "(a) or (b)", "", "")', topology_a),
+            ('up{"service.name"="x"} == 0', topology_b),
+            ('sum by (x) (foo{"a.b"="c"}) > 0 # comment', topology_a),
+            ("up", {}),
+        ]
+
+        with patch.object(CosTool, "_exec", side_effect=fake_transform) as exec_:
+            transformed = self.tool.inject_label_matchers_bulk(expressions)
+
+        self.assertEqual(
+            transformed,
+            [
+                'up{juju_model="a","service.name"="x"} == 0',
+                'label_replace(up{juju_model="a","a.b"="c"}, "x", "(a) or (b)", "", "")',
+                'up{juju_model="b","service.name"="x"} == 0',
+                'sum by (x) (foo{juju_model="a","a.b"="c"}) > 0 # comment',
+                "up",
+            ],
+        )
+        self.assertEqual(exec_.call_count, 2)
+
+    def test_supported_expressions_are_transformed_without_cos_tool(self):
+        topology = {"juju_model": "a"}
+        expressions = [("up == 0", topology), ('foo{"a.b"="c"} > 1', topology)]
+
+        with patch.object(CosTool, "_exec", side_effect=fake_transform) as exec_:
+            transformed = self.tool.inject_label_matchers_bulk(expressions)
+
+        self.assertEqual(
+            transformed, ['up{juju_model="a"} == 0', 'foo{juju_model="a","a.b"="c"} > 1']
+        )
+        self.assertEqual(exec_.call_count, 1)
+
+    def test_falls_back_to_one_run_per_expression(self):
+        topology = {"juju_model": "a"}
+        expressions = [
+            ('up{"a.b"="c"} == 0', topology),
+            ('bad{"a.b"="c"}', topology),
+            ('foo{"a.b"="c"} > 1', topology),
+        ]
+
+        with patch.object(CosTool, "_exec", side_effect=fake_transform) as exec_:
+            transformed = self.tool.inject_label_matchers_bulk(expressions)
+
+        # Expressions that cannot be transformed are left unchanged
+        self.assertEqual(
+            transformed,
+            [
+                'up{juju_model="a","a.b"="c"} == 0',
+                'bad{"a.b"="c"}',
+                'foo{juju_model="a","a.b"="c"} > 1',
+            ],
+        )
+        self.assertEqual(exec_.call_count, 1 + len(expressions))
+
+    def test_without_cos_tool_unsupported_expressions_are_unchanged(self):
+        with patch.object(CosTool, "path", new_callable=PropertyMock, return_value=None):
+            transformed = self.tool.inject_label_matchers_bulk(
+                [("up", {"juju_model": "a"}), ('up{"a.b"="c"}', {"juju_model": "a"})]
+            )
+
+        self.assertEqual(transformed, ['up{juju_model="a"}', 'up{"a.b"="c"}'])
+
+
+class TestInjectPromQLLabelMatchers(unittest.TestCase):
+    MATCHERS = {"juju_model": "m", "juju_application": "a"}
+    M = 'juju_model="m",juju_application="a"'
+
+    def test_supported_expressions(self):
+        m = self.M
+        for expression, expected in [
+            ("up", f"up{{{m}}}"),
+            ("up{%%juju_topology%%}", f"up{{{m}}}"),
+            ('up{job="x",%%juju_topology%%} == 0', f'up{{job="x",{m}}} == 0'),
+            ('{__name__=~"up|foo"}', f'{{__name__=~"up|foo",{m}}}'),
+            ("rate(foo[5m]) > 0.5", f"rate(foo{{{m}}}[5m]) > 0.5"),
+            ("SUM BY (job) (up) == 0", f"SUM BY (job) (up{{{m}}}) == 0"),
+            ("sum without(instance)(up)", f"sum without(instance)(up{{{m}}})"),
+            (
+                "foo / on(job) group_left(x) bar",
+                f"foo{{{m}}} / on(job) group_left(x) bar{{{m}}}",
+            ),
+            (
+                "max_over_time(up[1h:5m] offset 1d)",
+                f"max_over_time(up{{{m}}}[1h:5m] offset 1d)",
+            ),
+            ("up @ 1609746000", f"up{{{m}}} @ 1609746000"),
+            ("absent(up) # no targets", f"absent(up{{{m}}}) # no targets"),
+            (
+                'vector(1) and on() label_replace(up, "a", "b", "", "")',
+                f'vector(1) and on() label_replace(up{{{m}}}, "a", "b", "", "")',
+            ),
+            ("foo:bar:rate5m > Inf", f"foo:bar:rate5m{{{m}}} > Inf"),
+            ("up\n  unless\nfoo", f"up{{{m}}}\n  unless\nfoo{{{m}}}"),
+        ]:
+            with self.subTest(expression=expression):
+                self.assertEqual(inject_promql_label_matchers(expression, self.MATCHERS), expected)
+
+    def test_unsupported_expressions(self):
+        for expression in [
+            "sum(up",
+            "up)",
+            '{"service.name"="x"}',
+            'up{"a.b"="c"}',
+            'up{juju_model="other"}',
+            "up[$interval]",
+        ]:
+            with self.subTest(expression=expression):
+                with self.assertRaises(UnsupportedPromQLError):
+                    inject_promql_label_matchers(expression, self.MATCHERS)
+
+    def test_matches_cos_tool(self):
+        # cos-tool is run directly, as `inject_label_matchers` only runs it for the
+        # expressions that are not supported in-process
+        tool = CosTool(None)
+        if not tool.path:
+            # `tox -e cos-tool` downloads a pinned cos-tool release and requires it
+            if os.environ.get("COS_TOOL_REQUIRED"):
+                self.fail("cos-tool is not available")
+            self.skipTest("cos-tool is not available, see `tox -e cos-tool`")
+        for expression in alert_expressions():
+            with self.subTest(expression=expression):
+                expression = re.sub(r"%%juju_topology%%,?", "", expression)
+                injected = inject_promql_label_matchers(expression, self.MATCHERS)
+                expected = tool._transform(expression, self.MATCHERS)
+                # cos-tool prints the expression back in its canonical form
+                self.assertEqual(tool._transform(injected, {}), expected)
+
+
+class TestConcurrentExecution(unittest.TestCase):
+    def setUp(self):
+        self.tool = CosTool(None, max_workers=4)
+        patcher = patch.object(
+            CosTool, "path", new_callable=PropertyMock, return_value=Path("cos-tool-amd64")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def slow(self, func):
+        def run(cmd):
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            try:
+                time.sleep(0.05)
+                return func(cmd)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+        return run
+
+    def test_invalid_jobs_are_isolated_concurrently(self):
+        job_lists = [[{"job_name": f"job-{i}"}] for i in range(8)]
+        job_lists[2] = [{"job_name": "invalid-job"}]
+        job_lists[5] = [{"job_name": "invalid-job"}, {"job_name": "job"}]
+
+        with patch.object(CosTool, "_exec", side_effect=self.slow(fake_validate_config)):
+            errors = self.tool.validate_scrape_jobs_batch(job_lists)
+
+        self.assertEqual([i for i, error in enumerate(errors) if error], [2, 5])
+        self.assertEqual(self.max_running, 4)
+
+    def test_invalid_jobs_are_bisected_concurrently(self):
+        job_lists = [[{"job_name": f"job-{i}"}] for i in range(64)]
+        job_lists[37] = [{"job_name": "invalid-job"}]
+
+        with patch.object(CosTool, "_exec", side_effect=self.slow(fake_validate_config)) as exec_:
+            errors = self.tool.validate_scrape_jobs_batch(job_lists)
+
+        self.assertEqual([i for i, error in enumerate(errors) if error], [37])
+        # Both halves at each of the 6 bisection levels, plus the initial run
+        self.assertEqual(exec_.call_count, 1 + 2 * 6)
+        self.assertEqual(self.max_running, 2)
+
+    def test_concurrent_runs_are_bounded_by_workers(self):
+        tool = CosTool(None, max_workers=2)
+        job_lists = [[{"job_name": f"job-{i}"}] for i in range(8)]
+        job_lists[2] = [{"job_name": "invalid-job"}]
+        job_lists[5] = [{"job_name": "invalid-job"}]
+
+        with patch.object(CosTool, "_exec", side_effect=self.slow(fake_validate_config)):
+            errors = tool.validate_scrape_jobs_batch(job_lists)
+
+        self.assertEqual([i for i, error in enumerate(errors) if error], [2, 5])
+        # Nested bisections run up to four cos-tool processes at once without the bound
+        self.assertEqual(self.max_running, 2)
+
+    def test_expressions_are_transformed_concurrently(self):
+        expressions = [(f'up{{"a.b"="{i}"}}', {"juju_model": str(i % 3)}) for i in range(6)]
+
+        with patch.object(CosTool, "_exec", side_effect=self.slow(fake_transform)) as exec_:
+            transformed = self.tool.inject_label_matchers_bulk(expressions)
+
+        self.assertEqual(
+            transformed, [f'up{{juju_model="{i % 3}","a.b"="{i}"}}' for i in range(6)]
+        )
+        self.assertEqual(exec_.call_count, 3)
+        self.assertEqual(self.max_running, 3)
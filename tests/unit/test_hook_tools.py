@@ -0,0 +1,87 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import inspect
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from ops.model import ModelError, _ModelBackend
+
+from hook_tools import MEMOIZED_METHODS, HookToolAccounting
+
+
+class FakeBackend:
+    """A model backend running hook tools like ops does, through `_run`."""
+
+    def __init__(self):
+        self.runs = []
+
+    def _run(self, *args, **kwargs):
+        self.runs.append(args)
+        if args[0] == "relation-get":
+            raise ModelError("relation not found")
+        return args[0]
+
+    def is_leader(self):
+        return self._run("is-leader", return_output=True, use_json=True)
+
+    def relation_get(self, relation_id):
+        return self._run("relation-get", "-r", str(relation_id))
+
+    def relation_remote_app_name(self, relation_id):
+        return self._run("relation-list", "-r", str(relation_id), "--app")
+
+    def planned_units(self):
+        return self._run("goal-state")
+
+
+class TestHookToolAccounting(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.accounting = HookToolAccounting(self.backend)
+
+    def test_invocations_are_counted_per_hook_tool(self):
+        self.backend.is_leader()
+        self.backend.is_leader()
+        with self.assertRaises(ModelError):
+            self.backend.relation_get(1)
+
+        self.assertEqual(self.accounting.calls, {"is-leader": 2, "relation-get": 1})
+        self.assertEqual(set(self.accounting.durations), {"is-leader", "relation-get"})
+
+    def test_concurrent_invocations_are_all_counted(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: self.backend.is_leader(), range(8000)))
+
+        self.assertEqual(self.accounting.calls, {"is-leader": 8000})
+
+    def test_ops_backend_runs_hook_tools_through_run(self):
+        # The accounting wraps this private method of ops, see the module docstring
+        parameters = inspect.signature(_ModelBackend._run).parameters
+        self.assertEqual(parameters["args"].kind, inspect.Parameter.VAR_POSITIONAL)
+        for name in MEMOIZED_METHODS:
+            self.assertTrue(callable(getattr(_ModelBackend, name)), name)
+
+    def test_read_only_hook_tools_are_memoized(self):
+        for _ in range(3):
+            self.assertEqual(self.backend.relation_remote_app_name(1), "relation-list")
+            self.assertEqual(self.backend.planned_units(), "goal-state")
+        self.backend.relation_remote_app_name(2)
+
+        self.assertEqual(self.accounting.calls, {"relation-list": 2, "goal-state": 3})
+        # The goal state may change during a hook, e.g. after `juju add-unit`
+        self.assertEqual(self.accounting.memoized, {"relation_remote_app_name": 2})
+        self.assertEqual(len(self.backend.runs), 5)
+
+    def test_summary(self):
+        self.assertEqual(self.accounting.summary(), "no hook tools invoked")
+
+        self.backend.is_leader()
+        self.backend.relation_remote_app_name(1)
+        self.backend.relation_remote_app_name(1)
+        summary = self.accounting.summary()
+
+        self.assertTrue(summary.startswith("2 hook tool invocations in "), summary)
+        self.assertIn("is-leader x1 (", summary)
+        self.assertIn("relation-list x1 (", summary)
+        self.assertTrue(summary.endswith("; 1 avoided by memoization"), summary)
@@ -0,0 +1,139 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import unittest
+
+from overrides import (
+    InvalidOverridesError,
+    ScrapeOverrides,
+    format_duration,
+    parse_duration,
+    profiles_from_config,
+)
+
+
+class TestDurations(unittest.TestCase):
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration("0"), 0)
+        self.assertEqual(parse_duration("250ms"), 250)
+        self.assertEqual(parse_duration("1m30s"), 90_000)
+        self.assertEqual(parse_duration("1h"), 3_600_000)
+
+    def test_parse_invalid_duration(self):
+        for value in ["", "1", "1.5s", "s", "30s1m", "-1s"]:
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    parse_duration(value)
+
+    def test_format_duration(self):
+        self.assertEqual(format_duration(0), "0s")
+        self.assertEqual(format_duration(90_000), "1m30s")
+        self.assertEqual(format_duration(parse_duration("14d")), "2w")
+
+
+class TestScrapeOverrides(unittest.TestCase):
+    def test_values_are_parsed_and_normalized(self):
+        overrides = ScrapeOverrides.from_config(
+            {
+                "scrape_interval": " 90s ",
+                "scrape_timeout": "10s",
+                "sample_limit": 1000,
+                "relabel_configs": "- target_label: foo\n  replacement: bar\n",
+                "forward_alert_rules": True,
+            }
+        )
+        self.assertEqual(
+            dict(overrides.values),
+            {
+                "scrape_interval": "1m30s",
+                "scrape_timeout": "10s",
+                "sample_limit": 1000,
+                "relabel_configs": [{"target_label": "foo", "replacement": "bar"}],
+            },
+        )
+
+    def test_unset_values_are_not_overridden(self):
+        overrides = ScrapeOverrides.from_config(
+            {"scrape_interval": "", "relabel_configs": "", "forward_alert_rules": True}
+        )
+        self.assertEqual(dict(overrides.values), {})
+        job = {"job_name": "job", "scrape_interval": "1m"}
+        self.assertEqual(overrides.apply(job), {"job_name": "job", "scrape_interval": "1m"})
+
+    def test_compiled_overrides_are_cached(self):
+        config = {"scrape_interval": "1m", "forward_alert_rules": True}
+        overrides = ScrapeOverrides.from_config(config)
+        self.assertIs(ScrapeOverrides.from_config(dict(config)), overrides)
+
+        changed = ScrapeOverrides.from_config({**config, "scrape_interval": "2m"})
+        self.assertNotEqual(changed.digest, overrides.digest)
+
+    def test_overrides_are_immutable(self):
+        overrides = ScrapeOverrides.from_config({"scrape_interval": "1m"})
+        with self.assertRaises(TypeError):
+            overrides.values["scrape_interval"] = "2m"  # type: ignore
+
+    def test_invalid_values_are_rejected(self):
+        for config in [
+            {"scrape_interval": "1 minute"},
+            {"scrape_interval": "10s", "scrape_timeout": "1m"},
+            {"sample_limit": -1},
+            {"relabel_configs": "- foo: [bar"},
+            {"metric_relabel_configs": "action: drop"},
+            {"proxy_url": "proxy:3128"},
+        ]:
+            with self.subTest(config=config):
+                with self.assertRaises(InvalidOverridesError):
+                    ScrapeOverrides.from_config(config)
+
+
+class TestProfiles(unittest.TestCase):
+    def test_profiles_are_layered_on_global_overrides(self):
+        profiles = profiles_from_config(
+            {
+                "scrape_interval": "1m",
+                "sample_limit": 1000,
+                "profiles": "short: {scrape_interval: 15s}\n"
+                "long: {scrape_interval: 2m, relabel_configs: [{target_label: a}]}\n",
+            }
+        )
+        self.assertEqual(
+            dict(profiles["short"].values), {"scrape_interval": "15s", "sample_limit": 1000}
+        )
+        self.assertEqual(
+            dict(profiles["long"].values),
+            {
+                "scrape_interval": "2m",
+                "sample_limit": 1000,
+                "relabel_configs": [{"target_label": "a"}],
+            },
+        )
+
+    def test_profiles_with_non_json_scalars(self):
+        profiles = profiles_from_config(
+            {"profiles": "short: {relabel_configs: [{target_label: 2026-01-01}]}"}
+        )
+        self.assertEqual(
+            dict(profiles["short"].values), {"relabel_configs": [{"target_label": "2026-01-01"}]}
+        )
+
+    def test_compiled_profiles_are_cached(self):
+        config = {"profiles": "short: {scrape_interval: 15s}"}
+        self.assertIs(profiles_from_config(dict(config)), profiles_from_config(config))
+
+    def test_unset_profiles(self):
+        for value in [None, ""]:
+            with self.subTest(value=value):
+                self.assertEqual(dict(profiles_from_config({"profiles": value})), {})
+
+    def test_invalid_profiles_are_rejected(self):
+        for config in [
+            {"profiles": "- short"},
+            {"profiles": "short: {forward_alert_rules: false}"},
+            {"profiles": "short: {scrape_interval: 1 minute}"},
+            # The timeout of the global overrides exceeds the interval of the profile
+            {"scrape_timeout": "30s", "profiles": "short: {scrape_interval: 15s}"},
+        ]:
+            with self.subTest(config=config):
+                with self.assertRaises(InvalidOverridesError):
+                    profiles_from_config(config)
@@ -0,0 +1,108 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+
+from payload_encoding import (
+    decode_relation_payload,
+    encode_relation_payload,
+    load_split_relation_payload,
+    split_relation_payload,
+)
+
+
+def _payloads(upstreams: int):
+    """Scrape jobs and alert rules as forwarded for the given number of upstreams."""
+    jobs = []
+    groups = []
+    for i in range(upstreams):
+        labels = {
+            "juju_model": "cos",
+            "juju_model_uuid": "20ce8299-3634-4bef-8bd8-5ace6c8816b4",
+            "juju_application": f"app-{i}",
+            "juju_charm": "some-charm",
+        }
+        jobs.append(
+            {
+                "job_name": f"juju_cos_20ce829_app-{i}_prometheus_scrape",
+                "metrics_path": "/metrics",
+                "scrape_interval": "1m",
+                "static_configs": [
+                    {"targets": [f"app-{i}-{j}.app-{i}-endpoints.cos.svc.cluster.local:9100"]}
+                    for j in range(3)
+                ],
+                "relabel_configs": [
+                    {
+                        "source_labels": ["juju_model", "juju_model_uuid", "juju_application"],
+                        "separator": "_",
+                        "target_label": "instance",
+                        "regex": "(.*)",
+                    }
+                ],
+            }
+        )
+        groups.append(
+            {
+                "name": f"cos_20ce8299_app-{i}_alerts",
+                "rules": [
+                    {
+                        "alert": "TargetDown",
+                        "expr": 'up{{juju_application="app-{}",juju_model="cos"}} < 1'.format(i),
+                        "for": "5m",
+                        "labels": dict(labels, severity="critical"),
+                        "annotations": {"summary": "Target {{ $labels.instance }} is down"},
+                    }
+                ],
+            }
+        )
+    return json.dumps(jobs), json.dumps({"groups": groups})
+
+
+class TestRelationPayloadEncoding(unittest.TestCase):
+    def test_encoded_payloads_are_decoded(self):
+        payload = json.dumps([{"job_name": "job"}])
+        databag = {"scrape_jobs_zlib_v1": encode_relation_payload(payload)}
+        self.assertEqual(decode_relation_payload(databag, "scrape_jobs"), payload)
+
+    def test_plain_payloads_are_read_as_is(self):
+        databag = {"scrape_jobs": "[]"}
+        self.assertEqual(decode_relation_payload(databag, "scrape_jobs"), "[]")
+        self.assertIsNone(decode_relation_payload({}, "scrape_jobs"))
+
+    def test_invalid_payloads_are_ignored(self):
+        databag = {"scrape_jobs": "[]", "scrape_jobs_zlib_v1": "bm90IHpsaWI="}
+        self.assertIsNone(decode_relation_payload(databag, "scrape_jobs"))
+
+    def test_payloads_compress_well(self):
+        for upstreams in [10, 100, 1000]:
+            for payload in _payloads(upstreams):
+                with self.subTest(upstreams=upstreams):
+                    encoded = encode_relation_payload(payload)
+                    decoded = decode_relation_payload({"key_zlib_v1": encoded}, "key")
+
+                    self.assertEqual(decoded, payload)
+                    # Payloads are highly repetitive, so they compress well
+                    self.assertLess(len(encoded), len(payload) / 5)
+
+
+class TestSplitRelationPayload(unittest.TestCase):
+    def test_chunks_are_content_addressed(self):
+        chunks = [json.dumps([{"job_name": "a"}]), json.dumps([{"job_name": "b"}])]
+        databag = split_relation_payload("scrape_jobs", chunks)
+
+        manifest = json.loads(databag["scrape_jobs_manifest"])
+        self.assertEqual(len(manifest), 2)
+        self.assertEqual([databag[f"scrape_jobs.{digest}"] for digest in manifest], chunks)
+        # Unchanged chunks keep their key
+        changed = split_relation_payload("scrape_jobs", [chunks[0], "[]"])
+        self.assertIn(f"scrape_jobs.{manifest[0]}", changed)
+        self.assertNotIn(f"scrape_jobs.{manifest[1]}", changed)
+
+    def test_split_payloads_are_loaded_in_order(self):
+        chunks = [json.dumps([{"job_name": f"job-{i}"}]) for i in range(3)]
+        databag = split_relation_payload("scrape_jobs", chunks)
+
+        jobs = load_split_relation_payload(databag, "scrape_jobs")
+        self.assertEqual(jobs, [{"job_name": f"job-{i}"} for i in range(3)])
+        self.assertIsNone(load_split_relation_payload({"scrape_jobs": "[]"}, "scrape_jobs"))
@@ -0,0 +1,75 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import unittest
+from unittest.mock import patch
+
+from routing import InvalidRoutesError, RoutingTable, topology_labels
+
+ROUTES = """
+"mysql-*": prometheus-db
+"juju_model=prod-*,juju_application=*-exporter": [prometheus-a, prometheus-b]
+"noisy": prometheus-short
+"""
+
+
+class TestRoutingTable(unittest.TestCase):
+    def setUp(self):
+        self.routes = RoutingTable.from_config(ROUTES)
+        self.consumers = ["prometheus-a", "prometheus-b", "prometheus-db", "prometheus-short"]
+
+    def test_first_matching_route_wins(self):
+        for topology, expected in [
+            ({"juju_application": "mysql-k8s"}, ("prometheus-db",)),
+            (
+                {"juju_model": "prod-1", "juju_application": "node-exporter"},
+                ("prometheus-a", "prometheus-b"),
+            ),
+            ({"juju_model": "dev", "juju_application": "node-exporter"}, tuple(self.consumers)),
+            ({"juju_application": "noisy"}, ("prometheus-short",)),
+            ({}, tuple(self.consumers)),
+        ]:
+            with self.subTest(topology=topology):
+                self.assertEqual(self.routes.consumers_for(topology, self.consumers), expected)
+
+    def test_consumers_that_are_not_related_are_skipped(self):
+        routed = self.routes.consumers_for({"juju_application": "mysql-k8s"}, ["prometheus-a"])
+        self.assertEqual(routed, ())
+
+    def test_routes_are_evaluated_once_per_topology(self):
+        jobs = [
+            {"job_name": f"job-{i}", "app": "mysql-k8s" if i % 2 else "other"} for i in range(100)
+        ]
+        with patch.object(
+            RoutingTable,
+            "consumers_for",
+            autospec=True,
+            side_effect=RoutingTable.consumers_for,
+        ) as consumers_for:
+            indexed = self.routes.index(
+                jobs, lambda job: topology_labels({"juju_application": job["app"]}), self.consumers
+            )
+
+        self.assertEqual(consumers_for.call_count, 2)
+        self.assertEqual(len(indexed["prometheus-db"]), 100)
+        self.assertEqual(len(indexed["prometheus-a"]), 50)
+        self.assertEqual(indexed["prometheus-a"][0]["job_name"], "job-0")
+
+    def test_unset_routes(self):
+        for value in [None, "", "# no routes"]:
+            with self.subTest(value=value):
+                self.assertFalse(RoutingTable.from_config(value))
+
+    def test_invalid_routes_are_rejected(self):
+        for value in [
+            "- mysql",
+            "mysql: [1, 2]",
+            "juju_foo=bar: prometheus",
+            "a: [b",
+            # A term without "=" would otherwise match no upstream at all
+            "juju_model=prod,juju_application: prometheus",
+            "juju_model=prod,mysql-*: prometheus",
+        ]:
+            with self.subTest(value=value):
+                with self.assertRaises(InvalidRoutesError):
+                    RoutingTable.from_config(value)
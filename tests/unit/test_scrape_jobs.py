@@ -0,0 +1,298 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import copy
+import hashlib
+import json
+import random
+import tracemalloc
+import unittest
+from typing import List
+
+from charms.prometheus_k8s.v0.prometheus_scrape import PrometheusConfig
+from cosl import JujuTopology
+
+from scrape_jobs import (
+    consolidate_jobs,
+    dedupe_job_names,
+    iter_expanded_wildcard_targets,
+)
+from serialization import canonical_json, iter_json_array
+
+
+def _reference_dedupe_job_names(jobs):
+    """The original quadratic implementation of `dedupe_job_names`, hashing canonical JSON.
+
+    Jobs are returned in canonical order. The jobs given to it must have sorted targets.
+    """
+    jobs_copy = copy.deepcopy(jobs)
+    jobs_dict = {
+        job["job_name"]: list(filter(lambda x: x["job_name"] == job["job_name"], jobs_copy))
+        for job in jobs_copy
+    }
+    for key in jobs_dict:
+        if len(jobs_dict[key]) > 1:
+            for job in jobs_dict[key]:
+                hashed = hashlib.sha256(canonical_json(job).encode()).hexdigest()
+                job["job_name"] = "{}_{}".format(job["job_name"], hashed)
+    new_jobs = []
+    for key in jobs_dict:
+        new_jobs.extend(list(jobs_dict[key]))
+    deduped_jobs = []
+    seen = []
+    for job in new_jobs:
+        hashed = hashlib.sha256(json.dumps(job).encode()).hexdigest()
+        if hashed in seen:
+            continue
+        seen.append(hashed)
+        deduped_jobs.append(job)
+    return sorted(deduped_jobs, key=lambda job: (job["job_name"], canonical_json(job)))
+
+
+def _jobs(count: int, seed: int = 0):
+    """Scrape jobs with some shared names and some identical jobs."""
+    rng = random.Random(seed)
+    return [
+        {
+            "job_name": f"job-{rng.randrange(count // 2 or 1)}",
+            "metrics_path": "/metrics",
+            "static_configs": [{"targets": [f"10.0.0.{rng.randrange(4)}:9100"]}],
+        }
+        for _ in range(count)
+    ]
+
+
+TOPOLOGY = JujuTopology(
+    model="model",
+    model_uuid="20ce8299-3634-4bef-8bd8-5ace6c8816b4",
+    application="app",
+    charm_name="charm",
+)
+
+
+class TestExpandWildcardTargets(unittest.TestCase):
+    def setUp(self):
+        self.jobs = [
+            {"job_name": "job", "static_configs": [{"targets": ["*:9100"]}]},
+            {
+                "job_name": "mixed",
+                "metrics_path": "/stats",
+                "relabel_configs": [{"target_label": "a", "replacement": "b"}],
+                "static_configs": [
+                    {"targets": ["*:9100", "*:9200", "fixed:80"], "labels": {"x": "y"}},
+                    {"targets": ["*"], "labels": {"juju_unit": "pinned/0"}},
+                ],
+            },
+            {"metrics_path": "/unnamed", "static_configs": [{"targets": ["*:80"]}]},
+            {"job_name": "empty", "static_configs": [{"targets": []}]},
+        ]
+        self.hosts = {f"app/{i}": (f"10.0.0.{i}", "/prefix" * (i % 2)) for i in range(5)}
+
+    def test_expanded_jobs_match_the_reference(self):
+        for topology in [TOPOLOGY, None]:
+            with self.subTest(topology=topology):
+                self.assertEqual(
+                    list(iter_expanded_wildcard_targets(self.jobs, self.hosts, topology)),
+                    PrometheusConfig.expand_wildcard_targets_into_individual_jobs(
+                        self.jobs, self.hosts, topology
+                    ),
+                )
+
+    def test_unit_invariant_parts_are_shared(self):
+        jobs = list(iter_expanded_wildcard_targets(self.jobs[:1], self.hosts, TOPOLOGY))
+
+        self.assertEqual(len(jobs), len(self.hosts))
+        self.assertTrue(all(job["relabel_configs"] is jobs[0]["relabel_configs"] for job in jobs))
+        # Per-unit fields are not shared
+        self.assertEqual(len({id(job["static_configs"][0]["labels"]) for job in jobs}), len(jobs))
+
+    def test_jobs_are_not_modified(self):
+        original = copy.deepcopy(self.jobs)
+        list(iter_expanded_wildcard_targets(self.jobs, self.hosts, TOPOLOGY))
+        self.assertEqual(self.jobs, original)
+
+    def test_jobs_are_expanded_lazily(self):
+        consumed = []
+
+        def jobs():
+            for job in self.jobs:
+                consumed.append(job)
+                yield job
+
+        expanded = iter_expanded_wildcard_targets(jobs(), self.hosts, TOPOLOGY)
+        self.assertEqual(consumed, [])
+        next(expanded)
+        self.assertEqual(consumed, self.jobs[:1])
+
+    def test_streamed_serialization_peak_memory(self):
+        jobs = [
+            {
+                "job_name": f"job-{i}",
+                "relabel_configs": [{"target_label": "a", "replacement": "b"}],
+                "static_configs": [{"targets": ["*:9100", "*:9101"], "labels": {"x": "y"}}],
+            }
+            for i in range(5)
+        ]
+        hosts = {f"app/{i}": (f"10.0.{i // 256}.{i % 256}", "") for i in range(1000)}
+
+        tracemalloc.start()
+        try:
+            payload = "".join(
+                iter_json_array(
+                    iter_expanded_wildcard_targets(jobs, hosts, TOPOLOGY)
+                )
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # The expanded jobs are discarded as they are serialized, so the peak is about twice
+        # the size of the payload (its fragments and the payload itself). Materializing the
+        # expanded jobs before serializing them peaks at more than four times its size.
+        self.assertLess(peak, 3 * len(payload))
+
+
+class TestConsolidateJobs(unittest.TestCase):
+    def setUp(self):
+        jobs = [{"job_name": "job", "static_configs": [{"targets": ["*:9100"]}]}]
+        hosts = {f"app/{i}": (f"10.0.0.{i}", "") for i in range(3)}
+        self.jobs = list(iter_expanded_wildcard_targets(jobs, hosts, TOPOLOGY))
+
+    def test_per_unit_jobs_are_merged(self):
+        consolidated = consolidate_jobs(self.jobs)
+
+        self.assertEqual(len(self.jobs), 3)
+        self.assertEqual(len(consolidated), 1)
+        job = consolidated[0]
+        self.assertEqual(job["job_name"], self.jobs[0]["job_name"])
+        self.assertEqual(job["relabel_configs"], self.jobs[0]["relabel_configs"])
+        self.assertEqual(
+            [
+                (static_config["targets"], static_config["labels"]["juju_unit"])
+                for static_config in job["static_configs"]
+            ],
+            [([f"10.0.0.{i}:9100"], f"app/{i}") for i in range(3)],
+        )
+        # The series keep the `job` label they had before
+        self.assertEqual(
+            [static_config["labels"]["job"] for static_config in job["static_configs"]],
+            [original["job_name"] for original in self.jobs],
+        )
+
+    def test_jobs_with_different_settings_are_kept(self):
+        self.jobs[1] = dict(self.jobs[1], scrape_interval="1m")
+        consolidated = consolidate_jobs(self.jobs)
+
+        self.assertEqual(
+            [len(job["static_configs"]) for job in consolidated],
+            [2, 1],
+        )
+
+    def test_jobs_are_not_modified(self):
+        consolidate_jobs(self.jobs)
+        self.assertEqual([len(job["static_configs"]) for job in self.jobs], [1, 1, 1])
+        self.assertNotIn("job", self.jobs[0]["static_configs"][0]["labels"])
+
+
+class TestDedupe(unittest.TestCase):
+    def test_job_names_are_deduped_like_the_reference(self):
+        for seed in range(20):
+            jobs = _jobs(50, seed)
+            with self.subTest(seed=seed):
+                self.assertEqual(dedupe_job_names(jobs), _reference_dedupe_job_names(jobs))
+
+    def test_jobs_are_only_copied_when_renamed(self):
+        jobs = [{"job_name": "a"}, {"job_name": "b", "x": 1}, {"job_name": "b", "x": 2}]
+        deduped = dedupe_job_names(jobs)
+
+        self.assertIs(deduped[0], jobs[0])
+        self.assertEqual([job["job_name"] for job in jobs], ["a", "b", "b"])
+
+    def test_dedupe_is_linear(self):
+        # Operations on the jobs are counted rather than timed, which is not reliable on
+        # shared runners. The quadratic implementation looked up the name of every other
+        # job for each job.
+        for count in [100, 1_000]:
+            jobs: List[dict] = [_CountingJob(job) for job in _jobs(count)]
+            _CountingJob.operations = 0
+            dedupe_job_names(jobs)
+            with self.subTest(count=count):
+                self.assertLessEqual(_CountingJob.operations, 3 * count)
+
+
+class _CountingJob(dict):
+    """A scrape job counting the lookups of its keys and the comparisons with it."""
+
+    operations = 0
+    __hash__ = None  # pyright: ignore
+
+    def __getitem__(self, key):
+        _CountingJob.operations += 1
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        _CountingJob.operations += 1
+        return super().get(key, default)
+
+    def __eq__(self, other):
+        _CountingJob.operations += 1
+        return super().__eq__(other)
+
+
+def _shuffled(jobs, rng: random.Random):
+    """Copy jobs, shuffling their order, the order of their keys and of their targets."""
+    shuffled = []
+    for job in rng.sample(jobs, len(jobs)):
+        job = copy.deepcopy(job)
+        for static_config in job.get("static_configs", []):
+            rng.shuffle(static_config["targets"])
+        rng.shuffle(job.get("static_configs", []))
+        shuffled.append(dict(rng.sample(list(job.items()), len(job))))
+    return shuffled
+
+
+class TestCanonicalSerialization(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.jobs = [
+            {
+                "job_name": f"job-{rng.randrange(10)}",
+                "metrics_path": "/metrics",
+                "scrape_interval": rng.choice(["30s", "1m"]),
+                "static_configs": [
+                    {
+                        "targets": [f"10.0.{i}.{j}:9100" for j in range(rng.randrange(1, 4))],
+                        "labels": {"juju_unit": f"app/{i}", "juju_model": "model"},
+                    }
+                    for i in range(rng.randrange(1, 4))
+                ],
+            }
+            for _ in range(30)
+        ]
+
+    def test_deduped_jobs_are_permutation_invariant(self):
+        expected = canonical_json(dedupe_job_names(self.jobs))
+        for seed in range(50):
+            jobs = _shuffled(self.jobs, random.Random(seed))
+            with self.subTest(seed=seed):
+                self.assertEqual(canonical_json(dedupe_job_names(jobs)), expected)
+
+    def test_deduped_jobs_are_sorted(self):
+        jobs = dedupe_job_names(_shuffled(self.jobs, random.Random(1)))
+
+        names = [job["job_name"] for job in jobs]
+        self.assertEqual(names, sorted(names))
+        for job in jobs:
+            for static_config in job["static_configs"]:
+                self.assertEqual(static_config["targets"], sorted(static_config["targets"]))
+
+    def test_json_array_is_written_incrementally(self):
+        for jobs in [[], self.jobs[:1], self.jobs]:
+            with self.subTest(count=len(jobs)):
+                self.assertEqual("".join(iter_json_array(iter(jobs))), canonical_json(jobs))
+
+    def test_jobs_are_not_modified(self):
+        jobs = _shuffled(self.jobs, random.Random(2))
+        original = copy.deepcopy(jobs)
+        dedupe_job_names(jobs)
+        self.assertEqual(jobs, original)
@@ -0,0 +1,81 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import unittest
+
+from sharding import shard_jobs
+
+
+def _targets(jobs):
+    return [
+        target
+        for job in jobs
+        for static_config in job["static_configs"]
+        for target in static_config["targets"]
+    ]
+
+
+class TestShardJobs(unittest.TestCase):
+    def setUp(self):
+        self.jobs = [
+            {
+                "job_name": f"job-{i}",
+                "metrics_path": "/metrics",
+                "static_configs": [
+                    {
+                        "targets": [f"10.1.{i}.{j}:9100" for j in range(20)],
+                        "labels": {"juju_application": f"app-{i}", "env": "prod"},
+                    }
+                ],
+            }
+            for i in range(10)
+        ]
+
+    def assignments(self, shards):
+        return {
+            target: shard
+            for shard, jobs in shard_jobs(self.jobs, shards).items()
+            for target in _targets(jobs)
+        }
+
+    def test_every_target_is_assigned_to_exactly_one_shard(self):
+        sharded = shard_jobs(self.jobs, ["a", "b", "c"])
+
+        all_targets = [target for jobs in sharded.values() for target in _targets(jobs)]
+        self.assertCountEqual(all_targets, _targets(self.jobs))
+        # Every shard gets a fair share of the targets
+        for jobs in sharded.values():
+            self.assertGreater(len(_targets(jobs)), 200 / 3 / 2)
+
+    def test_jobs_keep_their_settings_and_labels(self):
+        for jobs in shard_jobs(self.jobs, ["a", "b"]).values():
+            for job in jobs:
+                i = int(job["job_name"].split("-")[1])
+                self.assertEqual(job["metrics_path"], "/metrics")
+                for static_config in job["static_configs"]:
+                    self.assertEqual(
+                        static_config["labels"], {"juju_application": f"app-{i}", "env": "prod"}
+                    )
+        # The original jobs are left untouched
+        self.assertEqual(len(self.jobs[0]["static_configs"][0]["targets"]), 20)
+
+    def test_adding_a_shard_only_moves_targets_to_it(self):
+        before = self.assignments(["a", "b", "c"])
+        after = self.assignments(["a", "b", "c", "d"])
+
+        moved = {target for target in before if before[target] != after[target]}
+        self.assertTrue(moved)
+        self.assertEqual({after[target] for target in moved}, {"d"})
+
+    def test_removing_a_shard_only_moves_its_targets(self):
+        before = self.assignments(["a", "b", "c"])
+        after = self.assignments(["a", "c"])
+
+        moved = {target for target in before if before[target] != after[target]}
+        self.assertEqual(moved, {target for target in before if before[target] == "b"})
+
+    def test_jobs_without_static_configs_are_assigned_whole(self):
+        job = {"job_name": "discovered", "kubernetes_sd_configs": [{"role": "pod"}]}
+        sharded = shard_jobs([job], ["a", "b"])
+
+        self.assertEqual(sorted(len(jobs) for jobs in sharded.values()), [0, 1])
@@ -0,0 +1,44 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+
+from upstreams import TargetsDiff
+
+
+class TestTargetsDiff(unittest.TestCase):
+    def test_diff_between_snapshots(self):
+        old = {
+            "units": {"app/0": "a", "app/1": "b"},
+            "jobs": {"job-0": "c", "job-1": "d"},
+            "alert_rules": "e",
+        }
+        new = {
+            "units": {"app/1": "B", "app/2": "f"},
+            "jobs": {"job-1": "d", "job-2": "g"},
+            "alert_rules": "e",
+        }
+        self.assertEqual(
+            TargetsDiff.between(old, new),
+            TargetsDiff(
+                added_units=["app/2"],
+                removed_units=["app/0"],
+                changed_units=["app/1"],
+                added_jobs=["job-2"],
+                removed_jobs=["job-0"],
+            ),
+        )
+        self.assertFalse(TargetsDiff.between(new, new))
+        self.assertTrue(TargetsDiff.between(new, dict(new, alert_rules="h")))
+
+    def test_diff_from_empty_snapshot(self):
+        new = {"units": {"app/0": "a"}, "jobs": {"job-0": "b"}, "alert_rules": ""}
+        self.assertEqual(
+            TargetsDiff.between({}, new), TargetsDiff(added_units=["app/0"], added_jobs=["job-0"])
+        )
+
+    def test_round_trip(self):
+        diff = TargetsDiff(added_jobs=["b", "a"], alert_rules_changed=True)
+        self.assertEqual(diff.added_jobs, ["a", "b"])
+        self.assertEqual(TargetsDiff(**json.loads(json.dumps(diff.as_dict()))), diff)